@@ -0,0 +1,383 @@
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+from helpers import (
+    nemo_msdd_model,
+    nemo_speaker_model,
+    nemo_vad_model,
+    punct_model_name,
+)
+
+# Local registry of the configs and model files a job needs. Everything is
+# looked up in the local caches the libraries already use, the NeMo config
+# lives under TS_ARTIFACT_DIR, and manifest.json there records the sha256 of
+# every file, so a node without internet can check that it has everything
+# before the first job instead of stalling in it.
+#
+#   python artifacts.py preflight --fetch   # where there is internet
+#   python artifacts.py preflight           # verify only, exit 1 on problems
+#
+# Set TS_OFFLINE=1 to never download anything at job time.
+
+nemo_config_url = "https://raw.githubusercontent.com/NVIDIA/NeMo/main/examples/speaker_tasks/diarization/conf/inference/{}"
+
+
+def get_artifact_dir():
+    return os.environ.get("TS_ARTIFACT_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "transcriptionstream", "artifacts"
+    )
+
+
+def is_offline():
+    return os.environ.get("TS_OFFLINE", "0") != "0"
+
+
+def nemo_config_path(domain="telephonic", fetch=None):
+    """
+    Path of the NeMo diarization inference config, downloaded into the
+    registry when it is missing and downloads are allowed.
+    """
+    file_name = f"diar_infer_{domain}.yaml"
+    config_dir = os.path.join(get_artifact_dir(), "nemo_msdd_configs")
+    path = os.path.join(config_dir, file_name)
+    if os.path.exists(path):
+        return path
+    # where earlier versions downloaded it, relative to the working directory
+    legacy_path = os.path.join("nemo_msdd_configs", file_name)
+    if os.path.exists(legacy_path):
+        return legacy_path
+    if fetch is False or (fetch is None and is_offline()):
+        raise FileNotFoundError(
+            f"{path} is missing, run artifacts.py preflight --fetch with internet access"
+        )
+
+    import wget
+
+    os.makedirs(config_dir, exist_ok=True)
+    # download next to the target and rename, concurrent jobs may race here
+    download_dir = tempfile.mkdtemp(dir=config_dir)
+    try:
+        downloaded = wget.download(nemo_config_url.format(file_name), download_dir)
+        os.replace(downloaded, path)
+    finally:
+        shutil.rmtree(download_dir, ignore_errors=True)
+    return path
+
+
+def nemo_cache_dir():
+    return os.environ.get("NEMO_CACHE_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "torch", "NeMo"
+    )
+
+
+def nemo_model_path(name):
+    """The cached .nemo file of a pretrained NeMo model, or its name when it is not cached."""
+    paths = sorted(
+        glob.glob(os.path.join(nemo_cache_dir(), "**", f"{name}.nemo"), recursive=True)
+    )
+    return paths[-1] if paths else name
+
+
+class Artifact:
+    """A named artifact, find() returns its local files and fetch() downloads it."""
+
+    def __init__(self, name, find, fetch):
+        self.name = name
+        self.find = find
+        self.fetch = fetch
+
+
+def _list_files(path):
+    if path is None or not os.path.exists(path):
+        return []
+    if os.path.isfile(path):
+        return [path]
+    return sorted(
+        os.path.realpath(p)
+        for p in glob.glob(os.path.join(path, "**"), recursive=True)
+        if os.path.isfile(p)
+    )
+
+
+def _find_hf(repo_id):
+    from huggingface_hub import snapshot_download
+
+    try:
+        return _list_files(snapshot_download(repo_id, local_files_only=True))
+    except Exception:
+        return []
+
+
+def _fetch_hf(repo_id):
+    from huggingface_hub import snapshot_download
+
+    snapshot_download(repo_id)
+
+
+def _find_whisper(model_name):
+    from faster_whisper.utils import download_model
+
+    try:
+        return _list_files(download_model(model_name, local_files_only=True))
+    except Exception:
+        return []
+
+
+def _fetch_whisper(model_name):
+    from faster_whisper.utils import download_model
+
+    download_model(model_name)
+
+
+def _find_nemo(name):
+    path = nemo_model_path(name)
+    return [path] if path != name else []
+
+
+def _fetch_nemo(name):
+    from nemo.collections.asr.models import (
+        EncDecClassificationModel,
+        EncDecDiarLabelModel,
+        EncDecSpeakerLabelModel,
+    )
+
+    model_class = {
+        nemo_vad_model: EncDecClassificationModel,
+        nemo_speaker_model: EncDecSpeakerLabelModel,
+        nemo_msdd_model: EncDecDiarLabelModel,
+    }[name]
+    model_class.from_pretrained(name, map_location="cpu")
+
+
+def _torch_checkpoint_dir():
+    import torch
+
+    return os.path.join(torch.hub.get_dir(), "checkpoints")
+
+
+def _find_torchaudio_bundle(bundle_name):
+    import torchaudio
+
+    bundle = getattr(torchaudio.pipelines, bundle_name)
+    return _list_files(
+        os.path.join(_torch_checkpoint_dir(), os.path.basename(bundle._path))
+    )
+
+
+def _fetch_alignment(language):
+    import whisperx
+
+    whisperx.load_align_model(language_code=language, device="cpu")
+
+
+def _find_demucs(name):
+    import demucs
+    import yaml
+
+    with open(os.path.join(os.path.dirname(demucs.__file__), "remote", f"{name}.yaml")) as f:
+        signatures = yaml.safe_load(f)["models"]
+    files = [
+        glob.glob(os.path.join(_torch_checkpoint_dir(), f"{signature}-*.th"))
+        for signature in signatures
+    ]
+    return sorted(sum(files, [])) if all(files) else []
+
+
+def _fetch_demucs(name):
+    from demucs.pretrained import get_model
+
+    get_model(name)
+
+
+def _alignment_artifact(language):
+    from whisperx.alignment import DEFAULT_ALIGN_MODELS_HF, DEFAULT_ALIGN_MODELS_TORCH
+
+    if language in DEFAULT_ALIGN_MODELS_TORCH:
+        bundle_name = DEFAULT_ALIGN_MODELS_TORCH[language]
+        find = lambda: _find_torchaudio_bundle(bundle_name)
+    elif language in DEFAULT_ALIGN_MODELS_HF:
+        repo_id = DEFAULT_ALIGN_MODELS_HF[language]
+        find = lambda: _find_hf(repo_id)
+    else:
+        return None
+    return Artifact(f"align/{language}", find, lambda: _fetch_alignment(language))
+
+
+def required_artifacts(diarization_model, transcription_model=None, languages=("en",), stemming=True):
+    """The artifacts diarize and transcribe jobs with these models need."""
+    artifacts = [
+        Artifact(
+            "nemo-config/telephonic",
+            lambda: [nemo_config_path(fetch=False)],
+            lambda: nemo_config_path(fetch=True),
+        )
+    ]
+    for model_name in dict.fromkeys(filter(None, (diarization_model, transcription_model))):
+        artifacts.append(
+            Artifact(
+                f"whisper/{model_name}",
+                lambda model_name=model_name: _find_whisper(model_name),
+                lambda model_name=model_name: _fetch_whisper(model_name),
+            )
+        )
+    for name in (nemo_vad_model, nemo_speaker_model, nemo_msdd_model):
+        artifacts.append(
+            Artifact(
+                f"nemo/{name}",
+                lambda name=name: _find_nemo(name),
+                lambda name=name: _fetch_nemo(name),
+            )
+        )
+    artifacts.append(
+        Artifact(
+            f"punctuation/{punct_model_name}",
+            lambda: _find_hf(punct_model_name),
+            lambda: _fetch_hf(punct_model_name),
+        )
+    )
+    for language in languages:
+        artifact = _alignment_artifact(language)
+        if artifact is not None:
+            artifacts.append(artifact)
+    if stemming:
+        from separation_helpers import separation_model_name
+
+        artifacts.append(
+            Artifact(
+                f"demucs/{separation_model_name}",
+                lambda: _find_demucs(separation_model_name),
+                lambda: _fetch_demucs(separation_model_name),
+            )
+        )
+    return artifacts
+
+
+def _try(find):
+    try:
+        return find()
+    except (FileNotFoundError, ImportError):
+        return []
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_manifest_path():
+    return os.path.join(get_artifact_dir(), "manifest.json")
+
+
+def load_manifest():
+    try:
+        with open(get_manifest_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest):
+    path = get_manifest_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def preflight(artifacts, fetch=False, full=False, register=False):
+    """
+    Check that every artifact is on disk and matches the checksums in the
+    manifest. Files not in the manifest yet are hashed and registered, files
+    whose size and mtime did not change are only hashed again with full.
+    fetch downloads missing artifacts first, register records the current
+    checksums instead of comparing them, after an intended update.
+
+    Returns a list of (artifact name, problem).
+    """
+    manifest = load_manifest()
+    problems = []
+    for artifact in artifacts:
+        files = _try(artifact.find)
+        if not files and fetch:
+            try:
+                artifact.fetch()
+            except Exception as e:
+                logging.exception(f"Fetching {artifact.name} failed")
+                problems.append((artifact.name, f"fetch failed: {e!r}"))
+                continue
+            files = _try(artifact.find)
+        if not files:
+            problems.append((artifact.name, "missing"))
+            continue
+
+        if register:
+            manifest.pop(artifact.name, None)
+        recorded = manifest.setdefault(artifact.name, {})
+        for path in files:
+            stat = os.stat(path)
+            entry = recorded.get(path)
+            if (
+                entry is not None
+                and not full
+                and entry["size"] == stat.st_size
+                and entry["mtime"] == stat.st_mtime
+            ):
+                continue
+            digest = file_sha256(path)
+            if entry is not None and entry["sha256"] != digest:
+                problems.append((artifact.name, f"checksum mismatch: {path}"))
+                continue
+            recorded[path] = {"sha256": digest, "size": stat.st_size, "mtime": stat.st_mtime}
+    save_manifest(manifest)
+    return problems
+
+
+def configured_artifacts():
+    """The artifacts for the DIARIZATION_MODEL and TRANSCRIPTION_MODEL of this node."""
+    diarization_model = os.environ.get("DIARIZATION_MODEL", "medium.en")
+    languages = os.environ.get("TS_PREWARM_LANGUAGES", "en").split(",")
+    return required_artifacts(
+        diarization_model,
+        os.environ.get("TRANSCRIPTION_MODEL", "large-v3"),
+        [language.strip() for language in languages if language.strip()],
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="local model and config artifacts")
+    commands = parser.add_subparsers(dest="command", required=True)
+    preflight_parser = commands.add_parser(
+        "preflight",
+        help="verify the artifacts of DIARIZATION_MODEL and TRANSCRIPTION_MODEL",
+    )
+    preflight_parser.add_argument(
+        "--fetch", action="store_true", help="download missing artifacts"
+    )
+    preflight_parser.add_argument(
+        "--full", action="store_true", help="hash every file again, not only changed ones"
+    )
+    preflight_parser.add_argument(
+        "--register",
+        action="store_true",
+        help="record the current checksums, after the artifacts were updated on purpose",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    artifacts = configured_artifacts()
+    problems = dict(
+        preflight(artifacts, fetch=args.fetch, full=args.full, register=args.register)
+    )
+    for artifact in artifacts:
+        print(f"{artifact.name:<40} {problems.get(artifact.name, 'ok')}")
+    sys.exit(1 if problems else 0)
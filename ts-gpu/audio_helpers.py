@@ -0,0 +1,484 @@
+import os
+import struct
+import subprocess
+import tempfile
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+WAV_HEADER_SIZE = 44
+
+
+def _wav_header(num_samples, sample_rate=SAMPLE_RATE, channels=1):
+    data_size = num_samples * channels * 2
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF",
+        36 + data_size,
+        b"WAVE",
+        b"fmt ",
+        16,
+        1,  # PCM
+        channels,
+        sample_rate,
+        sample_rate * channels * 2,
+        channels * 2,
+        16,
+        b"data",
+        data_size,
+    )
+
+
+class PcmAudio:
+    """
+    16 kHz mono int16 audio backed by a memory-mapped WAV file.
+
+    The same file is the NeMo manifest input, and float32() gives Whisper and
+    the alignment model the exact samples whisperx.load_audio would decode.
+    """
+
+    def __init__(self, path, sample_rate=SAMPLE_RATE):
+        self.path = path
+        self.sample_rate = sample_rate
+        num_samples = (os.path.getsize(path) - WAV_HEADER_SIZE) // 2
+        if num_samples <= 0:
+            raise ValueError(f"No audio samples in {path}")
+        self.samples = np.memmap(
+            path, dtype=np.int16, mode="r", offset=WAV_HEADER_SIZE, shape=(num_samples,)
+        )
+
+    def __len__(self):
+        return len(self.samples)
+
+    @property
+    def duration(self):
+        return len(self.samples) / self.sample_rate
+
+    def float32(self, start=0, end=None):
+        return self.samples[start:end].astype(np.float32) / 32768.0
+
+
+def decode_audio(audio_file, output_path, sample_rate=SAMPLE_RATE, chunk_size=1 << 20):
+    """
+    Stream audio_file through ffmpeg once into a 16 kHz mono int16 WAV file at
+    output_path and return it as PcmAudio. Uses the same ffmpeg arguments as
+    whisperx.load_audio so the samples are identical.
+    """
+    cmd = [
+        "ffmpeg",
+        "-nostdin",
+        "-threads",
+        "0",
+        "-i",
+        audio_file,
+        "-f",
+        "s16le",
+        "-ac",
+        "1",
+        "-acodec",
+        "pcm_s16le",
+        "-ar",
+        str(sample_rate),
+        "-",
+    ]
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    num_bytes = 0
+    with open(output_path, "wb") as f, tempfile.TemporaryFile() as stderr:
+        f.write(_wav_header(0, sample_rate))
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+        while True:
+            chunk = process.stdout.read(chunk_size)
+            if not chunk:
+                break
+            f.write(chunk)
+            num_bytes += len(chunk)
+        if process.wait() != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"Failed to load audio: {stderr.read().decode()}")
+        f.seek(0)
+        f.write(_wav_header(num_bytes // 2, sample_rate))
+    return PcmAudio(output_path, sample_rate)
+
+
+def _spectral_flatness(frames, hann):
+    power = np.abs(np.fft.rfft(frames * hann, axis=1)) ** 2 + 1e-10
+    return float(
+        np.median(np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1))
+    )
+
+
+def music_likelihood(
+    samples,
+    sample_rate=SAMPLE_RATE,
+    window_seconds=5.0,
+    max_windows=120,
+    frame_size=512,
+    hop_size=256,
+    silence_rms=1e-3,
+    low_energy_threshold=0.2,
+    flatness_threshold=0.1,
+):
+    """
+    Estimate how much of the audio is music, as the share of non-silent analysis
+    windows that look like music. Speech has many low-energy frames between
+    syllables while music is sustained, and tonal music has a low spectral
+    flatness where hiss and noise are flat. At most max_windows evenly spaced
+    windows are analysed, so the cost does not grow with the recording length.
+
+    Returns (score, features).
+    """
+    window_size = int(window_seconds * sample_rate)
+    num_windows = max(len(samples) // window_size, 1)
+    picked = np.unique(
+        np.linspace(0, num_windows - 1, min(num_windows, max_windows)).astype(int)
+    )
+    hann = np.hanning(frame_size).astype(np.float32)
+
+    voiced_windows, music_windows = 0, 0
+    low_energy_ratios, flatnesses = [], []
+    for idx in picked:
+        segment = np.asarray(
+            samples[idx * window_size : (idx + 1) * window_size], dtype=np.float32
+        ) / 32768.0
+        if len(segment) < frame_size:
+            continue
+        frames = np.lib.stride_tricks.sliding_window_view(segment, frame_size)[
+            ::hop_size
+        ]
+        rms = np.sqrt(np.mean(frames**2, axis=1))
+        if rms.mean() < silence_rms:
+            continue
+
+        flatness = _spectral_flatness(frames, hann)
+        low_energy_ratio = float(np.mean(rms < 0.5 * rms.mean()))
+
+        voiced_windows += 1
+        low_energy_ratios.append(low_energy_ratio)
+        flatnesses.append(flatness)
+        if low_energy_ratio < low_energy_threshold and flatness < flatness_threshold:
+            music_windows += 1
+
+    score = music_windows / voiced_windows if voiced_windows else 0.0
+    features = {
+        "analysed_windows": int(len(picked)),
+        "voiced_windows": voiced_windows,
+        "music_windows": music_windows,
+        "low_energy_ratio": round(float(np.median(low_energy_ratios)), 4)
+        if low_energy_ratios
+        else None,
+        "spectral_flatness": round(float(np.median(flatnesses)), 4)
+        if flatnesses
+        else None,
+    }
+    return score, features
+
+
+def write_wav(path, audio, sample_rate=SAMPLE_RATE):
+    """
+    Write float32 audio in [-1, 1] as a 16 kHz mono int16 WAV and return it as
+    PcmAudio. The file is replaced atomically, so a PcmAudio that still maps
+    the previous file keeps reading the old samples.
+    """
+    samples = np.clip(np.asarray(audio) * 32768.0, -32768, 32767).astype(np.int16)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_wav_header(len(samples), sample_rate))
+        f.write(samples.tobytes())
+    os.replace(tmp_path, path)
+    return PcmAudio(path, sample_rate)
+
+
+def frame_energy_db(samples, frame_size, block_frames=4096):
+    """RMS energy in dBFS of consecutive frames, computed block by block."""
+    num_frames = len(samples) // frame_size
+    energy = np.empty(num_frames, dtype=np.float32)
+    for start in range(0, num_frames, block_frames):
+        end = min(start + block_frames, num_frames)
+        block = np.asarray(
+            samples[start * frame_size : end * frame_size], dtype=np.float32
+        ).reshape(end - start, frame_size)
+        rms = np.sqrt(np.mean((block / 32768.0) ** 2, axis=1))
+        energy[start:end] = 20 * np.log10(rms + 1e-10)
+    return energy
+
+
+def probe_channels(audio_file):
+    """Number of channels of the first audio stream, or None when ffprobe fails."""
+    result = subprocess.run(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "a:0",
+            "-show_entries",
+            "stream=channels",
+            "-of",
+            "csv=p=0",
+            audio_file,
+        ],
+        capture_output=True,
+        text=True,
+    )
+    try:
+        return int(result.stdout.strip().splitlines()[0].strip(","))
+    except (IndexError, ValueError):
+        return None
+
+
+def decode_channel_energy(
+    audio_file, sample_rate=SAMPLE_RATE, frame_seconds=0.03, chunk_size=1 << 20
+):
+    """
+    Stream the first two channels of audio_file through ffmpeg and return the
+    frame_energy_db of both as a (2, num_frames) array. Only the energies are
+    kept, so the memory does not grow with the length of the recording.
+    """
+    cmd = [
+        "ffmpeg",
+        "-nostdin",
+        "-threads",
+        "0",
+        "-i",
+        audio_file,
+        "-f",
+        "s16le",
+        "-ac",
+        "2",
+        "-acodec",
+        "pcm_s16le",
+        "-ar",
+        str(sample_rate),
+        "-",
+    ]
+    frame_size = int(frame_seconds * sample_rate)
+    # whole frames of both channels per read, the rest is carried over
+    frame_bytes = frame_size * 2 * 2
+    energies, rest = [], b""
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+        while True:
+            chunk = process.stdout.read(chunk_size)
+            if not chunk:
+                break
+            data = rest + chunk
+            usable = len(data) - len(data) % frame_bytes
+            rest = data[usable:]
+            samples = np.frombuffer(data[:usable], dtype=np.int16).reshape(-1, 2)
+            energies.append(
+                np.stack([frame_energy_db(samples[:, c], frame_size) for c in (0, 1)])
+            )
+        if process.wait() != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"Failed to load audio: {stderr.read().decode()}")
+    if not energies:
+        return np.zeros((2, 0), dtype=np.float32)
+    return np.concatenate(energies, axis=1)
+
+
+def speech_regions(
+    samples,
+    sample_rate=SAMPLE_RATE,
+    frame_seconds=0.03,
+    floor_db=-50.0,
+    margin_db=12.0,
+    min_silence=0.5,
+    min_speech=0.1,
+    pad=0.2,
+):
+    """
+    Energy based voice activity detection. A frame is active when it is louder
+    than both floor_db and the noise floor (10th percentile) plus margin_db.
+    Gaps shorter than min_silence are bridged, bursts shorter than min_speech
+    dropped and every region padded by pad seconds.
+
+    Returns an (N, 2) int64 array of [start, end) sample offsets.
+    """
+    frame_size = int(frame_seconds * sample_rate)
+    energy = frame_energy_db(samples, frame_size)
+    if len(energy) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    threshold = max(floor_db, float(np.percentile(energy, 10)) + margin_db)
+    active = np.concatenate(([False], energy > threshold, [False]))
+    edges = np.flatnonzero(np.diff(active.astype(np.int8)))
+    starts, ends = edges[::2], edges[1::2]
+    if len(starts) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    # bridge short pauses between words
+    keep = np.concatenate(
+        ([True], (starts[1:] - ends[:-1]) * frame_seconds >= min_silence)
+    )
+    starts = starts[keep]
+    ends = np.maximum.reduceat(ends, np.flatnonzero(keep))
+
+    long_enough = (ends - starts) * frame_seconds >= min_speech
+    starts, ends = starts[long_enough], ends[long_enough]
+
+    pad_frames = int(pad / frame_seconds)
+    regions = np.stack(
+        (
+            np.maximum(starts - pad_frames, 0) * frame_size,
+            np.minimum((ends + pad_frames) * frame_size, len(samples)),
+        ),
+        axis=1,
+    ).astype(np.int64)
+    if len(regions) > 1:
+        # padding can make neighbours overlap again
+        keep = np.concatenate(([True], regions[1:, 0] > regions[:-1, 1]))
+        regions = np.stack(
+            (
+                regions[keep, 0],
+                np.maximum.reduceat(regions[:, 1], np.flatnonzero(keep)),
+            ),
+            axis=1,
+        )
+    return regions
+
+
+def plan_shards(samples, num_shards, sample_rate=SAMPLE_RATE, min_shard_seconds=300.0):
+    """
+    Split the audio into at most num_shards contiguous [start, end) sample
+    ranges of at least min_shard_seconds. Every cut is made in the middle of
+    the silence between two speech regions that is closest to an even split,
+    so no word is cut in half.
+    """
+    total = len(samples)
+    num_shards = min(num_shards, int(total // (min_shard_seconds * sample_rate)))
+    if num_shards <= 1:
+        return [(0, total)]
+    regions = speech_regions(samples, sample_rate)
+    if len(regions) < 2:
+        return [(0, total)]
+
+    gaps = (regions[:-1, 1] + regions[1:, 0]) // 2
+    targets = np.arange(1, num_shards) * total // num_shards
+    after = np.clip(np.searchsorted(gaps, targets), 0, len(gaps) - 1)
+    before = np.clip(after - 1, 0, len(gaps) - 1)
+    nearest = np.where(
+        np.abs(gaps[before] - targets) <= np.abs(gaps[after] - targets), before, after
+    )
+    bounds = [0, *np.unique(gaps[nearest]).tolist(), total]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def compaction_segments(
+    samples,
+    sample_rate=SAMPLE_RATE,
+    min_gap=5.0,
+    keep=0.5,
+    window_seconds=1.0,
+    frame_size=512,
+    hop_size=256,
+    low_energy_threshold=0.2,
+    flatness_threshold=0.1,
+    floor_db=-80.0,
+):
+    """
+    The parts of the audio left when silences and music of at least min_gap
+    seconds are cut out, as an (N, 2) int64 array of [start, end) sample
+    offsets. A window_seconds window is silence when speech_regions finds no
+    speech in it, and music when it looks like music to music_likelihood.
+    keep seconds of every cut region stay on both sides, so no word edge is
+    lost.
+
+    Speech is found relative to the noise floor of the call. floor_db is far
+    below the -50 dB speech_regions uses for stemming, so a quiet far end over
+    a quiet line is kept, it only keeps line hiss from counting as speech.
+    """
+    total = len(samples)
+    window_size = int(window_seconds * sample_rate)
+    num_windows = total // window_size
+    if num_windows == 0:
+        return np.array([[0, total]], dtype=np.int64)
+
+    speech = np.zeros(num_windows, dtype=bool)
+    for start, end in speech_regions(samples, sample_rate, floor_db=floor_db).tolist():
+        speech[start // window_size : min(-(-end // window_size), num_windows)] = True
+
+    hann = np.hanning(frame_size).astype(np.float32)
+    for idx in np.flatnonzero(speech).tolist():
+        segment = np.asarray(
+            samples[idx * window_size : (idx + 1) * window_size], dtype=np.float32
+        ) / 32768.0
+        frames = np.lib.stride_tricks.sliding_window_view(segment, frame_size)[::hop_size]
+        rms = np.sqrt(np.mean(frames**2, axis=1))
+        # speech pauses between syllables, only sustained windows get the FFT
+        if np.mean(rms < 0.5 * rms.mean()) >= low_energy_threshold:
+            continue
+        if _spectral_flatness(frames, hann) < flatness_threshold:
+            speech[idx] = False
+
+    padded = np.concatenate(([True], speech, [True]))
+    edges = np.flatnonzero(np.diff(padded.astype(np.int8)))
+    gap_starts, gap_ends = edges[::2], edges[1::2]
+    min_windows = int(np.ceil(min_gap / window_seconds))
+    long_gaps = gap_ends - gap_starts >= min_windows
+
+    keep_size = int(keep * sample_rate)
+    cuts = [
+        (start * window_size + (keep_size if start > 0 else 0),
+         total if end == num_windows else end * window_size - keep_size)
+        for start, end in zip(gap_starts[long_gaps].tolist(), gap_ends[long_gaps].tolist())
+    ]
+    bounds = [0]
+    for cut_start, cut_end in cuts:
+        if cut_end > cut_start:
+            bounds.extend((cut_start, cut_end))
+    bounds.append(total)
+    segments = np.array(bounds, dtype=np.int64).reshape(-1, 2)
+    return segments[segments[:, 1] > segments[:, 0]]
+
+
+class OffsetMap:
+    """
+    Maps times in audio made of the [start, end) sample segments of another
+    recording, one after the other, back to the time in that recording.
+    """
+
+    def __init__(self, segments, sample_rate=SAMPLE_RATE):
+        self.segments = np.asarray(segments, dtype=np.int64).reshape(-1, 2)
+        self.sample_rate = sample_rate
+        lengths = self.segments[:, 1] - self.segments[:, 0]
+        self.compacted_starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+    @property
+    def compacted_length(self):
+        return int((self.segments[:, 1] - self.segments[:, 0]).sum())
+
+    def to_original_ms(self, ms, end=False):
+        """
+        Original times in ms of an array of compacted times in ms. A time on a
+        cut is the start of the segment after it, or with end the end of the
+        segment before it, so nothing that ends at a cut spans the cut out gap.
+        """
+        ms = np.asarray(ms)
+        starts_ms = self.compacted_starts * 1000 / self.sample_rate
+        shifts_ms = (self.segments[:, 0] - self.compacted_starts) * 1000 / self.sample_rate
+        side = "left" if end else "right"
+        idx = np.maximum(np.searchsorted(starts_ms, ms, side=side) - 1, 0)
+        return np.rint(ms + shifts_ms[idx]).astype(ms.dtype)
+
+
+def write_segments(path, samples, segments, sample_rate=SAMPLE_RATE, block_size=1 << 22):
+    """
+    Write the [start, end) segments of int16 samples one after the other as a
+    16 kHz mono int16 WAV and return it as PcmAudio. Like write_wav the file is
+    replaced atomically, so samples can map the file being replaced.
+    """
+    segments = np.asarray(segments, dtype=np.int64).reshape(-1, 2)
+    num_samples = int((segments[:, 1] - segments[:, 0]).sum())
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_wav_header(num_samples, sample_rate))
+        for start, end in segments.tolist():
+            for block_start in range(start, end, block_size):
+                f.write(
+                    np.asarray(
+                        samples[block_start : min(block_start + block_size, end)],
+                        dtype=np.int16,
+                    ).tobytes()
+                )
+    os.replace(tmp_path, path)
+    return PcmAudio(path, sample_rate)
@@ -0,0 +1,1009 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from word_table import WordTable
+
+# Micro benchmarks for the post-processing helpers. Every benchmark times the
+# current implementation against a reference copy of the one it replaced on a
+# synthetic transcript. That both give the same result is checked by the tests
+# in tests/, which import the reference copies from here.
+#
+#   python3 benchmark.py speaker-mapping --hours 10 --words 100000
+#   python3 benchmark.py realignment --words 100000
+#   python3 benchmark.py sentences --words 3000
+#   python3 benchmark.py timestamps --words 100000
+#   python3 benchmark.py diarization-profiles --samples /data/labelled
+
+
+def synthetic_transcript(hours, num_words, num_speakers=4, seed=0):
+    """Word timestamps and NeMo style speaker turns covering hours of audio."""
+    rng = random.Random(seed)
+    duration = hours * 3600.0
+
+    spk_ts, t = [], 0.0
+    while t < duration:
+        length = rng.uniform(1.0, 30.0)
+        spk_ts.append([int(t * 1000), int((t + length) * 1000), rng.randrange(num_speakers)])
+        # turns can overlap a little or leave a gap
+        t += length + rng.uniform(-0.5, 2.0)
+
+    step = duration / num_words
+    words = []
+    for i in range(num_words):
+        start = round(i * step + rng.uniform(0, step / 4), 3)
+        words.append(
+            {
+                "word": rng.choice(["so", "the", "call", "is", "fine.", "ok?", "yes,"]),
+                "start": start,
+                "end": round(start + rng.uniform(0.05, step * 0.7), 3),
+            }
+        )
+    return words, spk_ts
+
+
+def write_rttm(path, spk_ts):
+    with open(path, "w") as f:
+        for s, e, sp in spk_ts:
+            f.write(
+                f"SPEAKER mono_file 1   {s / 1000:.3f}   {(e - s) / 1000:.3f} <NA> <NA> speaker_{sp} <NA> <NA>\n"
+            )
+
+
+def timed(func, *args, repeat=3):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start_time)
+    return best, result
+
+
+def report(name, reference_time, current_time):
+    print(
+        f"{name:<28} reference {reference_time * 1000:9.1f} ms"
+        f"   current {current_time * 1000:9.1f} ms   x{reference_time / current_time:.1f}"
+    )
+
+
+# reference implementations, as they were before the optimized versions
+
+
+def reference_read_speaker_ts(rttm_path):
+    speaker_ts = []
+    with open(rttm_path, "r") as f:
+        lines = f.readlines()
+        for line in lines:
+            line_list = line.split(" ")
+            s = int(float(line_list[5]) * 1000)
+            e = s + int(float(line_list[8]) * 1000)
+            speaker_ts.append([s, e, int(line_list[11].split("_")[-1])])
+    return speaker_ts
+
+
+def reference_get_word_ts_anchor(s, e, option="start"):
+    if option == "end":
+        return e
+    elif option == "mid":
+        return (s + e) / 2
+    return s
+
+
+def reference_get_words_speaker_mapping(wrd_ts, spk_ts, word_anchor_option="start"):
+    s, e, sp = spk_ts[0]
+    wrd_pos, turn_idx = 0, 0
+    wrd_spk_mapping = []
+    for wrd_dict in wrd_ts:
+        ws, we, wrd = (
+            int(wrd_dict["start"] * 1000),
+            int(wrd_dict["end"] * 1000),
+            wrd_dict["word"],
+        )
+        wrd_pos = reference_get_word_ts_anchor(ws, we, word_anchor_option)
+        while wrd_pos > float(e):
+            turn_idx += 1
+            turn_idx = min(turn_idx, len(spk_ts) - 1)
+            s, e, sp = spk_ts[turn_idx]
+            if turn_idx == len(spk_ts) - 1:
+                e = reference_get_word_ts_anchor(ws, we, option="end")
+        wrd_spk_mapping.append(
+            {"word": wrd, "start_time": ws, "end_time": we, "speaker": sp}
+        )
+    return wrd_spk_mapping
+
+
+sentence_ending_punctuations = ".?!"
+
+
+def reference_get_first_word_idx_of_sentence(word_idx, word_list, speaker_list, max_words):
+    is_word_sentence_end = (
+        lambda x: x >= 0 and word_list[x][-1] in sentence_ending_punctuations
+    )
+    left_idx = word_idx
+    while (
+        left_idx > 0
+        and word_idx - left_idx < max_words
+        and speaker_list[left_idx - 1] == speaker_list[left_idx]
+        and not is_word_sentence_end(left_idx - 1)
+    ):
+        left_idx -= 1
+
+    return left_idx if left_idx == 0 or is_word_sentence_end(left_idx - 1) else -1
+
+
+def reference_get_last_word_idx_of_sentence(word_idx, word_list, max_words):
+    is_word_sentence_end = (
+        lambda x: x >= 0 and word_list[x][-1] in sentence_ending_punctuations
+    )
+    right_idx = word_idx
+    while (
+        right_idx < len(word_list)
+        and right_idx - word_idx < max_words
+        and not is_word_sentence_end(right_idx)
+    ):
+        right_idx += 1
+
+    return (
+        right_idx
+        if right_idx == len(word_list) - 1 or is_word_sentence_end(right_idx)
+        else -1
+    )
+
+
+def reference_get_realigned_ws_mapping_with_punctuation(
+    word_speaker_mapping, max_words_in_sentence=50
+):
+    is_word_sentence_end = (
+        lambda x: x >= 0
+        and word_speaker_mapping[x]["word"][-1] in sentence_ending_punctuations
+    )
+    wsp_len = len(word_speaker_mapping)
+
+    words_list, speaker_list = [], []
+    for k, line_dict in enumerate(word_speaker_mapping):
+        word, speaker = line_dict["word"], line_dict["speaker"]
+        words_list.append(word)
+        speaker_list.append(speaker)
+
+    k = 0
+    while k < len(word_speaker_mapping):
+        line_dict = word_speaker_mapping[k]
+        if (
+            k < wsp_len - 1
+            and speaker_list[k] != speaker_list[k + 1]
+            and not is_word_sentence_end(k)
+        ):
+            left_idx = reference_get_first_word_idx_of_sentence(
+                k, words_list, speaker_list, max_words_in_sentence
+            )
+            right_idx = (
+                reference_get_last_word_idx_of_sentence(
+                    k, words_list, max_words_in_sentence - k + left_idx - 1
+                )
+                if left_idx > -1
+                else -1
+            )
+            if min(left_idx, right_idx) == -1:
+                k += 1
+                continue
+
+            spk_labels = speaker_list[left_idx : right_idx + 1]
+            mod_speaker = max(set(spk_labels), key=spk_labels.count)
+            if spk_labels.count(mod_speaker) < len(spk_labels) // 2:
+                k += 1
+                continue
+
+            speaker_list[left_idx : right_idx + 1] = [mod_speaker] * (
+                right_idx - left_idx + 1
+            )
+            k = right_idx
+
+        k += 1
+
+    k, realigned_list = 0, []
+    while k < len(word_speaker_mapping):
+        line_dict = word_speaker_mapping[k].copy()
+        line_dict["speaker"] = speaker_list[k]
+        realigned_list.append(line_dict)
+        k += 1
+
+    return realigned_list
+
+
+def random_word_speaker_mapping(rng, num_words, num_speakers, flip_rate, end_rate):
+    """A word speaker stream with random sentence ends and speaker flips."""
+    speaker_ids = rng.sample(range(40), num_speakers)
+    speaker = rng.choice(speaker_ids)
+    wsm = []
+    for i in range(num_words):
+        if rng.random() < flip_rate:
+            speaker = rng.choice(speaker_ids)
+        word = rng.choice(["so", "the", "U.S.A.", "call", "is", "a", "...ok"])
+        if rng.random() < end_rate:
+            word += rng.choice(".?!")
+        wsm.append({"word": word, "start_time": i * 300, "end_time": i * 300 + 250, "speaker": speaker})
+    return wsm
+
+
+def bench_realignment(args):
+    from helpers import get_realigned_ws_mapping_with_punctuation
+
+    rng = random.Random(1)
+    wsm = random_word_speaker_mapping(
+        rng, args.words, num_speakers=4, flip_rate=0.3, end_rate=0.03
+    )
+    wsm[-1]["word"] += "."
+    reference_time, _ = timed(reference_get_realigned_ws_mapping_with_punctuation, wsm)
+    current_time, _ = timed(get_realigned_ws_mapping_with_punctuation, wsm)
+    report("realignment", reference_time, current_time)
+
+    table = WordTable.from_dicts(wsm)
+    current_time, _ = timed(get_realigned_ws_mapping_with_punctuation, table)
+    report("word table realignment", reference_time, current_time)
+
+
+def reference_get_sentences_speaker_mapping(word_speaker_mapping, spk_ts):
+    import nltk
+
+    sentence_checker = nltk.tokenize.PunktSentenceTokenizer().text_contains_sentbreak
+    s, e, spk = spk_ts[0]
+    prev_spk = spk
+
+    snts = []
+    snt = {"speaker": f"Speaker {spk}", "start_time": s, "end_time": e, "text": ""}
+
+    for wrd_dict in word_speaker_mapping:
+        wrd, spk = wrd_dict["word"], wrd_dict["speaker"]
+        s, e = wrd_dict["start_time"], wrd_dict["end_time"]
+        if spk != prev_spk or sentence_checker(snt["text"] + " " + wrd):
+            snts.append(snt)
+            snt = {
+                "speaker": f"Speaker {spk}",
+                "start_time": s,
+                "end_time": e,
+                "text": "",
+            }
+        else:
+            snt["end_time"] = e
+        snt["text"] += wrd + " "
+        prev_spk = spk
+
+    snts.append(snt)
+    return snts
+
+
+def bench_sentences(args):
+    from helpers import get_sentences_speaker_mapping
+
+    # one speaker talking without a single sentence break
+    rng = random.Random(1)
+    wsm = [
+        {
+            "word": rng.choice(["so", "and", "the", "call", "then", "yes,", "well"]),
+            "start_time": i * 300,
+            "end_time": i * 300 + 250,
+            "speaker": 0,
+        }
+        for i in range(args.words)
+    ]
+    spk_ts = [[0, args.words * 300, 0]]
+    reference_time, _ = timed(reference_get_sentences_speaker_mapping, wsm, spk_ts, repeat=1)
+    current_time, _ = timed(get_sentences_speaker_mapping, wsm, spk_ts, repeat=1)
+    report(f"monologue of {args.words} words", reference_time, current_time)
+
+
+def reference_get_next_start_timestamp(word_timestamps, current_word_index, final_timestamp):
+    # if current word is the last word
+    if current_word_index == len(word_timestamps) - 1:
+        return word_timestamps[current_word_index]["start"]
+
+    next_word_index = current_word_index + 1
+    while current_word_index < len(word_timestamps) - 1:
+        if word_timestamps[next_word_index].get("start") is None:
+            # if next word doesn't have a start timestamp
+            # merge it with the current word and delete it
+            word_timestamps[current_word_index]["word"] += (
+                " " + word_timestamps[next_word_index]["word"]
+            )
+
+            word_timestamps[next_word_index]["word"] = None
+            next_word_index += 1
+            if next_word_index == len(word_timestamps):
+                return final_timestamp
+
+        else:
+            return word_timestamps[next_word_index]["start"]
+
+
+def reference_filter_missing_timestamps(
+    word_timestamps, initial_timestamp=0, final_timestamp=None
+):
+    # handle the first and last word
+    if word_timestamps[0].get("start") is None:
+        word_timestamps[0]["start"] = (
+            initial_timestamp if initial_timestamp is not None else 0
+        )
+        word_timestamps[0]["end"] = reference_get_next_start_timestamp(
+            word_timestamps, 0, final_timestamp
+        )
+
+    result = [
+        word_timestamps[0],
+    ]
+
+    for i, ws in enumerate(word_timestamps[1:], start=1):
+        # if ws doesn't have a start and end
+        # use the previous end as start and next start as end
+        if ws.get("start") is None and ws.get("word") is not None:
+            ws["start"] = word_timestamps[i - 1]["end"]
+            ws["end"] = reference_get_next_start_timestamp(word_timestamps, i, final_timestamp)
+
+        if ws["word"] is not None:
+            result.append(ws)
+    return result
+
+
+def random_word_segments(rng, num_words, missing_rate, max_run):
+    """whisperx style word segments with runs of unaligned words."""
+    segments, t, i = [], 0.0, 0
+    while i < num_words:
+        if rng.random() < missing_rate:
+            for _ in range(min(rng.randrange(1, max_run + 1), num_words - i)):
+                segments.append({"word": rng.choice(["1995", "%", "twenty", "$5"])})
+                i += 1
+        else:
+            start = round(t, 3)
+            t += rng.uniform(0.1, 0.6)
+            segments.append({"word": rng.choice(["so", "the", "call"]), "start": start, "end": round(t, 3), "score": 0.9})
+            i += 1
+    return segments
+
+
+def bench_timestamps(args):
+    import copy
+
+    from helpers import filter_missing_timestamps
+
+    segments = random_word_segments(random.Random(1), args.words, 0.02, 500)
+    reference_input = copy.deepcopy(segments)
+    reference_time, _ = timed(
+        reference_filter_missing_timestamps, reference_input, 0, None, repeat=1
+    )
+    current_time, _ = timed(filter_missing_timestamps, segments, 0, None)
+    report("missing timestamps", reference_time, current_time)
+
+
+def bench_speaker_mapping(args):
+    from helpers import get_words_speaker_mapping, read_rttm
+
+    words, spk_ts = synthetic_transcript(args.hours, args.words)
+    print(f"{args.hours} h, {len(words)} words, {len(spk_ts)} speaker turns")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        rttm_path = os.path.join(temp_dir, "mono_file.rttm")
+        write_rttm(rttm_path, spk_ts)
+        reference_time, reference_ts = timed(reference_read_speaker_ts, rttm_path)
+        current_time, current_ts = timed(read_rttm, rttm_path)
+    report("read rttm", reference_time, current_time)
+
+    for option in ("start", "mid", "end"):
+        reference_time, _ = timed(
+            reference_get_words_speaker_mapping, words, reference_ts, option
+        )
+        current_time, _ = timed(get_words_speaker_mapping, words, current_ts, option)
+        if option == "start":
+            start_reference_time = reference_time
+        report(f"words speaker mapping {option}", reference_time, current_time)
+
+    # the pipeline keeps the words in a WordTable, without the dict adapter
+    table = WordTable.from_word_timestamps(words)
+    current_time, _ = timed(get_words_speaker_mapping, table, current_ts, "start")
+    report("word table speaker mapping", start_reference_time, current_time)
+
+
+def reference_write_outputs(ssm, base, metadata):
+    from helpers import format_timestamp
+
+    data = {"segments": ssm}
+    data.update(metadata)
+
+    with open(f"{base}.txt", "w", encoding="utf-8-sig") as f:
+        previous_speaker = ssm[0]["speaker"]
+        f.write(f"{previous_speaker}: ")
+        for sentence_dict in ssm:
+            speaker = sentence_dict["speaker"]
+            if speaker != previous_speaker:
+                f.write(f"\n\n{speaker}: ")
+                previous_speaker = speaker
+            f.write(sentence_dict["text"] + " ")
+
+    with open(f"{base}.srt", "w", encoding="utf-8-sig") as srt:
+        for i, segment in enumerate(ssm, start=1):
+            print(
+                f"{i}\n"
+                f"{format_timestamp(segment['start_time'], always_include_hours=True, decimal_marker=',')} --> "
+                f"{format_timestamp(segment['end_time'], always_include_hours=True, decimal_marker=',')}\n"
+                f"{segment['speaker']}: {segment['text'].strip().replace('-->', '->')}\n",
+                file=srt,
+                flush=True,
+            )
+
+    with open(f"{base}.json", "w", encoding="utf-8-sig") as json_file:
+        json_file.write(json.dumps(data))
+
+
+def random_sentences(rng, num_sentences):
+    start = 0
+    for _ in range(num_sentences):
+        end = start + rng.randrange(500, 8000)
+        words = rng.choices(["so", "hello", "ünïcode", "--> arrow", 'a "quote"', "tab\t"], k=rng.randrange(1, 25))
+        yield {
+            "speaker": f"Speaker {rng.randrange(3)}",
+            "start_time": start,
+            "end_time": end,
+            "text": " ".join(words) + " ",
+        }
+        start = end
+
+
+def bench_writers(args):
+    import tracemalloc
+
+    from helpers import write_outputs
+
+    metadata = {"audio_duration": args.sentences * 4.25, "stemming": {"mode": "auto", "score": 0.1}}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        base = os.path.join(temp_dir, "transcript")
+        reference_time, _ = timed(
+            lambda: reference_write_outputs(
+                list(random_sentences(random.Random(0), args.sentences)), base, metadata
+            ),
+            repeat=1,
+        )
+        current_time, _ = timed(
+            lambda: write_outputs(
+                random_sentences(random.Random(0), args.sentences), base + ".wav", metadata
+            ),
+            repeat=1,
+        )
+
+        # tracing slows everything down, so the peaks are measured on their own runs
+        tracemalloc.start()
+        reference_write_outputs(
+            list(random_sentences(random.Random(0), args.sentences)), base, metadata
+        )
+        reference_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        write_outputs(random_sentences(random.Random(0), args.sentences), base + ".wav", metadata)
+        current_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    report(f"{args.sentences} sentences", reference_time, current_time)
+    print(
+        f"{'peak memory':<28} reference {reference_peak / 2**20:9.1f} MB"
+        f"   current {current_peak / 2**20:9.1f} MB"
+    )
+
+
+class SyntheticTokenizer:
+    """The get_vocab and to_str of a tokenizers.Tokenizer, with a random vocabulary."""
+
+    def __init__(self, vocab_size, seed=0):
+        rng = random.Random(seed)
+        alphabet = "abcdefghijklmnopqrstuvwxyz\u0120" * 4 + "0123456789%$£"
+        self.vocab = {}
+        while len(self.vocab) < vocab_size:
+            token = "".join(rng.choices(alphabet, k=rng.randrange(1, 9)))
+            self.vocab.setdefault(token, len(self.vocab))
+
+    def get_vocab(self):
+        return dict(self.vocab)
+
+    def to_str(self):
+        return json.dumps(self.vocab)
+
+
+def bench_numeral_tokens(args):
+    import token_cache
+    from helpers import find_numeral_symbol_tokens
+
+    tokenizer = SyntheticTokenizer(args.vocab_size)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.environ["TS_TOKEN_CACHE_DIR"] = temp_dir
+        scan_time, _ = timed(find_numeral_symbol_tokens, tokenizer, "synthetic", repeat=1)
+        token_cache._memory.clear()
+        disk_time, _ = timed(find_numeral_symbol_tokens, tokenizer, "synthetic", repeat=1)
+        memory_time, _ = timed(find_numeral_symbol_tokens, tokenizer, "synthetic")
+        token_cache.clear_token_cache()
+    report("numeral tokens from disk", scan_time, disk_time)
+    report("numeral tokens from memory", scan_time, memory_time)
+
+
+# entry points run after every file or row, with arguments that make them
+# exit right after their imports
+startup_entry_points = {
+    "update-data.py": ["--help"],
+    "notify.py": ["--help"],
+    "ts-summarize.py": [],
+    "nemo_process.py": ["--help"],
+}
+heavy_modules = ("torch", "whisperx", "nemo", "nltk", "omegaconf", "wget", "requests", "numpy")
+
+startup_probe = """
+import json, runpy, sys
+sys.argv = sys.argv[1:]
+sys.path.insert(0, ".")
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+except SystemExit:
+    pass
+except ImportError as e:
+    print(json.dumps({"error": repr(e)}), file=sys.stderr)
+    sys.exit(0)
+print(json.dumps({"modules": sorted({m.split(".")[0] for m in sys.modules})}), file=sys.stderr)
+"""
+
+
+def bench_startup(args):
+    import statistics
+    import subprocess
+    import sys
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def run(command):
+        start_time = time.perf_counter()
+        result = subprocess.run(
+            command, cwd=script_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+        )
+        return time.perf_counter() - start_time, result
+
+    interpreter_time = statistics.median(
+        run([sys.executable, "-c", "pass"])[0] for _ in range(args.repeat)
+    )
+    print(f"{'python -c pass':<28} {interpreter_time * 1000:9.1f} ms")
+
+    for script, script_args in startup_entry_points.items():
+        _, probe = run([sys.executable, "-c", startup_probe, script, *script_args])
+        try:
+            loaded = json.loads(probe.stderr.strip().splitlines()[-1])
+        except (IndexError, ValueError):
+            loaded = {"error": probe.stderr.strip()[-200:]}
+        if "error" in loaded:
+            print(f"{script:<28} could not start here: {loaded['error']}")
+            continue
+        startup_time = statistics.median(
+            run([sys.executable, script, *script_args])[0] for _ in range(args.repeat)
+        )
+        heavy = [m for m in heavy_modules if m in loaded["modules"]]
+        print(
+            f"{script:<28} {startup_time * 1000:9.1f} ms"
+            f"   heavy imports: {', '.join(heavy) or 'none'}"
+        )
+
+
+def bench_stage_graph(args):
+    from stage_graph import Stage, StageGraph, format_stats
+
+    # seconds per file of every stage, scaled down: decoding and stemming,
+    # Whisper, alignment, NeMo, punctuation and writing
+    durations = {
+        "prepare": 0.3, "transcribe": 0.4, "align": 0.1,
+        "diarize": 0.5, "punctuate": 0.1, "write": 0.05,
+    }
+    deps = {
+        "prepare": (), "transcribe": ("prepare",), "align": ("transcribe",),
+        "diarize": ("prepare",), "punctuate": ("align",), "write": ("diarize", "punctuate"),
+    }
+
+    def sleep_stage(name):
+        # a batch costs a little more than one item, not one item per file
+        return lambda items: time.sleep(durations[name] * (1 + 0.1 * (len(items) - 1)))
+
+    sequential_time = sum(durations.values()) * args.files
+
+    graph = StageGraph(
+        [
+            Stage(
+                name,
+                sleep_stage(name),
+                deps=deps[name],
+                workers=2 if name in ("prepare", "write") else 1,
+                batch_size=8 if name in ("transcribe", "punctuate") else 1,
+                resource=None if name in ("prepare", "write") else "model",
+            )
+            for name in durations
+        ],
+        resources={"model": args.model_slots},
+    )
+    start_time = time.perf_counter()
+    futures = [graph.submit({"file": i}) for i in range(args.files)]
+    items = [future.result() for future in futures]
+    graph_time = time.perf_counter() - start_time
+    stats = graph.stats()
+    graph.shutdown()
+
+    print(f"{'one file after the other':<28} {sequential_time:8.2f} s")
+    print(f"{'stage graph':<28} {graph_time:8.2f} s  x{sequential_time / graph_time:.1f}")
+    print(format_stats(stats))
+    slowest = max(items, key=lambda item: sum(t["queue"] for t in item["stage_times"].values()))
+    print(f"longest queued file: {json.dumps(slowest['stage_times'])}")
+
+
+def synthetic_call(rng, seconds, sample_rate=16000, leakage=0.03):
+    """A two-channel call, speakers alternating with pauses and crosstalk."""
+    import numpy as np
+
+    n = int(seconds * sample_rate)
+    stereo = (rng.standard_normal((n, 2)) * 30).astype(np.int16)
+    truth, t, speaker = [], 0, 0
+    while t < n:
+        end = min(t + int(rng.uniform(1.0, 10.0) * sample_rate), n)
+        voice = rng.standard_normal(end - t) * 3000 * (1 + np.sin(np.arange(end - t) / 800))
+        stereo[t:end, speaker] += voice.astype(np.int16)
+        stereo[t:end, 1 - speaker] += (voice * leakage).astype(np.int16)
+        truth.append((t * 1000 // sample_rate, end * 1000 // sample_rate, speaker))
+        t = end + int(rng.uniform(0.2, 1.5) * sample_rate)
+        speaker = 1 - speaker
+    return stereo, truth
+
+
+def bench_channels(args):
+    import numpy as np
+
+    from audio_helpers import frame_energy_db
+    from channel_diarization import channel_activity, channel_separation, channel_turns
+
+    rng = np.random.default_rng(0)
+    stereo, truth = synthetic_call(rng, args.minutes * 60)
+    frame_size = 480
+
+    start_time = time.perf_counter()
+    energy = np.stack([frame_energy_db(stereo[:, c], frame_size) for c in (0, 1)])
+    active = channel_activity(energy)
+    separation, shares = channel_separation(energy, active)
+    turns = channel_turns(energy, active)
+    channel_time = time.perf_counter() - start_time
+
+    # share of the speech of the reference that gets the right speaker, at 10 ms
+    reference = np.full(len(stereo) // 160, -1, dtype=np.int8)
+    for s, e, speaker in truth:
+        reference[s // 10 : e // 10] = speaker
+    predicted = np.full(len(reference), -1, dtype=np.int8)
+    for s, e, speaker in turns.tolist():
+        predicted[s // 10 : e // 10] = speaker
+    speech = reference >= 0
+    accuracy = float(np.mean(predicted[speech] == reference[speech]))
+
+    mono = np.repeat(stereo.mean(axis=1, keepdims=True).astype(np.int16), 2, axis=1)
+    mono_energy = np.stack([frame_energy_db(mono[:, c], frame_size) for c in (0, 1)])
+    mono_separation, _ = channel_separation(mono_energy, channel_activity(mono_energy))
+
+    print(f"{args.minutes:.0f} min call: {len(truth)} reference turns, {len(turns)} found")
+    print(f"{'channel diarization':<28} {channel_time * 1000:9.1f} ms (without decoding)")
+    print(f"{'separation':<28} {separation:9.3f}  channel shares {shares[0]:.2f} / {shares[1]:.2f}")
+    print(f"{'speech with right speaker':<28} {accuracy:9.2%}")
+    print(f"{'separation of a down-mix':<28} {mono_separation:9.3f}  (goes to NeMo)")
+
+
+def synthetic_hold_call(rng, minutes, sample_rate=16000, speech_level=3000, noise_level=20):
+    """
+    A mono call of speech with syllable pauses, dead air and hold music.
+    Returns the int16 samples and the [start, end) sample ranges of speech.
+    """
+    import numpy as np
+
+    parts, speech, position = [], [], 0
+    while position < minutes * 60 * sample_rate:
+        kind = rng.choice(["speech", "speech", "speech", "silence", "music"])
+        n = int(rng.uniform(1.0, 40.0 if kind != "speech" else 20.0) * sample_rate)
+        t = np.arange(n) / sample_rate
+        if kind == "speech":
+            voiced = np.sin(2 * np.pi * 4 * t) > 0
+            # the line noise goes on under the speech and its pauses
+            part = rng.standard_normal(n) * speech_level * voiced
+            part += rng.standard_normal(n) * noise_level
+            speech.append((position, position + int(np.flatnonzero(voiced)[-1]) + 1))
+        elif kind == "music":
+            part = 4000 * (np.sin(2 * np.pi * 440 * t) + 0.5 * np.sin(2 * np.pi * 660 * t))
+        else:
+            part = rng.standard_normal(n) * noise_level
+        parts.append(part.astype(np.int16))
+        position += n
+    return np.concatenate(parts), speech
+
+
+def bench_compaction(args):
+    import numpy as np
+
+    from audio_helpers import OffsetMap, compaction_segments
+
+    rng = np.random.default_rng(0)
+    samples, speech = synthetic_hold_call(rng, args.minutes)
+
+    start_time = time.perf_counter()
+    segments = compaction_segments(samples, min_gap=args.min_gap)
+    offsets = OffsetMap(segments)
+    plan_time = time.perf_counter() - start_time
+
+    # every speech sample has to survive, at its original time
+    kept = np.zeros(len(samples), dtype=bool)
+    for start, end in segments.tolist():
+        kept[start:end] = True
+    lost = sum(int((~kept[start:end]).sum()) for start, end in speech)
+    # a time every 10 ms of the kept audio, compacted and original
+    compacted, original = [], []
+    for compacted_start, (start, end) in zip(
+        offsets.compacted_starts.tolist(), segments.tolist()
+    ):
+        compacted.append(np.arange(compacted_start, compacted_start + end - start, 160))
+        original.append(np.arange(start, end, 160))
+    original_ms = offsets.to_original_ms(np.concatenate(compacted) * 1000 // 16000)
+    expected_ms = np.concatenate(original) * 1000 // 16000
+    max_error = int(np.abs(original_ms - expected_ms).max())
+
+    ratio = offsets.compacted_length / len(samples)
+    print(f"{args.minutes:.0f} min call, {len(segments) - 1} cuts, compacted to {ratio:.1%}")
+    print(f"{'planning the cuts':<28} {plan_time * 1000:9.1f} ms")
+    print(f"{'speech samples cut':<28} {lost:9d}")
+    print(f"{'max remapping error':<28} {max_error:9d} ms")
+
+
+def read_reference_rttm(path):
+    """Turns of an RTTM with any speaker labels, as (N, 3) start ms, end ms, speaker index."""
+    import numpy as np
+
+    turns, labels = [], {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0] != "SPEAKER":
+                continue
+            start = int(float(fields[3]) * 1000)
+            speaker = labels.setdefault(fields[7], len(labels))
+            turns.append([start, start + int(float(fields[4]) * 1000), speaker])
+    return np.array(turns, dtype=np.int64).reshape(-1, 3)
+
+
+def diarization_error(reference, hypothesis, collar_ms=250, frame_ms=10):
+    """
+    Missed, false alarm and confused speech of a hypothesis against a
+    reference, in frames, with the speakers mapped one to one so they overlap
+    the most and collar_ms around every reference boundary not scored, like
+    the NIST md-eval DER. Returns (error frames, reference speech frames).
+    """
+    import numpy as np
+    from scipy.optimize import linear_sum_assignment
+
+    end = max(reference[:, 1].max(initial=0), hypothesis[:, 1].max(initial=0))
+    num_frames = int(end) // frame_ms + 1
+
+    def activity(turns):
+        speakers = np.unique(turns[:, 2])
+        matrix = np.zeros((len(speakers), num_frames), dtype=bool)
+        for start, end, speaker in turns.tolist():
+            matrix[np.searchsorted(speakers, speaker), start // frame_ms : end // frame_ms] = True
+        return matrix
+
+    scored = np.ones(num_frames, dtype=bool)
+    for boundary in reference[:, :2].ravel().tolist():
+        scored[max(boundary - collar_ms, 0) // frame_ms : (boundary + collar_ms) // frame_ms] = False
+    ref = activity(reference)[:, scored]
+    hyp = activity(hypothesis)[:, scored]
+
+    overlap = ref.astype(np.int64) @ hyp.T.astype(np.int64)
+    rows, cols = linear_sum_assignment(-overlap)
+    correct = int(overlap[rows, cols].sum())
+    error = int(np.maximum(ref.sum(axis=0), hyp.sum(axis=0)).sum()) - correct
+    return error, int(ref.sum())
+
+
+def bench_diarization_profiles(args):
+    import glob
+
+    from audio_helpers import decode_audio
+    from helpers import cleanup, create_scratch_dir, get_mono_path
+    from model_cache import ModelCache
+    from pipeline import JobReport, get_parser, read_speaker_ts, run_diarizer
+
+    samples = [
+        path
+        for path in sorted(glob.glob(os.path.join(args.samples, "*")))
+        if not path.endswith(".rttm") and os.path.exists(os.path.splitext(path)[0] + ".rttm")
+    ]
+    if not samples:
+        raise SystemExit(f"No audio with a reference <name>.rttm in {args.samples}")
+
+    hints = []
+    if args.num_speakers:
+        hints += ["--num-speakers", str(args.num_speakers)]
+    if args.max_speakers:
+        hints += ["--max-speakers", str(args.max_speakers)]
+    cache = ModelCache(capacity=1)
+
+    def diarize(sample, job_args):
+        temp_path = create_scratch_dir("bench-")
+        try:
+            pcm = decode_audio(sample, get_mono_path(temp_path))
+            start_time = time.perf_counter()
+            run_diarizer(temp_path, job_args, cache, JobReport())
+            return time.perf_counter() - start_time, pcm.duration, read_speaker_ts(temp_path)
+        finally:
+            cleanup(temp_path)
+
+    print(f"{len(samples)} samples, collar {args.collar:.2f}s")
+    for profile in args.profiles.split(","):
+        job_args = get_parser().parse_args(
+            [
+                "-a",
+                samples[0],
+                "--diarization-profile",
+                profile,
+                "--diarizer-workers",
+                str(args.workers),
+                *hints,
+            ]
+        )
+        # the model load is not part of the runtime
+        diarize(samples[0], job_args)
+        run_time, duration, errors, speech = 0.0, 0.0, 0, 0
+        for sample in samples:
+            sample_time, sample_duration, hypothesis = diarize(sample, job_args)
+            error, total = diarization_error(
+                read_reference_rttm(os.path.splitext(sample)[0] + ".rttm"),
+                hypothesis,
+                collar_ms=int(args.collar * 1000),
+            )
+            run_time += sample_time
+            duration += sample_duration
+            errors += error
+            speech += total
+        print(
+            f"{profile:<12} {run_time:8.1f} s  RTF {run_time / duration:.4f}"
+            f"  DER {errors / speech if speech else 0:.2%}"
+        )
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError):
+        return float("nan")
+
+
+def bench_cpu_serving(args):
+    import gc
+    from concurrent.futures import ThreadPoolExecutor
+
+    from audio_helpers import SAMPLE_RATE, decode_audio
+    from cpu_serving import load_shared_whisper_model, plan_cpu_workers
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        audio = decode_audio(args.audio, os.path.join(temp_dir, "mono.wav")).float32()
+    duration = len(audio) / SAMPLE_RATE
+
+    def run_jobs(models):
+        def job(model):
+            segments, _ = model.transcribe(audio, beam_size=5, vad_filter=True)
+            return sum(1 for _ in segments)
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(models)) as pool:
+            list(pool.map(job, models))
+        return time.perf_counter() - start_time
+
+    def load_copies(num_jobs):
+        from faster_whisper import WhisperModel
+
+        return [
+            WhisperModel(args.model, device="cpu", compute_type="int8")
+            for _ in range(num_jobs)
+        ]
+
+    def load_shared(num_jobs):
+        return [load_shared_whisper_model(args.model, "int8", num_workers=num_jobs)] * num_jobs
+
+    print(f"{args.audio}: {duration:.0f}s of audio, model {args.model}")
+    print(f"{'mode':<8} {'jobs':>4} {'threads':>7} {'wall s':>8} {'RTF':>7} {'RSS MB':>8}")
+    for num_jobs in (int(n) for n in args.jobs.split(",")):
+        for mode, load in (("copies", load_copies), ("shared", load_shared)):
+            rss_before = _rss_mb()
+            models = load(num_jobs)
+            rss = _rss_mb() - rss_before
+            run_jobs(models[:1])  # warm up
+            wall = run_jobs(models)
+            threads = plan_cpu_workers(num_jobs)[1] if mode == "shared" else "default"
+            # processing time per second of audio over all jobs
+            print(
+                f"{mode:<8} {num_jobs:>4} {threads:>7} {wall:8.1f}"
+                f" {wall / (duration * num_jobs):7.3f} {rss:8.0f}"
+            )
+            del models
+            gc.collect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="post-processing benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    mapping_parser = commands.add_parser(
+        "speaker-mapping", help="RTTM loading and word to speaker mapping"
+    )
+    mapping_parser.add_argument("--hours", type=float, default=10)
+    mapping_parser.add_argument("--words", type=int, default=100_000)
+    mapping_parser.set_defaults(func=bench_speaker_mapping)
+    realignment_parser = commands.add_parser(
+        "realignment", help="speaker realignment on sentence boundaries"
+    )
+    realignment_parser.add_argument("--words", type=int, default=100_000)
+    realignment_parser.set_defaults(func=bench_realignment)
+    sentences_parser = commands.add_parser(
+        "sentences", help="sentence segmentation of a long monologue"
+    )
+    sentences_parser.add_argument("--words", type=int, default=3_000)
+    sentences_parser.set_defaults(func=bench_sentences)
+    timestamps_parser = commands.add_parser(
+        "timestamps", help="filling in unaligned word timestamps"
+    )
+    timestamps_parser.add_argument("--words", type=int, default=100_000)
+    timestamps_parser.set_defaults(func=bench_timestamps)
+    writers_parser = commands.add_parser(
+        "writers", help="writing the txt, srt and json outputs"
+    )
+    writers_parser.add_argument("--sentences", type=int, default=200_000)
+    writers_parser.set_defaults(func=bench_writers)
+    numeral_parser = commands.add_parser(
+        "numeral-tokens", help="cached suppress_numerals token lists"
+    )
+    numeral_parser.add_argument("--vocab-size", type=int, default=51_865)
+    numeral_parser.set_defaults(func=bench_numeral_tokens)
+    startup_parser = commands.add_parser(
+        "startup", help="start up time of the small entry point scripts"
+    )
+    startup_parser.add_argument("--repeat", type=int, default=10)
+    startup_parser.set_defaults(func=bench_startup)
+    stage_graph_parser = commands.add_parser(
+        "stage-graph", help="overlapping the diarization stages of several files"
+    )
+    stage_graph_parser.add_argument("--files", type=int, default=12)
+    stage_graph_parser.add_argument("--model-slots", type=int, default=2)
+    stage_graph_parser.set_defaults(func=bench_stage_graph)
+    channels_parser = commands.add_parser(
+        "channels", help="diarizing a two-channel call by its channels"
+    )
+    channels_parser.add_argument("--minutes", type=float, default=60)
+    channels_parser.set_defaults(func=bench_channels)
+    compaction_parser = commands.add_parser(
+        "compaction", help="cutting out dead air and hold music and mapping times back"
+    )
+    compaction_parser.add_argument("--minutes", type=float, default=60)
+    compaction_parser.add_argument("--min-gap", type=float, default=5.0)
+    compaction_parser.set_defaults(func=bench_compaction)
+    profiles_parser = commands.add_parser(
+        "diarization-profiles",
+        help="runtime and DER of the NeMo diarization profiles on labelled samples",
+    )
+    profiles_parser.add_argument(
+        "--samples",
+        required=True,
+        help="folder of audio files, each with a reference <name>.rttm next to it",
+    )
+    profiles_parser.add_argument("--profiles", default="fast,balanced,accurate")
+    profiles_parser.add_argument("--collar", type=float, default=0.25)
+    profiles_parser.add_argument("--num-speakers", type=int, default=None)
+    profiles_parser.add_argument("--max-speakers", type=int, default=None)
+    profiles_parser.add_argument("--workers", type=int, default=0)
+    profiles_parser.set_defaults(func=bench_diarization_profiles)
+    serving_parser = commands.add_parser(
+        "cpu-serving",
+        help="real-time factor of concurrent CPU transcriptions, one model per job"
+        " against one shared model",
+    )
+    serving_parser.add_argument("--audio", required=True)
+    serving_parser.add_argument("--model", default="small")
+    serving_parser.add_argument("--jobs", default="1,2,4", help="concurrent jobs to measure")
+    serving_parser.set_defaults(func=bench_cpu_serving)
+    args = parser.parse_args()
+    args.func(args)
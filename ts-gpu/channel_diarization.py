@@ -0,0 +1,162 @@
+import logging
+import os
+
+import numpy as np
+from audio_helpers import decode_channel_energy, probe_channels
+
+# Diarization of two-channel call recordings without NeMo. The telephony
+# platform records the agent and the customer on their own channel, so who
+# speaks when follows from which channel carries the voice. A frame belongs
+# to the speaker of the louder active channel, which also keeps the crosstalk
+# that leaks into the other channel from becoming a turn. The turns are
+# written as an RTTM, so everything after diarization is unchanged.
+
+
+def channel_activity(energy, floor_db=-50.0, margin_db=12.0):
+    """
+    Active frames of every channel of a (2, num_frames) frame_energy_db
+    array, with the same threshold as speech_regions: louder than floor_db
+    and the noise floor (10th percentile) of the channel plus margin_db.
+    """
+    thresholds = [
+        max(floor_db, float(np.percentile(channel, 10)) + margin_db) if len(channel) else floor_db
+        for channel in energy
+    ]
+    return energy > np.array(thresholds, dtype=np.float32)[:, None]
+
+
+def channel_separation(energy, active, dominance_db=10.0):
+    """
+    How separated the two channels are: the share of active frames in which
+    one channel is at least dominance_db louder than the other, and the share
+    of the active frames each channel dominates. A down-mix copied to both
+    channels has no dominant frames, a call with one speaker per channel
+    has nearly only dominant frames.
+    """
+    any_active = active.any(axis=0)
+    num_active = int(any_active.sum())
+    if not num_active:
+        return 0.0, [0.0, 0.0]
+    difference = energy[0, any_active] - energy[1, any_active]
+    left, right = difference >= dominance_db, difference <= -dominance_db
+    return (
+        float(np.mean(left | right)),
+        [float(left.sum()) / num_active, float(right.sum()) / num_active],
+    )
+
+
+def _runs(labels):
+    """[label, start frame, end frame) runs of equal labels."""
+    edges = np.flatnonzero(np.diff(labels)) + 1
+    starts = np.concatenate(([0], edges))
+    ends = np.concatenate((edges, [len(labels)]))
+    return [[int(labels[s]), int(s), int(e)] for s, e in zip(starts, ends)]
+
+
+def _merge_equal(runs):
+    merged = []
+    for run in runs:
+        if merged and merged[-1][0] == run[0]:
+            merged[-1][2] = run[2]
+        else:
+            merged.append(run)
+    return merged
+
+
+def channel_turns(energy, active, frame_seconds=0.03, min_speech=0.2, min_silence=0.4):
+    """
+    Speaker turns of the channels as an (N, 3) int64 array of start ms, end
+    ms and speaker index, where the speaker is the channel. Bursts shorter
+    than min_speech are dropped and pauses of a speaker shorter than
+    min_silence bridged, like speech_regions does for a single channel.
+    """
+    if energy.shape[1] == 0:
+        return np.zeros((0, 3), dtype=np.int64)
+    louder = (energy[1] > energy[0]).astype(np.int8)
+    labels = np.where(
+        active[0] & active[1],
+        louder,
+        np.where(active[0], 0, np.where(active[1], 1, -1)),
+    ).astype(np.int8)
+
+    runs = _runs(labels)
+    for run in runs:
+        if run[0] >= 0 and (run[2] - run[1]) * frame_seconds < min_speech:
+            run[0] = -1
+    runs = _merge_equal(runs)
+    # a short pause between two runs of the same speaker is part of the turn
+    for i in range(1, len(runs) - 1):
+        label, start, end = runs[i]
+        if (
+            label == -1
+            and runs[i - 1][0] == runs[i + 1][0]
+            and (end - start) * frame_seconds < min_silence
+        ):
+            runs[i][0] = runs[i - 1][0]
+    runs = _merge_equal(runs)
+
+    frame_ms = frame_seconds * 1000
+    turns = [
+        [int(start * frame_ms), int(end * frame_ms), label]
+        for label, start, end in runs
+        if label >= 0
+    ]
+    return np.array(turns, dtype=np.int64).reshape(-1, 3)
+
+
+def write_rttm(path, turns, uniq_id="mono_file"):
+    """Write the turns in the RTTM layout NeMo writes and read_rttm reads."""
+    with open(path, "w") as f:
+        for start, end, speaker in turns.tolist():
+            f.write(
+                f"SPEAKER {uniq_id} 1   {start / 1000:.3f}   {(end - start) / 1000:.3f}"
+                f" <NA> <NA> speaker_{speaker} <NA> <NA>\n"
+            )
+
+
+def diarize_channels(
+    audio_file,
+    rttm_path,
+    force=False,
+    min_separation=0.7,
+    min_channel_share=0.05,
+    frame_seconds=0.03,
+):
+    """
+    Diarize a two-channel recording by its channels and write the RTTM to
+    rttm_path. The channels are used when at least min_separation of the
+    active frames are dominated by one channel and both channels dominate at
+    least min_channel_share, so a stereo file with the whole call on both or
+    on one channel still goes to NeMo. force skips that check.
+
+    Returns a dict describing the decision, or None when NeMo is needed.
+    """
+    channels = probe_channels(audio_file)
+    if channels != 2:
+        if force:
+            logging.warning(f"{audio_file} has {channels} channels, diarizing it with NeMo")
+        return None
+
+    energy = decode_channel_energy(audio_file, frame_seconds=frame_seconds)
+    active = channel_activity(energy)
+    separation, channel_shares = channel_separation(energy, active)
+    info = {
+        "separation": round(separation, 4),
+        "channel_shares": [round(share, 4) for share in channel_shares],
+    }
+    if not force and (
+        separation < min_separation or min(channel_shares) < min_channel_share
+    ):
+        logging.info(f"Channels of {audio_file} are not separated enough: {info}")
+        return None
+
+    turns = channel_turns(energy, active, frame_seconds)
+    if len(turns) == 0:
+        # nothing was said, one turn over the whole file like NeMo gives
+        turns = np.array(
+            [[0, int(energy.shape[1] * frame_seconds * 1000), 0]], dtype=np.int64
+        )
+    os.makedirs(os.path.dirname(rttm_path), exist_ok=True)
+    write_rttm(rttm_path, turns)
+    info["turns"] = len(turns)
+    return info
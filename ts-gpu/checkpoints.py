@@ -0,0 +1,180 @@
+import hashlib
+import json
+import logging
+import os
+
+from artifacts import file_sha256
+
+# Stage checkpoints of a diarization job. The output of every expensive stage
+# is kept in a content-addressed store next to the audio file, so a job that
+# failed half way, or is run again with other punctuation settings, resumes
+# from the last stage whose inputs did not change instead of transcribing the
+# audio again.
+#
+#   <audio base>.stages/objects/<sha256>   stage outputs, named by content
+#   <audio base>.stages/stages.json        stage -> input key and object
+#
+# A stage is reused when its input key, a hash of the audio, the settings and
+# the objects of the stages it depends on, is the one it was stored with.
+
+# stage -> the stages that use its output
+stage_dependents = {
+    "audio": ("transcribe", "align", "diarize", "punctuate"),
+    "transcribe": ("align", "punctuate"),
+    "align": ("punctuate",),
+    "diarize": (),
+    "punctuate": (),
+}
+rerun_stages = ("transcribe", "align", "diarize", "punctuate")
+
+
+def _package_version(name):
+    from importlib.metadata import PackageNotFoundError, version
+
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return None
+
+
+def get_stage_dir(audio_file):
+    return f"{os.path.splitext(audio_file)[0]}.stages"
+
+
+def _to_builtin(value):
+    # numpy scalars in the whisperx results
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class StageStore:
+    """A content-addressed object store with an index of the stored stages."""
+
+    def __init__(self, path):
+        self.path = path
+        self.object_dir = os.path.join(path, "objects")
+        self.index_path = os.path.join(path, "stages.json")
+        os.makedirs(self.object_dir, exist_ok=True)
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def get(self, stage, key):
+        """Return (data, object hash) of stage stored with key, or (None, None)."""
+        entry = self.index.get(stage)
+        if entry is None or entry["key"] != key:
+            return None, None
+        try:
+            with open(os.path.join(self.object_dir, entry["object"]), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None, None
+        if hashlib.sha256(data).hexdigest() != entry["object"]:
+            logging.warning(f"Checkpoint of {stage} in {self.path} is corrupt, running it again")
+            return None, None
+        return data, entry["object"]
+
+    def put(self, stage, key, data):
+        object_hash = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.object_dir, object_hash)
+        if not os.path.exists(path):
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+        self.index[stage] = {"key": key, "object": object_hash}
+        self._save_index()
+        return object_hash
+
+    def invalidate(self, stages):
+        for stage in stages:
+            self.index.pop(stage, None)
+        self._save_index()
+
+    def _save_index(self):
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+        os.replace(self.index_path + ".tmp", self.index_path)
+        # objects no stage points at any more
+        live = {entry["object"] for entry in self.index.values()}
+        for name in os.listdir(self.object_dir):
+            if name not in live and not name.endswith(".tmp"):
+                os.remove(os.path.join(self.object_dir, name))
+
+
+class JobStages:
+    """
+    The checkpoints of one audio file. load returns the stored output of a
+    stage when its inputs did not change, save stores a new one. from_stage
+    drops that stage and every stage that uses its output first.
+    """
+
+    def __init__(self, audio_file, args):
+        self.args = args
+        self.store = StageStore(get_stage_dir(audio_file))
+        self.audio_hash = file_sha256(audio_file)
+        self.hashes = {}
+        if args.from_stage:
+            self.store.invalidate((args.from_stage, *stage_dependents[args.from_stage]))
+
+    def key(self, stage):
+        args = self.args
+        inputs = {
+            "audio": self.audio_hash,
+            "stem_mode": args.stem_mode,
+            "music_threshold": args.music_threshold,
+            # compaction changes the audio every stage sees
+            "compact_min_gap": args.compact_min_gap if args.compact else None,
+        }
+        if stage == "transcribe":
+            inputs.update(
+                model_name=args.model_name,
+                language=args.language,
+                batched=args.batch_size != 0,
+                suppress_numerals=args.suppress_numerals,
+                shards=args.shards,
+            )
+        elif stage == "diarize":
+            inputs.update(
+                mode=args.diarization_mode,
+                profile=args.diarization_profile,
+                num_speakers=args.num_speakers,
+                max_speakers=args.max_speakers,
+            )
+        elif stage == "align":
+            # the alignment model is the whisperx default for the language of
+            # the transcription, so it changes with the language and whisperx
+            inputs.update(
+                transcribe=self.hashes["transcribe"],
+                language=args.language,
+                device=args.device,
+                aligner=_package_version("whisperx"),
+            )
+        elif stage == "punctuate":
+            inputs = {
+                "align": self.hashes["align"],
+                "mode": args.punctuation_mode,
+                "int8": args.punctuation_int8 and args.device == "cpu",
+            }
+        return hashlib.sha256(
+            json.dumps([stage, inputs], sort_keys=True).encode()
+        ).hexdigest()
+
+    def load_bytes(self, stage):
+        data, object_hash = self.store.get(stage, self.key(stage))
+        if data is not None:
+            self.hashes[stage] = object_hash
+            logging.info(f"Reusing the {stage} checkpoint in {self.store.path}")
+        return data
+
+    def save_bytes(self, stage, data):
+        self.hashes[stage] = self.store.put(stage, self.key(stage), data)
+
+    def load(self, stage):
+        data = self.load_bytes(stage)
+        return None if data is None else json.loads(data)
+
+    def save(self, stage, value):
+        self.save_bytes(stage, json.dumps(value, default=_to_builtin).encode())
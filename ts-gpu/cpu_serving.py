@@ -0,0 +1,109 @@
+import logging
+import os
+
+# CPU serving of one Whisper model to concurrent jobs. Instead of every job
+# loading its own copy with the default CTranslate2 threading, one
+# WhisperModel is loaded with num_workers workers of cpu_threads threads
+# each, so concurrent transcriptions run in parallel on one copy of the
+# weights without oversubscribing the cores. Every worker is pinned to the
+# CPUs of one socket, and the OpenMP threads it starts inherit that.
+
+
+def _read_topology(cpu, name):
+    try:
+        with open(f"/sys/devices/system/cpu/cpu{cpu}/topology/{name}") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 0
+
+
+def cpu_sockets():
+    """
+    The CPUs this process may run on grouped by socket, as a list of
+    (cpus, physical core count) per socket.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        allowed = sorted(os.sched_getaffinity(0))
+    else:
+        allowed = list(range(os.cpu_count() or 1))
+    sockets = {}
+    for cpu in allowed:
+        sockets.setdefault(_read_topology(cpu, "physical_package_id"), []).append(cpu)
+    return [
+        (cpus, len({_read_topology(cpu, "core_id") for cpu in cpus}))
+        for _, cpus in sorted(sockets.items())
+    ]
+
+
+def plan_cpu_workers(num_workers, cpu_threads=0, sockets=None):
+    """
+    Spread num_workers over the sockets, round robin, and give every worker
+    cpu_threads threads, by default the physical cores of a socket divided by
+    the workers on it, so no worker needs cores of two sockets.
+
+    Returns (the CPUs of every worker, cpu_threads).
+    """
+    sockets = sockets or cpu_sockets()
+    workers_per_socket = [0] * len(sockets)
+    for i in range(num_workers):
+        workers_per_socket[i % len(sockets)] += 1
+    if not cpu_threads:
+        cpu_threads = max(
+            min(
+                cores // workers
+                for (_, cores), workers in zip(sockets, workers_per_socket)
+                if workers
+            ),
+            1,
+        )
+    return [sockets[i % len(sockets)][0] for i in range(num_workers)], cpu_threads
+
+
+def _thread_ids():
+    try:
+        return {int(tid) for tid in os.listdir("/proc/self/task")}
+    except OSError:
+        return set()
+
+
+def pin_new_threads(before, worker_cpus):
+    """
+    Pin the threads started since before, one per worker, to the CPUs of
+    their worker. Nothing is pinned when the count does not match, e.g.
+    because another job started threads meanwhile.
+    """
+    new_threads = sorted(_thread_ids() - before)
+    if len(new_threads) != len(worker_cpus) or not hasattr(os, "sched_setaffinity"):
+        logging.info(
+            f"Not pinning the Whisper workers, found {len(new_threads)} new threads"
+            f" for {len(worker_cpus)} workers"
+        )
+        return False
+    for tid, cpus in zip(new_threads, worker_cpus):
+        os.sched_setaffinity(tid, cpus)
+    return True
+
+
+def load_shared_whisper_model(model_name, compute_type, num_workers=2, cpu_threads=0):
+    """
+    One faster-whisper WhisperModel on CPU that num_workers jobs can call at
+    the same time, see plan_cpu_workers for the threads.
+    """
+    from faster_whisper import WhisperModel
+
+    worker_cpus, cpu_threads = plan_cpu_workers(num_workers, cpu_threads)
+    logging.info(
+        f"Loading {model_name} for CPU serving with {num_workers} workers"
+        f" of {cpu_threads} threads"
+    )
+    # CTranslate2 starts its worker threads while loading
+    before = _thread_ids()
+    model = WhisperModel(
+        model_name,
+        device="cpu",
+        compute_type=compute_type,
+        cpu_threads=cpu_threads,
+        num_workers=num_workers,
+    )
+    pin_new_threads(before, worker_cpus)
+    return model
@@ -0,0 +1,151 @@
+import logging
+import os
+import time
+
+from job_queue import root_dir, sub_dirs
+
+# Event driven discovery of incoming/<kind>/<rowId>/ folders. A folder is only
+# enqueued once it is complete:
+#   - it was moved into place in one go (ts-web /upload stages and renames it)
+#   - data.json was closed or moved in, which /upload always writes last, and
+#     no other file of the folder is still open for writing
+#   - files were uploaded over SFTP, every file that was created or written to
+#     was closed again and nothing happened in the folder for settle seconds
+
+data_file = "data.json"
+
+
+class IncomingWatcher:
+    def __init__(self, queue, base_dir=root_dir, settle=3.0, rescan_interval=300):
+        from inotify_simple import INotify, flags
+
+        self.flags = flags
+        self.queue = queue
+        self.base_dir = base_dir
+        self.settle = settle
+        self.rescan_interval = rescan_interval
+        self.inotify = INotify()
+        self.type_dirs = {}
+        self.row_dirs = {}
+        self.pending = {}
+        # names of the files of a row folder that are open for writing
+        self.writing = {}
+
+    def _watch_type_dir(self, kind):
+        path = os.path.join(self.base_dir, kind)
+        os.makedirs(path, exist_ok=True)
+        wd = self.inotify.add_watch(
+            path, self.flags.CREATE | self.flags.MOVED_TO | self.flags.ONLYDIR
+        )
+        self.type_dirs[wd] = (kind, path)
+
+    def _watch_row_dir(self, kind, path):
+        try:
+            wd = self.inotify.add_watch(
+                path,
+                self.flags.CREATE
+                | self.flags.MODIFY
+                | self.flags.CLOSE_WRITE
+                | self.flags.MOVED_TO
+                | self.flags.MOVED_FROM
+                | self.flags.DELETE
+                | self.flags.ONLYDIR,
+            )
+        except OSError:
+            return
+        self.row_dirs[wd] = (kind, path)
+        # files written between the mkdir and the watch would be missed
+        # otherwise. Whether they are still open is not known, even with a
+        # data.json, so the folder has to settle.
+        if any(os.scandir(path)):
+            self.pending[path] = (kind, time.monotonic() + self.settle)
+
+    def _enqueue(self, kind, path):
+        self.pending.pop(path, None)
+        self.writing.pop(path, None)
+        job_id = self.queue.enqueue(kind, path)
+        if job_id is not None:
+            logging.info(f"Enqueued job {job_id} for {path}")
+
+    def _handle(self, event):
+        flags = self.flags
+        if event.mask & flags.Q_OVERFLOW:
+            self.rescan()
+            return
+
+        if event.mask & flags.IGNORED:
+            kind_path = self.row_dirs.pop(event.wd, None)
+            if kind_path is not None:
+                self.pending.pop(kind_path[1], None)
+                self.writing.pop(kind_path[1], None)
+            return
+
+        if event.wd in self.type_dirs:
+            kind, type_dir = self.type_dirs[event.wd]
+            if not event.mask & flags.ISDIR:
+                return
+            path = os.path.join(type_dir, event.name)
+            if event.mask & flags.MOVED_TO:
+                self._enqueue(kind, path)
+            else:
+                self._watch_row_dir(kind, path)
+            return
+
+        if event.wd in self.row_dirs:
+            kind, path = self.row_dirs[event.wd]
+            writing = self.writing.setdefault(path, set())
+            if event.mask & (flags.CREATE | flags.MODIFY) and not event.mask & flags.ISDIR:
+                writing.add(event.name)
+            else:
+                writing.discard(event.name)
+            if (
+                event.name == data_file
+                and event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO)
+                and not writing
+            ):
+                self._enqueue(kind, path)
+                return
+            # every event pushes the deadline, so a file that is still being
+            # transferred keeps the folder from settling
+            self.pending[path] = (kind, time.monotonic() + self.settle)
+
+    def _flush_pending(self):
+        now = time.monotonic()
+        for path, (kind, deadline) in list(self.pending.items()):
+            # a file that was opened for writing and not closed yet is only
+            # stalled, it is waited for until the next event in the folder
+            if deadline <= now and not self.writing.get(path):
+                self._enqueue(kind, path)
+
+    def _timeout(self, next_rescan):
+        deadlines = [
+            deadline
+            for path, (_, deadline) in self.pending.items()
+            if not self.writing.get(path)
+        ]
+        deadline = min(deadlines + [next_rescan])
+        return max(int((deadline - time.monotonic()) * 1000), 0)
+
+    def rescan(self):
+        """Watch row folders the watcher does not know about yet."""
+        watched = {path for _, path in self.row_dirs.values()}
+        for kind, type_dir in list(self.type_dirs.values()):
+            for entry in os.scandir(type_dir):
+                if entry.is_dir(follow_symlinks=False) and entry.path not in watched:
+                    self._watch_row_dir(kind, entry.path)
+
+    def run(self):
+        for kind in sub_dirs:
+            self._watch_type_dir(kind)
+        # folders that were already there before the watcher started
+        self.rescan()
+
+        next_rescan = time.monotonic() + self.rescan_interval
+        while True:
+            for event in self.inotify.read(timeout=self._timeout(next_rescan)):
+                self._handle(event)
+            self._flush_pending()
+            if time.monotonic() >= next_rescan:
+                # safety net for events missed while a folder was being set up
+                self.rescan()
+                next_rescan = time.monotonic() + self.rescan_interval
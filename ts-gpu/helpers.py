@@ -1,12 +1,51 @@
+import copy
+import functools
 import os
-import wget
-from omegaconf import OmegaConf
 import json
 import shutil
-import nltk
-from whisperx.alignment import DEFAULT_ALIGN_MODELS_HF, DEFAULT_ALIGN_MODELS_TORCH
+import numpy as np
+import tempfile
+from word_table import WordTable
+from json_helpers import update_json_data
 import logging
-from whisperx.utils import LANGUAGES, TO_LANGUAGE_CODE
+
+# whisperx, nltk, omegaconf and wget are imported where they are used, so the
+# small scripts that only need a helper or two start without loading torch
+
+punct_model_name = "kredor/punctuate-all"
+
+# pretrained NeMo models of the telephonic MSDD diarization config
+nemo_vad_model = "vad_multilingual_marblenet"
+nemo_speaker_model = "titanet_large"
+nemo_msdd_model = "diar_msdd_telephonic"
+
+# NeMo diarization profiles, from fast to accurate. fast runs the clustering
+# diarizer alone on three scales instead of five, without the MSDD model,
+# balanced is the telephonic config as it is and accurate searches the
+# clustering threshold more finely. None keeps the value of the config.
+diarization_profiles = {
+    "fast": {
+        "msdd": False,
+        "window_length_in_sec": [1.5, 1.0, 0.5],
+        "shift_length_in_sec": [0.75, 0.5, 0.25],
+        "multiscale_weights": [1, 1, 1],
+        "sparse_search_volume": None,
+    },
+    "balanced": {
+        "msdd": True,
+        "window_length_in_sec": None,
+        "shift_length_in_sec": None,
+        "multiscale_weights": None,
+        "sparse_search_volume": None,
+    },
+    "accurate": {
+        "msdd": True,
+        "window_length_in_sec": None,
+        "shift_length_in_sec": None,
+        "multiscale_weights": None,
+        "sparse_search_volume": 60,
+    },
+}
 
 punct_model_langs = [
     "en",
@@ -22,32 +61,88 @@ punct_model_langs = [
     "sk",
     "sl",
 ]
-wav2vec2_langs = list(DEFAULT_ALIGN_MODELS_TORCH.keys()) + list(
-    DEFAULT_ALIGN_MODELS_HF.keys()
-)
 
-whisper_langs = sorted(LANGUAGES.keys()) + sorted(
-    [k.title() for k in TO_LANGUAGE_CODE.keys()]
-)
 
+def __getattr__(name):
+    # wav2vec2_langs and whisper_langs come from the whisperx tables, which
+    # import torch, so they are built on first access
+    if name == "wav2vec2_langs":
+        from whisperx.alignment import DEFAULT_ALIGN_MODELS_HF, DEFAULT_ALIGN_MODELS_TORCH
 
-def create_config(output_dir):
-    DOMAIN_TYPE = "telephonic"  # Can be meeting, telephonic, or general based on domain type of the audio file
-    CONFIG_LOCAL_DIRECTORY = "nemo_msdd_configs"
-    CONFIG_FILE_NAME = f"diar_infer_{DOMAIN_TYPE}.yaml"
-    MODEL_CONFIG_PATH = os.path.join(CONFIG_LOCAL_DIRECTORY, CONFIG_FILE_NAME)
-    if not os.path.exists(MODEL_CONFIG_PATH):
-        os.makedirs(CONFIG_LOCAL_DIRECTORY, exist_ok=True)
-        CONFIG_URL = f"https://raw.githubusercontent.com/NVIDIA/NeMo/main/examples/speaker_tasks/diarization/conf/inference/{CONFIG_FILE_NAME}"
-        MODEL_CONFIG_PATH = wget.download(CONFIG_URL, MODEL_CONFIG_PATH)
+        value = list(DEFAULT_ALIGN_MODELS_TORCH.keys()) + list(
+            DEFAULT_ALIGN_MODELS_HF.keys()
+        )
+    elif name == "whisper_langs":
+        from whisperx.utils import LANGUAGES, TO_LANGUAGE_CODE
+
+        value = sorted(LANGUAGES.keys()) + sorted(
+            [k.title() for k in TO_LANGUAGE_CODE.keys()]
+        )
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def create_scratch_dir(prefix="job-"):
+    """
+    Create a private scratch folder for one job. Set TS_SCRATCH_DIR=/dev/shm to
+    keep the decoded audio and NeMo intermediates on tmpfs.
+    """
+    base_dir = os.environ.get("TS_SCRATCH_DIR") or os.path.join(
+        os.getcwd(), "temp_outputs"
+    )
+    os.makedirs(base_dir, exist_ok=True)
+    return tempfile.mkdtemp(prefix=prefix, dir=base_dir)
+
+
+def get_mono_path(output_dir):
+    return os.path.join(output_dir, "mono_file.wav")
+
+
+def get_rttm_path(output_dir):
+    # NeMo names the prediction after the manifest audio file
+    return os.path.join(output_dir, "pred_rttms", "mono_file.rttm")
+
+
+@functools.lru_cache(maxsize=None)
+def _load_config(path, mtime):
+    from omegaconf import OmegaConf
 
-    config = OmegaConf.load(MODEL_CONFIG_PATH)
+    return OmegaConf.load(path)
+
+
+@functools.lru_cache(maxsize=None)
+def _nemo_model_path(name):
+    from artifacts import nemo_model_path
+
+    return nemo_model_path(name)
+
+
+def create_config(
+    output_dir, profile="balanced", num_speakers=None, max_speakers=None, num_workers=0, device=None
+):
+    """
+    The NeMo diarization config of a job in output_dir with one of the
+    diarization_profiles. num_speakers is a known speaker count, max_speakers
+    an upper bound for the clustering and num_workers the data loader workers.
+    """
+    from artifacts import nemo_config_path
+
+    settings = diarization_profiles[profile]
+
+    DOMAIN_TYPE = "telephonic"  # Can be meeting, telephonic, or general based on domain type of the audio file
+    MODEL_CONFIG_PATH = nemo_config_path(DOMAIN_TYPE)
+    # the yaml is parsed once per process, every job edits its own copy
+    config = copy.deepcopy(
+        _load_config(MODEL_CONFIG_PATH, os.path.getmtime(MODEL_CONFIG_PATH))
+    )
 
     data_dir = os.path.join(output_dir, "data")
     os.makedirs(data_dir, exist_ok=True)
 
     meta = {
-        "audio_filepath": os.path.join(output_dir, "mono_file.wav"),
+        "audio_filepath": get_mono_path(output_dir),
         "offset": 0,
         "duration": None,
         "label": "infer",
@@ -55,13 +150,18 @@ def create_config(output_dir):
         "rttm_filepath": None,
         "uem_filepath": None,
     }
+    if num_speakers:
+        meta["num_speakers"] = num_speakers
     with open(os.path.join(data_dir, "input_manifest.json"), "w") as fp:
         json.dump(meta, fp)
         fp.write("\n")
 
-    pretrained_vad = "vad_multilingual_marblenet"
-    pretrained_speaker_model = "titanet_large"
-    config.num_workers = 0
+    # the cached .nemo files, so NeMo does not look the names up online
+    pretrained_vad = _nemo_model_path(nemo_vad_model)
+    pretrained_speaker_model = _nemo_model_path(nemo_speaker_model)
+    config.num_workers = num_workers
+    if device is not None:
+        config.device = device
     config.diarizer.manifest_filepath = os.path.join(data_dir, "input_manifest.json")
     config.diarizer.out_dir = (
         output_dir  # Directory to store intermediate files and prediction outputs
@@ -71,20 +171,41 @@ def create_config(output_dir):
     config.diarizer.oracle_vad = (
         False  # compute VAD provided with model_path to vad config
     )
-    config.diarizer.clustering.parameters.oracle_num_speakers = False
+    clustering = config.diarizer.clustering.parameters
+    clustering.oracle_num_speakers = bool(num_speakers)
+    if max_speakers:
+        clustering.max_num_speakers = max_speakers
+    if settings["sparse_search_volume"] is not None:
+        clustering.sparse_search_volume = settings["sparse_search_volume"]
+    scales = config.diarizer.speaker_embeddings.parameters
+    for key in ("window_length_in_sec", "shift_length_in_sec", "multiscale_weights"):
+        if settings[key] is not None:
+            scales[key] = settings[key]
 
     # Here, we use our in-house pretrained NeMo VAD model
     config.diarizer.vad.model_path = pretrained_vad
     config.diarizer.vad.parameters.onset = 0.8
     config.diarizer.vad.parameters.offset = 0.6
     config.diarizer.vad.parameters.pad_offset = -0.05
-    config.diarizer.msdd_model.model_path = (
-        "diar_msdd_telephonic"  # Telephonic speaker diarization model
-    )
+    config.diarizer.msdd_model.model_path = _nemo_model_path(
+        nemo_msdd_model
+    )  # Telephonic speaker diarization model
 
     return config
 
 
+def load_diarizer(config, device, profile="balanced"):
+    """The NeMo diarizer of a profile, MSDD on top of the clustering or the clustering alone."""
+    if diarization_profiles[profile]["msdd"]:
+        from nemo.collections.asr.models.msdd_models import NeuralDiarizer
+
+        return NeuralDiarizer(cfg=config).to(device)
+
+    from nemo.collections.asr.models import ClusteringDiarizer
+
+    return ClusteringDiarizer(cfg=config).to(device)
+
+
 def get_word_ts_anchor(s, e, option="start"):
     if option == "end":
         return e
@@ -93,170 +214,266 @@ def get_word_ts_anchor(s, e, option="start"):
     return s
 
 
-def get_words_speaker_mapping(wrd_ts, spk_ts, word_anchor_option="start"):
-    s, e, sp = spk_ts[0]
-    wrd_pos, turn_idx = 0, 0
-    wrd_spk_mapping = []
-    for wrd_dict in wrd_ts:
-        ws, we, wrd = (
-            int(wrd_dict["start"] * 1000),
-            int(wrd_dict["end"] * 1000),
-            wrd_dict["word"],
-        )
-        wrd_pos = get_word_ts_anchor(ws, we, word_anchor_option)
-        while wrd_pos > float(e):
+def read_rttm(rttm_path):
+    """
+    Speaker turns of an RTTM file as an (N, 3) int64 array of start ms,
+    end ms and speaker index.
+    """
+    with open(rttm_path, "r") as f:
+        rows = [line.split(" ") for line in f if line.strip()]
+    spk_ts = np.zeros((len(rows), 3), dtype=np.int64)
+    if rows:
+        onsets = np.array([row[5] for row in rows], dtype=np.float64)
+        durations = np.array([row[8] for row in rows], dtype=np.float64)
+        spk_ts[:, 0] = (onsets * 1000).astype(np.int64)
+        spk_ts[:, 1] = spk_ts[:, 0] + (durations * 1000).astype(np.int64)
+        spk_ts[:, 2] = [int(row[11].split("_")[-1]) for row in rows]
+    return spk_ts
+
+
+def _get_turns_by_pointer(wrd_pos, turn_ends):
+    # walk the turns like the original loop, for anchors that go back in time
+    turn_ends = turn_ends.tolist()
+    last_turn = len(turn_ends) - 1
+    turn_idx, e = 0, turn_ends[0]
+    turns = np.empty(len(wrd_pos), dtype=np.int64)
+    for i, pos in enumerate(wrd_pos.tolist()):
+        while pos > e and turn_idx < last_turn:
             turn_idx += 1
-            turn_idx = min(turn_idx, len(spk_ts) - 1)
-            s, e, sp = spk_ts[turn_idx]
-            if turn_idx == len(spk_ts) - 1:
-                e = get_word_ts_anchor(ws, we, option="end")
-        wrd_spk_mapping.append(
-            {"word": wrd, "start_time": ws, "end_time": we, "speaker": sp}
-        )
-    return wrd_spk_mapping
-
+            e = turn_ends[turn_idx]
+        turns[i] = turn_idx
+    return turns
 
-sentence_ending_punctuations = ".?!"
 
+def get_words_speaker_mapping(wrd_ts, spk_ts, word_anchor_option="start"):
+    """
+    Give every word the speaker of the first turn, at or after the turn of the
+    previous word, that ends at or after the word anchor. Words past the last
+    turn belong to the last speaker. spk_ts is an (N, 3) array or list of
+    [start ms, end ms, speaker].
 
-def get_first_word_idx_of_sentence(word_idx, word_list, speaker_list, max_words):
-    is_word_sentence_end = (
-        lambda x: x >= 0 and word_list[x][-1] in sentence_ending_punctuations
+    Returns a WordTable with speakers for a WordTable, and the word speaker
+    mapping dicts for a list of whisperx word dicts.
+    """
+    words = (
+        wrd_ts
+        if isinstance(wrd_ts, WordTable)
+        else WordTable.from_word_timestamps(wrd_ts)
+    )
+    spk_ts = np.asarray(spk_ts, dtype=np.int64).reshape(-1, 3)
+    wrd_pos = get_word_ts_anchor(
+        words.start.astype(np.int64), words.end.astype(np.int64), word_anchor_option
     )
-    left_idx = word_idx
-    while (
-        left_idx > 0
-        and word_idx - left_idx < max_words
-        and speaker_list[left_idx - 1] == speaker_list[left_idx]
-        and not is_word_sentence_end(left_idx - 1)
-    ):
-        left_idx -= 1
 
-    return left_idx if left_idx == 0 or is_word_sentence_end(left_idx - 1) else -1
+    if len(words) > 1 and np.any(np.diff(wrd_pos) < 0):
+        turns = _get_turns_by_pointer(wrd_pos, spk_ts[:, 1])
+    else:
+        # with non-decreasing anchors the turn pointer lands on the first turn
+        # whose running maximum end reaches the anchor
+        turns = np.searchsorted(np.maximum.accumulate(spk_ts[:, 1]), wrd_pos, side="left")
+        np.minimum(turns, len(spk_ts) - 1, out=turns)
 
+    words = words.replace(speaker=spk_ts[turns, 2].astype(np.int16))
+    return words if isinstance(wrd_ts, WordTable) else words.to_dicts()
 
-def get_last_word_idx_of_sentence(word_idx, word_list, max_words):
-    is_word_sentence_end = (
-        lambda x: x >= 0 and word_list[x][-1] in sentence_ending_punctuations
-    )
-    right_idx = word_idx
-    while (
-        right_idx < len(word_list)
-        and right_idx - word_idx < max_words
-        and not is_word_sentence_end(right_idx)
-    ):
-        right_idx += 1
 
-    return (
-        right_idx
-        if right_idx == len(word_list) - 1 or is_word_sentence_end(right_idx)
-        else -1
-    )
+sentence_ending_punctuations = ".?!"
 
 
 def get_realigned_ws_mapping_with_punctuation(
     word_speaker_mapping, max_words_in_sentence=50
 ):
-    is_word_sentence_end = (
-        lambda x: x >= 0
-        and word_speaker_mapping[x]["word"][-1] in sentence_ending_punctuations
+    """
+    Give a sentence that has a speaker change inside it the speaker of most of
+    its words, so speaker turns follow sentence boundaries.
+
+    Only sentences of at most max_words_in_sentence words are realigned, and
+    only when the majority speaker has at least half of the words. The last, unterminated,
+    sentence is realigned when it is exactly max_words_in_sentence words long,
+    a shorter one keeps its speakers. Every sentence is decided on its own in a single pass with running speaker
+    counts. Takes and returns a WordTable or a list of word speaker dicts.
+    """
+    if isinstance(word_speaker_mapping, WordTable):
+        speaker_list = _realigned_speakers(
+            word_speaker_mapping.words,
+            word_speaker_mapping.speaker.tolist(),
+            max_words_in_sentence,
+        )
+        return word_speaker_mapping.replace(
+            speaker=np.array(speaker_list, dtype=np.int16)
+        )
+
+    # word dicts are realigned as they are, a round trip through a WordTable
+    # costs more than the realignment itself
+    speaker_list = _realigned_speakers(
+        [line_dict["word"] for line_dict in word_speaker_mapping],
+        [line_dict["speaker"] for line_dict in word_speaker_mapping],
+        max_words_in_sentence,
     )
-    wsp_len = len(word_speaker_mapping)
+    return [
+        {**line_dict, "speaker": speaker}
+        for line_dict, speaker in zip(word_speaker_mapping, speaker_list)
+    ]
 
-    words_list, speaker_list = [], []
-    for k, line_dict in enumerate(word_speaker_mapping):
-        word, speaker = line_dict["word"], line_dict["speaker"]
-        words_list.append(word)
-        speaker_list.append(speaker)
 
-    k = 0
-    while k < len(word_speaker_mapping):
-        line_dict = word_speaker_mapping[k]
+def _realigned_speakers(words_list, speaker_list, max_words_in_sentence):
+    """Realign speaker_list in place, see get_realigned_ws_mapping_with_punctuation."""
+    wsp_len = len(words_list)
+    sentence_start, first_change, spk_counts = 0, -1, {}
+    for k, word in enumerate(words_list):
+        speaker = speaker_list[k]
+        spk_counts[speaker] = spk_counts.get(speaker, 0) + 1
+        is_sentence_end = bool(word) and word[-1] in sentence_ending_punctuations
         if (
-            k < wsp_len - 1
-            and speaker_list[k] != speaker_list[k + 1]
-            and not is_word_sentence_end(k)
+            first_change == -1
+            and not is_sentence_end
+            and k < wsp_len - 1
+            and speaker != speaker_list[k + 1]
         ):
-            left_idx = get_first_word_idx_of_sentence(
-                k, words_list, speaker_list, max_words_in_sentence
-            )
-            right_idx = (
-                get_last_word_idx_of_sentence(
-                    k, words_list, max_words_in_sentence - k + left_idx - 1
-                )
-                if left_idx > -1
-                else -1
-            )
-            if min(left_idx, right_idx) == -1:
-                k += 1
-                continue
-
-            spk_labels = speaker_list[left_idx : right_idx + 1]
-            mod_speaker = max(set(spk_labels), key=spk_labels.count)
-            if spk_labels.count(mod_speaker) < len(spk_labels) // 2:
-                k += 1
-                continue
-
-            speaker_list[left_idx : right_idx + 1] = [mod_speaker] * (
-                right_idx - left_idx + 1
-            )
-            k = right_idx
+            first_change = k
+        if not is_sentence_end and k < wsp_len - 1:
+            continue
+
+        # k closes the sentence [sentence_start, k]
+        sentence_len = k - sentence_start + 1
+        if first_change > -1 and (
+            sentence_len <= max_words_in_sentence
+            if is_sentence_end
+            else sentence_len == max_words_in_sentence
+        ):
+            # ties go to the speaker set(spk_labels) iterates first, which only
+            # depends on the order the speakers first appear in
+            mod_speaker = max(set(spk_counts.keys()), key=spk_counts.__getitem__)
+            if spk_counts[mod_speaker] >= sentence_len // 2:
+                speaker_list[sentence_start : k + 1] = [mod_speaker] * sentence_len
+        sentence_start, first_change, spk_counts = k + 1, -1, {}
+
+    return speaker_list
+
+
+def is_well_punctuated(words, max_words_in_sentence=50, max_long_share=0.1, min_words=50):
+    """
+    Whether the words already end their sentences often enough for the
+    realignment, which leaves sentences longer than max_words_in_sentence
+    alone. True when at most max_long_share of the words are in such long
+    sentences. Transcripts shorter than min_words are never trusted.
+    """
+    if len(words) < min_words:
+        return False
+    long_words, sentence_len = 0, 0
+    for word in words:
+        sentence_len += 1
+        if word and word[-1] in sentence_ending_punctuations:
+            if sentence_len > max_words_in_sentence:
+                long_words += sentence_len
+            sentence_len = 0
+    if sentence_len > max_words_in_sentence:
+        long_words += sentence_len
+    return long_words <= max_long_share * len(words)
 
-        k += 1
 
-    k, realigned_list = 0, []
-    while k < len(word_speaker_mapping):
-        line_dict = word_speaker_mapping[k].copy()
-        line_dict["speaker"] = speaker_list[k]
-        realigned_list.append(line_dict)
-        k += 1
+def get_sentences_speaker_mapping(word_speaker_mapping, spk_ts, speaker_names=None):
+    return list(iter_sentences_speaker_mapping(word_speaker_mapping, spk_ts, speaker_names))
 
-    return realigned_list
 
+def iter_sentences_speaker_mapping(word_speaker_mapping, spk_ts, speaker_names=None):
+    """
+    Yield the sentences of the words one at a time. Groups words into sentences, starting a new one on every speaker change or
+    when Punkt finds a sentence break in the sentence so far plus the word.
+
+    Punkt only decides a break from a token and the one after it, and no token
+    spans the double space in front of the new word, so a sentence that had no
+    break before can only get one between the previous word and the new one.
+    Only those two words are checked, unless two words of the sentence touch
+    as in ". .", where Punkt tokens can span words and the whole sentence
+    is checked as before. Takes a WordTable or a list of word speaker dicts.
+    speaker_names maps speaker indexes to the names used instead of "Speaker n".
+    """
+    import nltk
 
-def get_sentences_speaker_mapping(word_speaker_mapping, spk_ts):
+    if not isinstance(word_speaker_mapping, WordTable):
+        word_speaker_mapping = WordTable.from_dicts(word_speaker_mapping)
     sentence_checker = nltk.tokenize.PunktSentenceTokenizer().text_contains_sentbreak
-    s, e, spk = spk_ts[0]
+    speaker_names = speaker_names or {}
+    speaker_label = lambda spk: speaker_names.get(spk) or f"Speaker {spk}"
+    s, e, spk = (int(x) for x in spk_ts[0])
     prev_spk = spk
 
-    snts = []
-    snt = {"speaker": f"Speaker {spk}", "start_time": s, "end_time": e, "text": ""}
+    snt = {"speaker": speaker_label(spk), "start_time": s, "end_time": e, "text": ""}
+    # words of the current sentence, its last word with text and whether
+    # Punkt tokens may span two of its words
+    words, prev_wrd, spanning_tokens = [], None, False
 
-    for wrd_dict in word_speaker_mapping:
-        wrd, spk = wrd_dict["word"], wrd_dict["speaker"]
-        s, e = wrd_dict["start_time"], wrd_dict["end_time"]
-        if spk != prev_spk or sentence_checker(snt["text"] + " " + wrd):
-            snts.append(snt)
+    for wrd, spk, s, e in zip(
+        word_speaker_mapping.words,
+        word_speaker_mapping.speaker.tolist(),
+        word_speaker_mapping.start.tolist(),
+        word_speaker_mapping.end.tolist(),
+    ):
+        if spk != prev_spk:
+            is_new_sentence = True
+        elif spanning_tokens:
+            is_new_sentence = sentence_checker(_join_sentence(words) + " " + wrd)
+        else:
+            is_new_sentence = sentence_checker(
+                wrd if prev_wrd is None else prev_wrd + "  " + wrd
+            )
+        if is_new_sentence:
+            snt["text"] = _join_sentence(words)
+            yield snt
             snt = {
-                "speaker": f"Speaker {spk}",
+                "speaker": speaker_label(spk),
                 "start_time": s,
                 "end_time": e,
                 "text": "",
             }
+            words, prev_wrd, spanning_tokens = [], None, False
         else:
             snt["end_time"] = e
-        snt["text"] += wrd + " "
+        if words and words[-1].endswith(".") and wrd.startswith("."):
+            spanning_tokens = True
+        words.append(wrd)
+        if wrd.strip():
+            prev_wrd = wrd
         prev_spk = spk
 
-    snts.append(snt)
-    return snts
+    snt["text"] = _join_sentence(words)
+    yield snt
 
 
-def get_speaker_aware_transcript(sentences_speaker_mapping, f):
-    previous_speaker = sentences_speaker_mapping[0]["speaker"]
-    f.write(f"{previous_speaker}: ")
+def _join_sentence(words):
+    # every word is followed by a space, like the transcript always had
+    return " ".join(words) + " " if words else ""
 
-    for sentence_dict in sentences_speaker_mapping:
-        speaker = sentence_dict["speaker"]
-        sentence = sentence_dict["text"]
 
+class TranscriptWriter:
+    """Writes the speaker aware .txt transcript one sentence at a time."""
+
+    def __init__(self, f):
+        self.f = f
+        self.previous_speaker = None
+
+    def write(self, sentence_dict):
+        speaker = sentence_dict["speaker"]
+        if self.previous_speaker is None:
+            self.f.write(f"{speaker}: ")
         # If this speaker doesn't match the previous one, start a new paragraph
-        if speaker != previous_speaker:
-            f.write(f"\n\n{speaker}: ")
-            previous_speaker = speaker
+        elif speaker != self.previous_speaker:
+            self.f.write(f"\n\n{speaker}: ")
+        self.previous_speaker = speaker
 
         # No matter what, write the current sentence
-        f.write(sentence + " ")
+        self.f.write(sentence_dict["text"] + " ")
+
+    def close(self):
+        pass
+
+
+def get_speaker_aware_transcript(sentences_speaker_mapping, f):
+    writer = TranscriptWriter(f)
+    for sentence_dict in sentences_speaker_mapping:
+        writer.write(sentence_dict)
+    writer.close()
 
 
 def format_timestamp(
@@ -279,82 +496,181 @@ def format_timestamp(
     )
 
 
+class SrtWriter:
+    """Writes SRT cues one sentence at a time, leaving flushing to the file buffer."""
+
+    def __init__(self, file):
+        self.file = file
+        self.index = 0
+
+    def write(self, segment):
+        self.index += 1
+        self.file.write(
+            f"{self.index}\n"
+            f"{format_timestamp(segment['start_time'], always_include_hours=True, decimal_marker=',')} --> "
+            f"{format_timestamp(segment['end_time'], always_include_hours=True, decimal_marker=',')}\n"
+            f"{segment['speaker']}: {segment['text'].strip().replace('-->', '->')}\n\n"
+        )
+
+    def close(self):
+        pass
+
+
 def write_srt(transcript, file):
     """
     Write a transcript to a file in SRT format.
 
     """
-    for i, segment in enumerate(transcript, start=1):
-        # write srt lines
-        print(
-            f"{i}\n"
-            f"{format_timestamp(segment['start_time'], always_include_hours=True, decimal_marker=',')} --> "
-            f"{format_timestamp(segment['end_time'], always_include_hours=True, decimal_marker=',')}\n"
-            f"{segment['speaker']}: {segment['text'].strip().replace('-->', '->')}\n",
-            file=file,
-            flush=True,
+    writer = SrtWriter(file)
+    for segment in transcript:
+        writer.write(segment)
+    writer.close()
+
+
+class JsonSegmentsWriter:
+    """
+    Writes {"segments": [...], **metadata} one segment at a time. The output is
+    byte for byte what json.dumps gives for the whole dict, without building
+    the whole string.
+    """
+
+    def __init__(self, file, metadata=None):
+        self.file = file
+        self.metadata = metadata or {}
+        self.count = 0
+        file.write('{"segments": [')
+
+    def write(self, segment):
+        if self.count:
+            self.file.write(", ")
+        self.file.write(json.dumps(segment))
+        self.count += 1
+
+    def close(self):
+        self.file.write("]")
+        for key, value in self.metadata.items():
+            if key != "segments":
+                self.file.write(f", {json.dumps(key)}: {json.dumps(value)}")
+        self.file.write("}")
+
+
+def write_sentences(sentences, writers):
+    """Hand every sentence to all writers in one pass, then close them."""
+    for sentence in sentences:
+        for writer in writers:
+            writer.write(sentence)
+    for writer in writers:
+        writer.close()
+
+
+def write_outputs(ssm, audio_file, metadata=None, buffer_size=1 << 20):
+    """
+    Write the .txt, .srt and .json of the sentences in a single pass. ssm can
+    be a generator, each sentence goes to all three writers and is dropped, so
+    the memory does not grow with the length of the recording.
+    """
+    base = os.path.splitext(audio_file)[0]
+    open_output = lambda ext: open(
+        f"{base}.{ext}", "w", encoding="utf-8-sig", buffering=buffer_size
+    )
+    with open_output("txt") as f, open_output("srt") as srt, open_output("json") as json_file:
+        write_sentences(
+            ssm,
+            [TranscriptWriter(f), SrtWriter(srt), JsonSegmentsWriter(json_file, metadata)],
         )
 
 
-def find_numeral_symbol_tokens(tokenizer):
-    numeral_symbol_tokens = [
-        -1,
-    ]
-    for token, token_id in tokenizer.get_vocab().items():
-        has_numeral_symbol = any(c in "0123456789%$£" for c in token)
-        if has_numeral_symbol:
-            numeral_symbol_tokens.append(token_id)
-    return numeral_symbol_tokens
-
-
-def _get_next_start_timestamp(word_timestamps, current_word_index, final_timestamp):
-    # if current word is the last word
-    if current_word_index == len(word_timestamps) - 1:
-        return word_timestamps[current_word_index]["start"]
-
-    next_word_index = current_word_index + 1
-    while current_word_index < len(word_timestamps) - 1:
-        if word_timestamps[next_word_index].get("start") is None:
-            # if next word doesn't have a start timestamp
-            # merge it with the current word and delete it
-            word_timestamps[current_word_index]["word"] += (
-                " " + word_timestamps[next_word_index]["word"]
-            )
+def find_numeral_symbol_tokens(tokenizer, model_name=None):
+    """The vocabulary ids with a digit or currency symbol, cached on disk per tokenizer."""
+    from token_cache import cached_token_ids
 
-            word_timestamps[next_word_index]["word"] = None
-            next_word_index += 1
-            if next_word_index == len(word_timestamps):
-                return final_timestamp
+    def compute():
+        numeral_symbol_tokens = [
+            -1,
+        ]
+        for token, token_id in tokenizer.get_vocab().items():
+            has_numeral_symbol = any(c in "0123456789%$£" for c in token)
+            if has_numeral_symbol:
+                numeral_symbol_tokens.append(token_id)
+        return numeral_symbol_tokens
 
-        else:
-            return word_timestamps[next_word_index]["start"]
+    return cached_token_ids("numerals", model_name, tokenizer, compute)
+
+
+def find_whisperx_numeral_symbol_tokens(whisper_model, model_name=None):
+    """
+    whisperx.asr.find_numeral_symbol_tokens for a whisperx model, which decodes
+    every token up to eot, cached on disk per tokenizer.
+    """
+    from token_cache import cached_token_ids
+
+    def compute():
+        import faster_whisper
+        from whisperx.asr import find_numeral_symbol_tokens
+
+        tokenizer = whisper_model.tokenizer
+        if tokenizer is None:
+            # no language yet, decoding a token does not depend on it
+            multilingual = whisper_model.model.model.is_multilingual
+            tokenizer = faster_whisper.tokenizer.Tokenizer(
+                whisper_model.model.hf_tokenizer,
+                multilingual,
+                task="transcribe" if multilingual else None,
+                language="en" if multilingual else None,
+            )
+        return find_numeral_symbol_tokens(tokenizer)
+
+    return cached_token_ids(
+        "whisperx-numerals", model_name, whisper_model.model.hf_tokenizer, compute
+    )
 
 
 def filter_missing_timestamps(
     word_timestamps, initial_timestamp=0, final_timestamp=None
 ):
-    # handle the first and last word
-    if word_timestamps[0].get("start") is None:
-        word_timestamps[0]["start"] = (
-            initial_timestamp if initial_timestamp is not None else 0
-        )
-        word_timestamps[0]["end"] = _get_next_start_timestamp(
-            word_timestamps, 0, final_timestamp
-        )
+    """
+    Fill in words the alignment model could not place. A run of words without
+    a start is merged into its first word, which starts at the end of the word
+    before (initial_timestamp for the first word) and ends at the start of the
+    next aligned word (final_timestamp when the run reaches the end).
 
-    result = [
-        word_timestamps[0],
-    ]
+    Returns a new list in a single pass, word_timestamps is left untouched.
+    """
+    num_words = len(word_timestamps)
+    result = []
+    i = 0
+    while i < num_words:
+        ws = word_timestamps[i]
+        if ws.get("start") is not None:
+            result.append(ws)
+            i += 1
+            continue
 
-    for i, ws in enumerate(word_timestamps[1:], start=1):
-        # if ws doesn't have a start and end
-        # use the previous end as start and next start as end
-        if ws.get("start") is None and ws.get("word") is not None:
-            ws["start"] = word_timestamps[i - 1]["end"]
-            ws["end"] = _get_next_start_timestamp(word_timestamps, i, final_timestamp)
+        next_idx = i + 1
+        while next_idx < num_words and word_timestamps[next_idx].get("start") is None:
+            next_idx += 1
 
-        if ws["word"] is not None:
-            result.append(ws)
+        if i == 0:
+            start = initial_timestamp if initial_timestamp is not None else 0
+        else:
+            start = result[-1]["end"]
+        if next_idx < num_words:
+            end = word_timestamps[next_idx]["start"]
+        elif i == num_words - 1:
+            # a single unaligned last word
+            end = start
+        else:
+            end = final_timestamp
+
+        result.append(
+            dict(
+                ws,
+                word=" ".join(w["word"] for w in word_timestamps[i:next_idx]),
+                start=start,
+                end=end,
+            )
+        )
+        i = next_idx
     return result
 
 
@@ -375,6 +691,8 @@ def process_language_arg(language: str, model_name: str):
     """
     Process the language argument to make sure it's valid and convert language names to language codes.
     """
+    from whisperx.utils import LANGUAGES, TO_LANGUAGE_CODE
+
     if language is not None:
         language = language.lower()
     if language not in LANGUAGES:
@@ -390,19 +708,3 @@ def process_language_arg(language: str, model_name: str):
             )
         language = "en"
     return language
-
-def update_json_data(file_path, values, encoding="utf-8"):
-    try:
-        with open(file_path, 'r', encoding=encoding) as f:
-            data = json.load(f)
-
-        for key, value in values.items():
-            data[key] = value
-
-        with open(file_path, 'w') as f:
-            json.dump(data, f)
-
-    except FileNotFoundError:
-        print(f"File '{file_path}' not found.")
-    except json.JSONDecodeError:
-        print(f"Error decoding JSON in '{file_path}'.")
@@ -0,0 +1,318 @@
+import argparse
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Durable job table shared by the worker, transcribe.sh and the folder scanner.
+# A job is one incoming/<kind>/<rowId>/ folder. Claims happen inside a
+# BEGIN IMMEDIATE transaction so two workers can never run the same rowId.
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+default_db_path = os.environ.get(
+    "TS_QUEUE_DB", "/transcriptionstream/incoming/data/jobs.sqlite3"
+)
+root_dir = "/transcriptionstream/incoming/"
+sub_dirs = ("diarize", "transcribe")
+
+schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    inode INTEGER,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    worker TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    available_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, available_at, id);
+CREATE INDEX IF NOT EXISTS jobs_path ON jobs (path, state);
+"""
+
+
+def process_token(pid):
+    """
+    The start time of process pid in clock ticks since boot, which tells a
+    process apart from an earlier one that had the same pid, e.g. the worker
+    before a container restart. "0" when it cannot be read.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # the command name in brackets can contain spaces
+            return f.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return "0"
+
+
+def worker_id(pid=None, thread=None):
+    """host:pid:start token:thread of the calling thread, or of a given process."""
+    pid = os.getpid() if pid is None else pid
+    thread = threading.get_ident() if thread is None else thread
+    return f"{socket.gethostname()}:{pid}:{process_token(pid)}:{thread}"
+
+
+def _worker_alive(worker):
+    try:
+        host, pid, *token, _ = worker.split(":")
+        pid = int(pid)
+    except (AttributeError, ValueError):
+        return False
+    if host != socket.gethostname():
+        return True
+    if not token:
+        # written before workers had a start token, so by a process that is
+        # gone if it had the pid of this one
+        if pid == os.getpid():
+            return False
+    elif token[0] != "0":
+        # the pid is alive and still the same process
+        return process_token(pid) == token[0]
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _folder_mtime(path):
+    """The latest modification time of a folder and of the entries in it."""
+    mtime = os.stat(path).st_mtime
+    for entry in os.scandir(path):
+        try:
+            mtime = max(mtime, entry.stat(follow_symlinks=False).st_mtime)
+        except FileNotFoundError:
+            pass
+    return mtime
+
+
+class JobQueue:
+    def __init__(self, db_path=default_db_path, retry_delay=30):
+        self.db_path = db_path
+        self.retry_delay = retry_delay
+        # wakes up workers in this process as soon as a job is enqueued here
+        self._enqueued = threading.Event()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(schema)
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def enqueue(self, kind, path, max_attempts=3):
+        """
+        Queue a folder unless it already has a queued or running job. A folder
+        whose job failed for good is only queued again once it changed after
+        the failure, e.g. files were uploaded again, otherwise it waits for
+        retry.
+        """
+        path = os.path.normpath(path)
+        try:
+            inode = os.stat(path).st_ino
+            mtime = _folder_mtime(path)
+        except FileNotFoundError:
+            return None
+
+        now = time.time()
+        with self._transaction() as db:
+            existing = db.execute(
+                "SELECT state, finished_at FROM jobs WHERE path = ? AND inode = ? AND state != ?",
+                (path, inode, DONE),
+            ).fetchall()
+            if any(
+                job["state"] != FAILED or mtime <= (job["finished_at"] or 0)
+                for job in existing
+            ):
+                return None
+            job_id = db.execute(
+                "INSERT INTO jobs (kind, path, inode, max_attempts, created_at, available_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, path, inode, max_attempts, now, now),
+            ).lastrowid
+        self._enqueued.set()
+        return job_id
+
+    def claim(self, worker=None):
+        """Atomically move the oldest runnable job to running and return it."""
+        worker = worker or worker_id()
+        now = time.time()
+        with self._transaction() as db:
+            job = db.execute(
+                "SELECT * FROM jobs WHERE state = ? AND available_at <= ?"
+                " ORDER BY available_at, id LIMIT 1",
+                (QUEUED, now),
+            ).fetchone()
+            if job is None:
+                return None
+            db.execute(
+                "UPDATE jobs SET state = ?, attempts = attempts + 1, worker = ?,"
+                " started_at = ? WHERE id = ?",
+                (RUNNING, worker, now, job["id"]),
+            )
+        return dict(job, state=RUNNING, attempts=job["attempts"] + 1, worker=worker)
+
+    def wait_for_job(self, timeout):
+        self._enqueued.wait(timeout)
+        self._enqueued.clear()
+
+    def complete(self, job_id):
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE jobs SET state = ?, finished_at = ?, error = NULL WHERE id = ?",
+                (DONE, time.time(), job_id),
+            )
+
+    def fail(self, job_id, error=""):
+        """Requeue the job with a backoff, or mark it failed once out of attempts."""
+        now = time.time()
+        with self._transaction() as db:
+            job = db.execute(
+                "SELECT attempts, max_attempts FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if job is None:
+                return None
+            if job["attempts"] < job["max_attempts"]:
+                state = QUEUED
+                available_at = now + self.retry_delay * job["attempts"]
+            else:
+                state = FAILED
+                available_at = now
+            db.execute(
+                "UPDATE jobs SET state = ?, error = ?, available_at = ?, finished_at = ?"
+                " WHERE id = ?",
+                (state, str(error)[-2000:], available_at, now, job_id),
+            )
+        return state
+
+    def retry(self, job_id):
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE jobs SET state = ?, attempts = 0, available_at = ? WHERE id = ?",
+                (QUEUED, time.time(), job_id),
+            )
+        self._enqueued.set()
+
+    def requeue_orphans(self):
+        """Put running jobs back in the queue when their worker process is gone."""
+        requeued = []
+        with self._transaction() as db:
+            for job in db.execute(
+                "SELECT id, worker FROM jobs WHERE state = ?", (RUNNING,)
+            ).fetchall():
+                if not _worker_alive(job["worker"]):
+                    db.execute(
+                        "UPDATE jobs SET state = ?, available_at = ? WHERE id = ?",
+                        (QUEUED, time.time(), job["id"]),
+                    )
+                    requeued.append(job["id"])
+        return requeued
+
+    def depth(self):
+        """Number of jobs per state, plus the age of the oldest queued job."""
+        with self._connect() as db:
+            counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+            for row in db.execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state"):
+                counts[row["state"]] = row["n"]
+            oldest = db.execute(
+                "SELECT MIN(created_at) AS t FROM jobs WHERE state = ?", (QUEUED,)
+            ).fetchone()["t"]
+        counts["oldest_queued_age"] = round(time.time() - oldest, 1) if oldest else 0
+        return counts
+
+    def jobs(self, states=(QUEUED, RUNNING, FAILED)):
+        with self._connect() as db:
+            return [
+                dict(row)
+                for row in db.execute(
+                    f"SELECT * FROM jobs WHERE state IN ({','.join('?' * len(states))})"
+                    " ORDER BY id",
+                    states,
+                )
+            ]
+
+
+def scan_incoming(queue, base_dir=root_dir):
+    """Enqueue every incoming/<kind>/<rowId>/ folder that has no active job yet."""
+    enqueued = []
+    for kind in sub_dirs:
+        type_dir = os.path.join(base_dir, kind)
+        if not os.path.isdir(type_dir):
+            continue
+        for entry in sorted(os.scandir(type_dir), key=lambda e: e.name):
+            if entry.is_dir(follow_symlinks=False):
+                job_id = queue.enqueue(kind, entry.path)
+                if job_id is not None:
+                    enqueued.append(job_id)
+    return enqueued
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="transcription stream job queue")
+    parser.add_argument("--db", default=default_db_path, help="sqlite database path")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="show the queue depth and active jobs")
+    commands.add_parser("scan", help="enqueue incoming folders")
+    commands.add_parser("claim", help="claim a job, prints: id kind path")
+    done_parser = commands.add_parser("done", help="mark a job as done")
+    done_parser.add_argument("job_id", type=int)
+    fail_parser = commands.add_parser("fail", help="mark a job as failed")
+    fail_parser.add_argument("job_id", type=int)
+    fail_parser.add_argument("error", nargs="?", default="")
+    retry_parser = commands.add_parser("retry", help="requeue a failed job")
+    retry_parser.add_argument("job_id", type=int)
+    args = parser.parse_args()
+
+    queue = JobQueue(args.db)
+    if args.command == "status":
+        depth = queue.depth()
+        print(" ".join(f"{k}={v}" for k, v in depth.items()))
+        for job in queue.jobs():
+            print(
+                f"{job['id']:>6} {job['state']:<8} {job['kind']:<10} attempts={job['attempts']}"
+                f" {job['path']} {job['error'] or ''}".rstrip()
+            )
+    elif args.command == "scan":
+        queue.requeue_orphans()
+        for job_id in scan_incoming(queue):
+            print(job_id)
+    elif args.command == "claim":
+        job = queue.claim(worker_id(os.getppid(), 0))
+        if job is not None:
+            print(job["id"], job["kind"], job["path"])
+    elif args.command == "done":
+        queue.complete(args.job_id)
+    elif args.command == "fail":
+        print(queue.fail(args.job_id, args.error))
+    elif args.command == "retry":
+        queue.retry(args.job_id)
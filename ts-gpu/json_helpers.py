@@ -0,0 +1,28 @@
+import json
+
+# Kept free of heavy imports, update-data.py runs this after every file.
+
+
+def update_json_data(file_path, values, encoding="utf-8", defaults=None):
+    """
+    defaults maps keys to zero-argument callables that are only called when the
+    file does not have that key yet.
+    """
+    try:
+        with open(file_path, 'r', encoding=encoding) as f:
+            data = json.load(f)
+
+        for key, value in values.items():
+            data[key] = value
+
+        for key, get_value in (defaults or {}).items():
+            if key not in data:
+                data[key] = get_value()
+
+        with open(file_path, 'w') as f:
+            json.dump(data, f)
+
+    except FileNotFoundError:
+        print(f"File '{file_path}' not found.")
+    except json.JSONDecodeError:
+        print(f"Error decoding JSON in '{file_path}'.")
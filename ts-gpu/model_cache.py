@@ -0,0 +1,68 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+
+class ModelCache:
+    """
+    Keeps loaded models resident between jobs with least-recently-used eviction.
+
+    Keys are tuples such as ("align", language, device) or
+    ("whisperx", model_name, compute_type, device), so every language and model
+    name gets its own slot. A capacity of 0 disables caching, which gives the
+    same load-use-drop behaviour as a cold single-file run.
+    """
+
+    def __init__(self, capacity=4):
+        self.capacity = capacity
+        self._models = OrderedDict()
+        self._load_times = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def get(self, key, loader):
+        """
+        Return (model, seconds_saved). seconds_saved is the time the first cold
+        load of this key took when the model is served from the cache, else 0.
+        """
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    return self._models[key], self._load_times[key]
+
+            start_time = time.time()
+            model = loader()
+            load_time = time.time() - start_time
+            logging.info(f"Loaded {key} in {load_time:.2f}s")
+
+            with self._lock:
+                self._load_times.setdefault(key, load_time)
+                if self.capacity > 0:
+                    self._models[key] = model
+                    self._evict()
+            return model, 0.0
+
+    def _evict(self):
+        evicted = False
+        while len(self._models) > self.capacity:
+            key, _ = self._models.popitem(last=False)
+            logging.info(f"Evicting {key} from the model cache")
+            evicted = True
+        if evicted:
+            torch.cuda.empty_cache()
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+        torch.cuda.empty_cache()
+
+    def keys(self):
+        with self._lock:
+            return list(self._models.keys())
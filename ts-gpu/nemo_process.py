@@ -2,8 +2,7 @@ import argparse
 import os
 from helpers import *
 import torch
-from pydub import AudioSegment
-from nemo.collections.asr.models.msdd_models import NeuralDiarizer
+from audio_helpers import decode_audio
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -15,15 +14,36 @@ parser.add_argument(
     default="cuda" if torch.cuda.is_available() else "cpu",
     help="if you have a GPU use 'cuda', otherwise 'cpu'",
 )
+parser.add_argument(
+    "--temp-path",
+    dest="temp_path",
+    default=os.path.join(os.getcwd(), "temp_outputs"),
+    help="scratch folder of the job, the manifest and RTTM are written here",
+)
+parser.add_argument(
+    "--profile",
+    default="balanced",
+    choices=["fast", "balanced", "accurate"],
+    help="diarization profile, see diarization_profiles in helpers.py",
+)
+parser.add_argument("--num-speakers", dest="num_speakers", type=int, default=None)
+parser.add_argument("--max-speakers", dest="max_speakers", type=int, default=None)
+parser.add_argument(
+    "--workers", type=int, default=0, help="data loader workers of the diarizer"
+)
 args = parser.parse_args()
 
-# convert audio to mono for NeMo combatibility
-sound = AudioSegment.from_file(args.audio).set_channels(1)
-ROOT = os.getcwd()
-temp_path = os.path.join(ROOT, "temp_outputs")
-os.makedirs(temp_path, exist_ok=True)
-sound.export(os.path.join(temp_path, "mono_file.wav"), format="wav")
+temp_path = args.temp_path
+mono_file = get_mono_path(temp_path)
 
-# Initialize NeMo MSDD diarization model
-msdd_model = NeuralDiarizer(cfg=create_config(temp_path)).to(args.device)
+# convert audio to mono for NeMo combatibility, unless the caller already
+# decoded it into the shared 16 kHz mono buffer
+if os.path.abspath(args.audio) != mono_file:
+    decode_audio(args.audio, mono_file)
+
+# Initialize the NeMo diarizer of the profile
+config = create_config(
+    temp_path, args.profile, args.num_speakers, args.max_speakers, args.workers, args.device
+)
+msdd_model = load_diarizer(config, args.device, args.profile)
 msdd_model.diarize()
@@ -1,6 +1,5 @@
 import argparse
 import os
-import requests
 import json
 import sys
 
@@ -47,6 +46,8 @@ if args.path != '':
                 doNotify = False
 
     if doNotify:
+        import requests
+
         hookUrl = salesdockUrl + '/' + dataJson['returnHook']
         print(f"Pinging hook {hookUrl}")
         headers = {'Authorization': "Bearer " + os.environ.get('SALESDOCK_AUTHORIZATION')}
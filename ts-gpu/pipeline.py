@@ -0,0 +1,1194 @@
+import argparse
+import copy
+import logging
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+import torch
+from audio_helpers import (
+    OffsetMap,
+    compaction_segments,
+    decode_audio,
+    music_likelihood,
+    plan_shards,
+    write_segments,
+    write_wav,
+)
+from helpers import *
+from helpers import wav2vec2_langs, whisper_langs
+from model_cache import ModelCache
+from word_table import WordTable
+
+mtypes = {"cpu": "int8", "cuda": "float16"}
+
+# We don't want to punctuate U.S.A. with a period. Right?
+acronym_pattern = re.compile(r"\b(?:[a-zA-Z]\.){2,}")
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-a", "--audio", help="name of the target audio file", required=True
+    )
+    parser.add_argument(
+        "--stem",
+        dest="stem_mode",
+        choices=["auto", "always", "never"],
+        default="auto",
+        help="Source separation mode. auto runs demucs only when a quick music"
+        " detection pass finds music in the audio.",
+    )
+    parser.add_argument(
+        "--no-stem",
+        action="store_const",
+        const="never",
+        dest="stem_mode",
+        help="Disables source separation."
+        "This helps with long files that don't contain a lot of music.",
+    )
+    parser.add_argument(
+        "--music-threshold",
+        type=float,
+        dest="music_threshold",
+        default=0.1,
+        help="share of music-like windows above which --stem auto runs demucs",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        dest="compact",
+        default=False,
+        help="cut long silences and hold music out of the audio before stemming,"
+        " transcription and diarization",
+    )
+    parser.add_argument(
+        "--no-compact",
+        action="store_false",
+        dest="compact",
+        help="keep long silences and hold music in the audio, the default",
+    )
+    parser.add_argument(
+        "--compact-min-gap",
+        type=float,
+        dest="compact_min_gap",
+        default=5.0,
+        help="seconds of silence or music from which on they are cut out",
+    )
+    parser.add_argument(
+        "--separation-workers",
+        type=int,
+        dest="separation_workers",
+        default=0,
+        help="processes used by demucs on CPU, 0 picks one per 4 cores",
+    )
+
+    parser.add_argument(
+        "--suppress_numerals",
+        action="store_true",
+        dest="suppress_numerals",
+        default=False,
+        help="Suppresses Numerical Digits."
+        "This helps the diarization accuracy but converts all digits into written text.",
+    )
+
+    parser.add_argument(
+        "--whisper-model",
+        dest="model_name",
+        default="medium.en",
+        help="name of the Whisper model to use",
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        dest="batch_size",
+        default=8,
+        help="Batch size for batched inference, reduce if you run out of memory, set to 0 for non-batched inference",
+    )
+
+    parser.add_argument(
+        "--cpu-serving",
+        action="store_true",
+        dest="cpu_serving",
+        default=False,
+        help="on CPU, serve every job from one shared Whisper model with"
+        " --cpu-workers parallel workers instead of one copy per job",
+    )
+    parser.add_argument(
+        "--cpu-workers",
+        type=int,
+        dest="cpu_workers",
+        default=2,
+        help="transcriptions the shared CPU model runs at the same time",
+    )
+    parser.add_argument(
+        "--cpu-threads",
+        type=int,
+        dest="cpu_threads",
+        default=0,
+        help="threads of every CPU worker, 0 divides the physical cores of a"
+        " socket between the workers on it",
+    )
+
+    parser.add_argument(
+        "--shards",
+        type=int,
+        dest="shards",
+        default=1,
+        help="split long audio at silences into this many shards that are"
+        " transcribed in parallel processes, meant for CPU nodes."
+        " Shards are at least 5 minutes long.",
+    )
+
+    parser.add_argument(
+        "--punctuation",
+        dest="punctuation_mode",
+        choices=["auto", "always", "never"],
+        default="auto",
+        help="Punctuation restoration mode. auto skips the punctuation model"
+        " when Whisper's own sentence endings are already good enough for the"
+        " speaker realignment.",
+    )
+    parser.add_argument(
+        "--punctuation-int8",
+        action="store_true",
+        dest="punctuation_int8",
+        default=False,
+        help="run the punctuation model with dynamic int8 quantization when it"
+        " is on CPU",
+    )
+
+    parser.add_argument(
+        "--diarization",
+        dest="diarization_mode",
+        choices=["auto", "channels", "nemo"],
+        default="auto",
+        help="Diarization mode. auto diarizes two-channel recordings with one"
+        " speaker per channel by their channels instead of running NeMo,"
+        " channels does that for every stereo file.",
+    )
+    parser.add_argument(
+        "--diarization-profile",
+        dest="diarization_profile",
+        choices=["fast", "balanced", "accurate"],
+        default="balanced",
+        help="NeMo diarization profile. fast clusters on fewer scales without"
+        " the MSDD model, accurate searches the clustering threshold more finely.",
+    )
+    parser.add_argument(
+        "--num-speakers",
+        type=int,
+        dest="num_speakers",
+        default=None,
+        help="known number of speakers in the audio",
+    )
+    parser.add_argument(
+        "--max-speakers",
+        type=int,
+        dest="max_speakers",
+        default=None,
+        help="upper bound of the number of speakers NeMo looks for",
+    )
+    parser.add_argument(
+        "--diarizer-workers",
+        type=int,
+        dest="diarizer_workers",
+        default=0,
+        help="data loader workers of the NeMo diarizer",
+    )
+    parser.add_argument(
+        "--channel-speakers",
+        dest="channel_speakers",
+        default=None,
+        help="comma separated names of the speakers on the left and right"
+        " channel, e.g. Agent,Customer, used when diarizing by channels",
+    )
+
+    parser.add_argument(
+        "--no-checkpoints",
+        action="store_false",
+        dest="checkpoints",
+        default=True,
+        help="do not keep the stage outputs in <audio>.stages next to the audio file",
+    )
+    parser.add_argument(
+        "--from-stage",
+        dest="from_stage",
+        choices=["transcribe", "align", "diarize", "punctuate"],
+        default=None,
+        help="run this stage and the stages that use its output again instead"
+        " of reusing their checkpoints",
+    )
+
+    parser.add_argument(
+        "--language",
+        type=str,
+        default=None,
+        choices=whisper_langs,
+        help="Language spoken in the audio, specify None to perform language detection",
+    )
+
+    parser.add_argument(
+        "--device",
+        dest="device",
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="if you have a GPU use 'cuda', otherwise 'cpu'",
+    )
+    return parser
+
+
+class JobReport:
+    """Collects which models were served warm and the load time that saved."""
+
+    def __init__(self):
+        self.models = {}
+        self.time_saved = 0.0
+        self.audio_duration = None
+        self.stemming = None
+        self.punctuation = None
+        self.diarization = None
+        self.compaction = None
+        self.stage_times = None
+        self.error = None
+        self._lock = threading.Lock()
+
+    def get_model(self, cache, key, loader):
+        model, saved = cache.get(key, loader)
+        with self._lock:
+            self.models["/".join(str(k) for k in key)] = "warm" if saved else "cold"
+            self.time_saved += saved
+        return model
+
+    def merge(self, other):
+        """Add the model loads of a batch this job was part of."""
+        with self._lock:
+            self.models.update(other.models)
+            self.time_saved += other.time_saved
+
+
+def isolate_vocals(pcm, args, cache, report):
+    """Return the separated vocals of pcm as a 16 kHz float32 array."""
+    from separation_helpers import (
+        SeparationPool,
+        load_separation_model,
+        separate_vocals,
+        separation_model_name,
+    )
+
+    if args.device == "cpu":
+        # processes that keep the model loaded, shared by the jobs of a worker
+        pool = report.get_model(
+            cache,
+            ("demucs-pool", separation_model_name, args.separation_workers),
+            lambda: SeparationPool(args.separation_workers),
+        )
+        return separate_vocals(pcm, pool=pool)
+
+    model = report.get_model(
+        cache,
+        ("demucs", separation_model_name, args.device),
+        lambda: load_separation_model(args.device),
+    )
+    return separate_vocals(pcm, model, args.device)
+
+
+def needs_stemming(pcm, args, report):
+    """Decide whether demucs is worth running and record why in the report."""
+    if args.stem_mode != "auto":
+        report.stemming = {
+            "mode": args.stem_mode,
+            "stemmed": args.stem_mode == "always",
+        }
+        return report.stemming["stemmed"]
+
+    start_time = time.time()
+    score, features = music_likelihood(pcm.samples, pcm.sample_rate)
+    report.stemming = {
+        "mode": "auto",
+        "music_score": round(score, 4),
+        "stemmed": score >= args.music_threshold,
+        "detection_time": round(time.time() - start_time, 3),
+        **features,
+    }
+    logging.info(f"Music detection: {report.stemming}")
+    return report.stemming["stemmed"]
+
+
+def whisper_model_loader(args, cache, report, batched=True):
+    """
+    The cache key and loader of the Whisper model of args. With --cpu-serving
+    on CPU both the batched and the plain model are the one shared model.
+    """
+    from transcription_helpers import load_batched_whisper_model, load_whisper_model
+
+    compute_dtype = mtypes[args.device]
+    if not (args.cpu_serving and args.device == "cpu"):
+        if batched:
+            return (
+                ("whisperx", args.model_name, compute_dtype, args.suppress_numerals, args.device),
+                lambda: load_batched_whisper_model(
+                    args.model_name, compute_dtype, args.suppress_numerals, args.device
+                ),
+            )
+        return (
+            ("faster-whisper", args.model_name, compute_dtype, args.device),
+            lambda: load_whisper_model(args.model_name, compute_dtype, args.device),
+        )
+
+    from cpu_serving import load_shared_whisper_model
+
+    shared_key = (
+        "whisper-cpu", args.model_name, compute_dtype, args.cpu_workers, args.cpu_threads
+    )
+    load_shared = lambda: load_shared_whisper_model(
+        args.model_name, compute_dtype, args.cpu_workers, args.cpu_threads
+    )
+    if not batched:
+        return shared_key, load_shared
+    return (
+        ("whisperx", args.model_name, compute_dtype, args.suppress_numerals, *shared_key),
+        lambda: load_batched_whisper_model(
+            args.model_name,
+            compute_dtype,
+            args.suppress_numerals,
+            args.device,
+            model=report.get_model(cache, shared_key, load_shared),
+        ),
+    )
+
+
+def transcribe_workers(args):
+    """
+    How many transcriptions can run at once: the workers of the shared model
+    with --cpu-serving on CPU, one otherwise.
+    """
+    return args.cpu_workers if args.cpu_serving and args.device == "cpu" else 1
+
+
+def get_whisper_model(args, cache, report, batched=True):
+    key, loader = whisper_model_loader(args, cache, report, batched)
+    whisper_model = report.get_model(cache, key, loader)
+    if batched:
+        # concurrent jobs share the model, e.g. the transcription and the
+        # diarization path when both use the same model name. The whisperx
+        # pipeline keeps the tokenizer and options of the call in progress, so
+        # each call gets its own shallow copy on top of the shared weights.
+        whisper_model = copy.copy(whisper_model)
+    return whisper_model
+
+
+def transcribe_audio(pcm, audio, args, cache, report):
+    from transcription_helpers import transcribe, transcribe_batched, transcribe_sharded
+
+    compute_dtype = mtypes[args.device]
+    shards = plan_shards(pcm.samples, args.shards, pcm.sample_rate)
+    if len(shards) > 1:
+        logging.info(f"Transcribing {len(shards)} shards in parallel")
+        # every shard process loads its own model, the resident one is not used
+        return transcribe_sharded(
+            pcm.path,
+            shards,
+            args.language,
+            args.batch_size,
+            args.model_name,
+            compute_dtype,
+            args.suppress_numerals,
+            args.device,
+        )
+
+    # Transcribe the audio file
+    if args.batch_size != 0:
+        whisper_model = get_whisper_model(args, cache, report)
+        return transcribe_batched(
+            audio,
+            args.language,
+            args.batch_size,
+            args.model_name,
+            compute_dtype,
+            args.suppress_numerals,
+            args.device,
+            whisper_model=whisper_model,
+        )
+
+    whisper_model = get_whisper_model(args, cache, report, batched=False)
+    return transcribe(
+        audio,
+        args.language,
+        args.model_name,
+        compute_dtype,
+        args.suppress_numerals,
+        args.device,
+        whisper_model=whisper_model,
+    )
+
+
+def align_words(whisper_results, language, audio, args, cache, report):
+    import whisperx
+
+    if language in wav2vec2_langs:
+        alignment_model, metadata = report.get_model(
+            cache,
+            ("align", language, args.device),
+            lambda: whisperx.load_align_model(
+                language_code=language, device=args.device
+            ),
+        )
+        result_aligned = whisperx.align(
+            whisper_results, alignment_model, metadata, audio, args.device
+        )
+        word_timestamps = filter_missing_timestamps(
+            result_aligned["word_segments"],
+            initial_timestamp=whisper_results[0].get("start"),
+            final_timestamp=whisper_results[-1].get("end"),
+        )
+        # clear gpu vram
+        del alignment_model
+        torch.cuda.empty_cache()
+        return word_timestamps
+
+    assert (
+        args.batch_size == 0  # TODO: add a better check for word timestamps existence
+    ), (
+        f"Unsupported language: {language}, use --batch_size to 0"
+        " to generate word timestamps using whisper directly and fix this error."
+    )
+    word_timestamps = []
+    for segment in whisper_results:
+        for word in segment["words"]:
+            word_timestamps.append({"word": word[2], "start": word[0], "end": word[1]})
+    return word_timestamps
+
+
+# resident NeuralDiarizer instances that are in use by a job, one job per instance
+_busy_diarizers = set()
+_diarizer_lock = threading.Lock()
+
+
+def _acquire_diarizer_slot(device):
+    with _diarizer_lock:
+        slot = 0
+        while (device, slot) in _busy_diarizers:
+            slot += 1
+        _busy_diarizers.add((device, slot))
+    return slot
+
+
+def _release_diarizer_slot(device, slot):
+    with _diarizer_lock:
+        _busy_diarizers.discard((device, slot))
+
+
+def get_diarizer_config(temp_path, args):
+    return create_config(
+        temp_path,
+        args.diarization_profile,
+        args.num_speakers,
+        args.max_speakers,
+        args.diarizer_workers,
+        args.device,
+    )
+
+
+def retarget_diarizer(msdd_model, config):
+    """
+    Point a resident diarizer at the manifest and output dir of a new job,
+    with the speaker count hints and data loader workers of that job.
+    """
+    msdd_model._cfg.num_workers = config.num_workers
+    msdd_model._cfg.diarizer.manifest_filepath = config.diarizer.manifest_filepath
+    msdd_model._cfg.diarizer.out_dir = config.diarizer.out_dir
+    clustering = msdd_model._cfg.diarizer.clustering.parameters
+    clustering.oracle_num_speakers = config.diarizer.clustering.parameters.oracle_num_speakers
+    clustering.max_num_speakers = config.diarizer.clustering.parameters.max_num_speakers
+    if hasattr(msdd_model, "msdd_model"):
+        # the MSDD model of a NeuralDiarizer keeps its own copy
+        msdd_model.msdd_model.cfg.test_ds.manifest_filepath = (
+            config.diarizer.manifest_filepath
+        )
+        msdd_model.msdd_model.cfg.test_ds.emb_dir = config.diarizer.out_dir
+
+
+def run_diarizer(temp_path, args, cache, report):
+    # temp_path/mono_file.wav is the shared 16 kHz mono buffer written by decode_audio
+    # concurrent jobs each get their own resident instance, since a diarizer
+    # is pointed at one job's manifest at a time
+    device, profile = args.device, args.diarization_profile
+    config = get_diarizer_config(temp_path, args)
+    slot = _acquire_diarizer_slot(device)
+    try:
+        # Initialize the NeMo diarizer of the profile
+        msdd_model = report.get_model(
+            cache,
+            ("msdd", device, profile, slot),
+            lambda: load_diarizer(config, device, profile),
+        )
+        retarget_diarizer(msdd_model, config)
+        msdd_model.diarize()
+    finally:
+        _release_diarizer_slot(device, slot)
+
+    del msdd_model
+    torch.cuda.empty_cache()
+
+
+def read_speaker_ts(temp_path):
+    # Reading timestamps <> Speaker Labels mapping
+    return read_rttm(get_rttm_path(temp_path))
+
+
+def load_punctuation_model(int8=False):
+    from deepmultilingualpunctuation import PunctuationModel
+
+    punct_model = PunctuationModel(model=punct_model_name)
+    if int8 and punct_model.pipe.device.type == "cpu":
+        punct_model.pipe.model = torch.quantization.quantize_dynamic(
+            punct_model.pipe.model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    return punct_model
+
+
+def predict_punctuation(punct_model, word_lists, chunk_size=230, overlap=5, batch_size=8):
+    """
+    PunctuationModel.predict for several word lists at once. Every list is cut
+    into chunks exactly like predict does, so the labels are the same, but the
+    chunks of all lists go through the token classification pipeline together.
+    """
+    chunked = []
+    for words in word_lists:
+        list_overlap = overlap if len(words) > chunk_size else 0
+        batches = [
+            words[i : i + chunk_size]
+            for i in range(0, len(words), chunk_size - list_overlap)
+        ]
+        # if the last batch is smaller than the overlap, we can just remove it
+        if batches and len(batches[-1]) <= list_overlap:
+            batches.pop()
+        chunked.append((batches, list_overlap))
+
+    texts = [" ".join(batch) for batches, _ in chunked for batch in batches]
+    results = iter(punct_model.pipe(texts, batch_size=batch_size) if texts else [])
+
+    labled_lists = []
+    for words, (batches, list_overlap) in zip(word_lists, chunked):
+        tagged_words = []
+        score = None
+        for batch in batches:
+            result = next(results)
+            # use last batch completely
+            if batch == batches[-1]:
+                list_overlap = 0
+            text = " ".join(batch)
+            assert len(text) == result[-1]["end"], "chunk size too large, text got clipped"
+
+            char_index = 0
+            result_index = 0
+            for word in batch[: len(batch) - list_overlap]:
+                char_index += len(word) + 1
+                # if any subtokens of an word are labled as sentence end
+                # we label the whole word as sentence end
+                label = "0"
+                while result_index < len(result) and char_index > result[result_index]["end"]:
+                    label = result[result_index]["entity"]
+                    score = result[result_index]["score"]
+                    result_index += 1
+                tagged_words.append([word, label, score])
+
+        assert len(tagged_words) == len(words)
+        labled_lists.append(tagged_words)
+    return labled_lists
+
+
+def restore_punctuation(wsms, languages, args, cache, row_report, reports):
+    """
+    Restore the punctuation of several WordTables in one pass. Returns new
+    tables with the punctuated words and records the path taken and its time
+    in the punctuation of every report.
+    """
+    start_time = time.time()
+    punctuated = []
+    for i, (wsm, language, report) in enumerate(zip(wsms, languages, reports)):
+        if language not in punct_model_langs:
+            logging.warning(
+                f"Punctuation restoration is not available for {language} language. Using the original punctuation."
+            )
+            report.punctuation = {"path": "unsupported"}
+        elif args.punctuation_mode == "never" or (
+            args.punctuation_mode == "auto" and is_well_punctuated(wsm.words)
+        ):
+            report.punctuation = {"path": "skipped"}
+        else:
+            punctuated.append(i)
+    if not punctuated:
+        for report in reports:
+            report.punctuation["time"] = round(time.time() - start_time, 3)
+        return wsms
+
+    # restoring punctuation in the transcript to help realign the sentences
+    int8 = args.punctuation_int8 and args.device == "cpu"
+    punct_model = row_report.get_model(
+        cache,
+        ("punctuation", punct_model_name, "int8" if int8 else "default"),
+        lambda: load_punctuation_model(int8),
+    )
+
+    labled_lists = predict_punctuation(
+        punct_model, [wsms[i].words for i in punctuated]
+    )
+
+    ending_puncts = ".?!"
+    model_puncts = ".,;:!?"
+
+    wsms = list(wsms)
+    for i, labled_words in zip(punctuated, labled_lists):
+        words = list(wsms[i].words)
+        for k, labeled_tuple in enumerate(labled_words):
+            if labeled_tuple[1] not in ending_puncts:
+                continue
+            word = words[k]
+            if word and (word[-1] not in model_puncts or acronym_pattern.fullmatch(word)):
+                word += labeled_tuple[1]
+                if word.endswith(".."):
+                    word = word.rstrip(".")
+                words[k] = word
+        wsms[i] = wsms[i].replace(words=words)
+
+    # the model time is shared by the files it ran on, by number of words
+    run_time = time.time() - start_time
+    total_words = sum(len(wsms[i]) for i in punctuated)
+    for i in punctuated:
+        share = len(wsms[i]) / total_words if total_words else 1 / len(punctuated)
+        reports[i].punctuation = {
+            "path": "model-int8" if int8 else "model",
+            "time": round(run_time * share, 3),
+        }
+    for report in reports:
+        report.punctuation.setdefault("time", 0.0)
+    return wsms
+
+
+def prewarm_models(args, cache, languages=("en",)):
+    """
+    Load the models a diarize job with args uses into cache, so the first job
+    finds them resident. A model that fails to load is logged and skipped, the
+    job that needs it loads it again and reports the error.
+    """
+    import whisperx
+
+    report = JobReport()
+    loads = [whisper_model_loader(args, cache, report, batched=args.batch_size != 0)]
+    for language in languages:
+        if language in wav2vec2_langs:
+            loads.append(
+                (
+                    ("align", language, args.device),
+                    lambda language=language: whisperx.load_align_model(
+                        language_code=language, device=args.device
+                    ),
+                )
+            )
+    if args.punctuation_mode != "never":
+        int8 = args.punctuation_int8 and args.device == "cpu"
+        loads.append(
+            (
+                ("punctuation", punct_model_name, "int8" if int8 else "default"),
+                lambda: load_punctuation_model(int8),
+            )
+        )
+
+    for key, loader in loads:
+        try:
+            report.get_model(cache, key, loader)
+        except Exception:
+            logging.exception(f"Prewarming {key} failed")
+
+    # the diarizer is built from a job config, a throwaway one points it at an
+    # empty scratch dir until retarget_diarizer moves it to the first job
+    temp_path = create_scratch_dir("prewarm-")
+    try:
+        report.get_model(
+            cache,
+            ("msdd", args.device, args.diarization_profile, 0),
+            lambda: load_diarizer(
+                get_diarizer_config(temp_path, args), args.device, args.diarization_profile
+            ),
+        )
+    except Exception:
+        logging.exception("Prewarming the diarizer failed")
+    finally:
+        cleanup(temp_path)
+    return report
+
+
+def diarize_audio(args, cache=None, nemo_in_process=False):
+    """
+    Diarize args.audio and write the .txt, .srt and .json next to it.
+
+    With a resident cache and nemo_in_process the models stay loaded between
+    calls and NeMo runs on a thread instead of a nemo_process.py subprocess.
+    Returns the JobReport.
+    """
+    report = diarize_files([args.audio], args, cache, nemo_in_process)[0]
+    if report.error is not None:
+        raise report.error
+    return report
+
+
+def diarize_files(audio_files, args, cache=None, nemo_in_process=False, graph=None):
+    """
+    Diarize several files through the stage graph: the files overlap, so one
+    is decoded while another is diarized, the Whisper segments of files that
+    wait for transcription together are packed into the same batches and the
+    punctuation model runs over the words of those files in one pass. The
+    outputs of every file are the same as diarizing it on its own.
+
+    graph is a shared create_diarization_graph, so files of other calls
+    overlap too. Without one a private graph is used for this call.
+
+    Returns one JobReport per file. A file that fails to decode or diarize
+    gets the exception in report.error, the other files are still written.
+    """
+    own_graph = graph is None
+    if own_graph:
+        if cache is None:
+            # the files of a batch share their models
+            cache = ModelCache(capacity=0 if len(audio_files) == 1 else 4)
+        graph = create_diarization_graph(
+            cache, nemo_in_process, transcribe_workers=transcribe_workers(args)
+        )
+
+    # every job gets its own scratch folder so concurrent diarizations do not
+    # overwrite each other's mono_file.wav, manifest and RTTM
+    jobs = [
+        {
+            "audio_file": audio_file,
+            "args": args,
+            "report": JobReport(),
+            "temp_path": create_scratch_dir(),
+        }
+        for audio_file in audio_files
+    ]
+    try:
+        futures = [graph.submit(job) for job in jobs]
+        for job, future in zip(jobs, futures):
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Diarizing {job['audio_file']} failed: {e!r}")
+                job["report"].error = e
+    finally:
+        # the future of a job resolves once none of its stages runs any more,
+        # so nothing writes into the scratch folder while it is removed
+        for job in jobs:
+            try:
+                cleanup(job["temp_path"])
+            except (OSError, ValueError):
+                logging.warning(f"Removing {job['temp_path']} failed", exc_info=True)
+        if own_graph:
+            graph.shutdown()
+    return [job["report"] for job in jobs]
+
+
+def compact_audio(pcm, args, report, temp_path):
+    """
+    Cut long silences and hold music out of pcm. Returns the compacted buffer
+    and the OffsetMap back to the original time.
+    """
+    start_time = time.time()
+    segments = compaction_segments(pcm.samples, pcm.sample_rate, min_gap=args.compact_min_gap)
+    offsets = OffsetMap(segments, pcm.sample_rate)
+    compacted_length = offsets.compacted_length
+    if compacted_length < len(pcm):
+        pcm_length = len(pcm)
+        pcm = write_segments(get_mono_path(temp_path), pcm.samples, segments, pcm.sample_rate)
+    else:
+        pcm_length = compacted_length
+    report.compaction = {
+        "compacted_duration": round(compacted_length / pcm.sample_rate, 3),
+        "removed_duration": round((pcm_length - compacted_length) / pcm.sample_rate, 3),
+        "ratio": round(compacted_length / pcm_length, 4),
+        "cuts": len(segments) - 1,
+        "time": round(time.time() - start_time, 3),
+    }
+    logging.info(f"Compaction: {report.compaction}")
+    return pcm, offsets
+
+
+def prepare_audio(audio_file, args, cache, report, temp_path):
+    """
+    Decode audio_file once into a 16 kHz mono buffer shared by Whisper,
+    alignment, NeMo and the metadata writer, without long silences and music
+    when args.compact and with only the vocals when stemming. Returns the
+    buffer and the OffsetMap of the compaction, or None.
+    """
+    pcm = decode_audio(audio_file, get_mono_path(temp_path))
+    report.audio_duration = pcm.duration
+
+    offsets = None
+    if args.compact:
+        # before stemming, so demucs does not separate the hold music either
+        pcm, offsets = compact_audio(pcm, args, report, temp_path)
+
+    if needs_stemming(pcm, args, report):
+        start_time = time.time()
+        try:
+            vocals = isolate_vocals(pcm, args, cache, report)
+            # the buffer holds the separated vocals instead of the original mix
+            pcm = write_wav(get_mono_path(temp_path), vocals)
+            del vocals
+        except Exception:
+            logging.exception(
+                "Source splitting failed, using original audio file. Use --no-stem argument to disable it."
+            )
+            report.stemming["stemmed"] = False
+        report.stemming["stem_time"] = round(time.time() - start_time, 3)
+    return pcm, offsets
+
+
+def run_nemo_process(audio_path, args, temp_path):
+    speaker_args = []
+    if args.num_speakers:
+        speaker_args += ["--num-speakers", str(args.num_speakers)]
+    if args.max_speakers:
+        speaker_args += ["--max-speakers", str(args.max_speakers)]
+    subprocess.run(
+        [
+            "python3",
+            "nemo_process.py",
+            "-a",
+            audio_path,
+            "--device",
+            args.device,
+            "--temp-path",
+            temp_path,
+            "--profile",
+            args.diarization_profile,
+            "--workers",
+            str(args.diarizer_workers),
+            *speaker_args,
+        ],
+    )
+
+
+def transcribe_files(pcms, audios, args, cache, report):
+    from transcription_helpers import transcribe_batched_files
+
+    if len(audios) == 1 or args.batch_size == 0 or args.shards > 1:
+        # nothing to pack, or the files are split up further instead
+        return [
+            transcribe_audio(pcm, audio, args, cache, report)
+            for pcm, audio in zip(pcms, audios)
+        ]
+
+    whisper_model = get_whisper_model(args, cache, report)
+    return transcribe_batched_files(
+        audios, args.language, args.batch_size, whisper_model
+    )
+
+
+def _open_stages(audio_file, args):
+    from checkpoints import JobStages
+
+    if not args.checkpoints:
+        return None
+    try:
+        return JobStages(audio_file, args)
+    except OSError:
+        logging.warning(f"Can not keep checkpoints next to {audio_file}", exc_info=True)
+        return None
+
+
+def _load_stage(stages, stage):
+    return None if stages is None else stages.load(stage)
+
+
+def _save_stage(stages, stage, value):
+    if stages is not None:
+        stages.save(stage, value)
+
+
+# the settings transcribe_files and restore_punctuation read. Jobs that agree
+# on them share a batch, whichever row or file they come from.
+transcription_settings = (
+    "model_name",
+    "language",
+    "batch_size",
+    "suppress_numerals",
+    "shards",
+    "device",
+    "cpu_serving",
+    "cpu_workers",
+    "cpu_threads",
+)
+punctuation_settings = ("punctuation_mode", "punctuation_int8", "device")
+
+
+def _group_by_settings(jobs, settings):
+    """Split a batch into groups of jobs with equal settings."""
+    groups = {}
+    for job in jobs:
+        key = tuple(getattr(job["args"], name) for name in settings)
+        groups.setdefault(key, []).append(job)
+    return list(groups.values())
+
+
+def _merge_batch_report(jobs, batch_report):
+    for job in jobs:
+        job["report"].merge(batch_report)
+
+
+def _prepare_stage(jobs, cache):
+    (job,) = jobs
+    args, report = job["args"], job["report"]
+    stages = job["stages"] = _open_stages(job["audio_file"], args)
+    job["transcription"] = _load_stage(stages, "transcribe")
+    job["timestamps"] = (
+        None if job["transcription"] is None else _load_stage(stages, "align")
+    )
+    job["diarization"] = _load_stage(stages, "diarize")
+    audio_meta = _load_stage(stages, "audio")
+    if None in (job["transcription"], job["timestamps"], job["diarization"], audio_meta):
+        job["pcm"], job["offsets"] = prepare_audio(
+            job["audio_file"], args, cache, report, job["temp_path"]
+        )
+        _save_stage(
+            stages,
+            "audio",
+            {
+                "audio_duration": report.audio_duration,
+                "stemming": report.stemming,
+                "compaction": report.compaction,
+                "segments": None if job["offsets"] is None else job["offsets"].segments.tolist(),
+            },
+        )
+    else:
+        # every stage that needs the audio is checkpointed
+        job["pcm"] = None
+        report.audio_duration = audio_meta["audio_duration"]
+        report.stemming = audio_meta["stemming"]
+        report.compaction = audio_meta["compaction"]
+        job["offsets"] = (
+            None if audio_meta["segments"] is None else OffsetMap(audio_meta["segments"])
+        )
+
+
+def _transcribe_stage(jobs, cache):
+    pending = [job for job in jobs if job["timestamps"] is None]
+    for job in pending:
+        job["audio"] = job["pcm"].float32()
+    errors = {}
+    for group in _group_by_settings(
+        [job for job in pending if job["transcription"] is None], transcription_settings
+    ):
+        batch_report = JobReport()
+        try:
+            transcriptions = transcribe_files(
+                [job["pcm"] for job in group],
+                [job["audio"] for job in group],
+                group[0]["args"],
+                cache,
+                batch_report,
+            )
+        except Exception as e:
+            logging.exception("Transcribing a batch failed")
+            errors.update((id(job), e) for job in group)
+            continue
+        _merge_batch_report(group, batch_report)
+        for job, (whisper_results, language) in zip(group, transcriptions):
+            job["transcription"] = {"segments": whisper_results, "language": language}
+            _save_stage(job["stages"], "transcribe", job["transcription"])
+    return [errors.get(id(job)) for job in jobs]
+
+
+def _align_stage(jobs, cache):
+    (job,) = jobs
+    if job["timestamps"] is None:
+        job["timestamps"] = align_words(
+            job["transcription"]["segments"],
+            job["transcription"]["language"],
+            job.pop("audio"),
+            job["args"],
+            cache,
+            job["report"],
+        )
+        _save_stage(job["stages"], "align", job["timestamps"])
+    job["words"] = WordTable.from_word_timestamps(job["timestamps"])
+
+
+def _diarize_stage(jobs, cache, nemo_in_process):
+    from channel_diarization import diarize_channels
+
+    (job,) = jobs
+    args, report, temp_path = job["args"], job["report"], job["temp_path"]
+    rttm_path = get_rttm_path(temp_path)
+    stored = job["diarization"]
+    if stored is not None:
+        report.diarization = stored["diarization"]
+        os.makedirs(os.path.dirname(rttm_path), exist_ok=True)
+        with open(rttm_path, "w") as f:
+            f.write(stored["rttm"])
+    else:
+        start_time = time.time()
+        channels = None
+        if args.diarization_mode != "nemo":
+            # the channels of the original file, not of the mono buffer
+            channels = diarize_channels(
+                job["audio_file"], rttm_path, force=args.diarization_mode == "channels"
+            )
+        if channels is not None:
+            report.diarization = {"path": "channels", **channels}
+        else:
+            logging.info(f"Starting Nemo process with audio: {job['pcm'].path}")
+            if nemo_in_process:
+                run_diarizer(temp_path, args, cache, report)
+            else:
+                run_nemo_process(job["pcm"].path, args, temp_path)
+            report.diarization = {"path": "nemo", "profile": args.diarization_profile}
+        report.diarization["time"] = round(time.time() - start_time, 3)
+        logging.info(f"Diarization: {report.diarization}")
+        with open(rttm_path) as f:
+            _save_stage(
+                job["stages"], "diarize", {"rttm": f.read(), "diarization": report.diarization}
+            )
+    job["speaker_ts"] = read_speaker_ts(temp_path)
+
+
+def _punctuate_stage(jobs, cache):
+    # punctuation checkpoints are reused, the rest runs through the model together
+    pending = []
+    for job in jobs:
+        stored = _load_stage(job["stages"], "punctuate")
+        if stored is None:
+            pending.append(job)
+            continue
+        job["report"].punctuation = stored["punctuation"]
+        job["words"] = job["words"].replace(words=[sys.intern(w) for w in stored["words"]])
+
+    errors = {}
+    for group in _group_by_settings(pending, punctuation_settings):
+        batch_report = JobReport()
+        try:
+            tables = restore_punctuation(
+                [job["words"] for job in group],
+                [job["transcription"]["language"] for job in group],
+                group[0]["args"],
+                cache,
+                batch_report,
+                [job["report"] for job in group],
+            )
+        except Exception as e:
+            logging.exception("Restoring punctuation of a batch failed")
+            errors.update((id(job), e) for job in group)
+            continue
+        _merge_batch_report(group, batch_report)
+        for job, table in zip(group, tables):
+            job["words"] = table
+            _save_stage(
+                job["stages"],
+                "punctuate",
+                {"words": table.words, "punctuation": job["report"].punctuation},
+            )
+    return [errors.get(id(job)) for job in jobs]
+
+
+def _write_stage(jobs):
+    (job,) = jobs
+    args, report = job["args"], job["report"]
+    words, speaker_ts = job["words"], job["speaker_ts"]
+    offsets = job["offsets"]
+    if offsets is not None:
+        # the words and the NeMo turns are in the time of the compacted audio,
+        # the channel turns in the time of the original file
+        words = words.replace(
+            start=offsets.to_original_ms(words.start),
+            end=offsets.to_original_ms(words.end, end=True),
+        )
+        if report.diarization["path"] == "nemo":
+            speaker_ts = speaker_ts.copy()
+            speaker_ts[:, 0] = offsets.to_original_ms(speaker_ts[:, 0])
+            speaker_ts[:, 1] = offsets.to_original_ms(speaker_ts[:, 1], end=True)
+    wsm = get_words_speaker_mapping(words, speaker_ts, "start")
+    wsm = get_realigned_ws_mapping_with_punctuation(wsm)
+    speaker_names = None
+    if report.diarization["path"] == "channels" and args.channel_speakers:
+        # the speaker index is the channel
+        speaker_names = dict(
+            enumerate(name.strip() for name in args.channel_speakers.split(","))
+        )
+    ssm = iter_sentences_speaker_mapping(wsm, speaker_ts, speaker_names)
+
+    report.stage_times = job["stage_times"]
+    write_outputs(
+        ssm,
+        job["audio_file"],
+        {
+            "audio_duration": report.audio_duration,
+            "stemming": report.stemming,
+            "punctuation": report.punctuation,
+            "diarization": report.diarization,
+            "compaction": report.compaction,
+            "stage_times": report.stage_times,
+        },
+    )
+    # the audio buffer is not needed any more
+    job.pop("pcm", None)
+
+
+def create_diarization_graph(
+    cache,
+    nemo_in_process=False,
+    model_slots=2,
+    prepare_workers=2,
+    write_workers=2,
+    batch_size=8,
+    transcribe_workers=1,
+):
+    """
+    The stages of a diarization job. Decoding with stemming and writing run on
+    their own worker threads, the model stages share model_slots slots of the
+    "model" budget and transcription and punctuation take up to batch_size
+    waiting files at once. NeMo runs on one worker, one file after the other.
+    transcribe_workers batches are transcribed at once, see transcribe_workers.
+
+        prepare -> transcribe -> align -> punctuate -> write
+                -> diarize ------------------------->
+    """
+    from stage_graph import Stage, StageGraph
+
+    return StageGraph(
+        [
+            Stage("prepare", lambda jobs: _prepare_stage(jobs, cache), workers=prepare_workers),
+            Stage(
+                "transcribe",
+                lambda jobs: _transcribe_stage(jobs, cache),
+                deps=("prepare",),
+                workers=transcribe_workers,
+                batch_size=batch_size,
+                resource="model",
+            ),
+            Stage(
+                "align",
+                lambda jobs: _align_stage(jobs, cache),
+                deps=("transcribe",),
+                resource="model",
+            ),
+            Stage(
+                "diarize",
+                lambda jobs: _diarize_stage(jobs, cache, nemo_in_process),
+                deps=("prepare",),
+                resource="model",
+            ),
+            Stage(
+                "punctuate",
+                lambda jobs: _punctuate_stage(jobs, cache),
+                deps=("align",),
+                batch_size=batch_size,
+                resource="model",
+            ),
+            Stage("write", _write_stage, deps=("diarize", "punctuate"), workers=write_workers),
+        ],
+        resources={"model": model_slots},
+    )
@@ -0,0 +1,175 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+import torch
+from audio_helpers import SAMPLE_RATE, speech_regions
+
+# In-process demucs vocal separation. Only the speech regions found by
+# speech_regions are separated, long regions are cut into overlapping segments
+# and the segments are crossfaded back together. On CPU the segments go to a
+# SeparationPool of processes that keep the model loaded between files. The
+# result stays a 16 kHz float32 array.
+
+separation_model_name = "htdemucs"
+
+_worker_model = None
+
+
+def load_separation_model(device="cpu"):
+    from demucs.pretrained import get_model
+
+    model = get_model(separation_model_name)
+    model.to(device)
+    model.eval()
+    return model
+
+
+def _init_worker(num_threads):
+    global _worker_model
+    torch.set_num_threads(num_threads)
+    _worker_model = load_separation_model("cpu")
+
+
+def _worker_ready():
+    return os.getpid()
+
+
+def _separate_in_worker(segment, ref_mean, ref_std):
+    return separate_segment(_worker_model, segment, ref_mean, ref_std, "cpu")
+
+
+class SeparationPool:
+    """
+    num_workers processes (0 picks one per 4 cores) that each load the model
+    once and share the CPU cores. Meant to be kept in a ModelCache, so every
+    file separated on CPU reuses the loaded processes. They exit once the
+    pool is shut down or no longer referenced.
+    """
+
+    def __init__(self, num_workers=0):
+        cores = os.cpu_count() or 1
+        self.num_workers = num_workers or max(cores // 4, 1)
+        # spawned like the shard workers of transcribe_sharded, a fork of a
+        # threaded caller can hang on a lock another thread held
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(max(cores // self.num_workers, 1),),
+        )
+        # processes are started on demand, start them all and wait for the
+        # model loads here, so the load is not paid by the first file
+        for future in [self._pool.submit(_worker_ready) for _ in range(self.num_workers)]:
+            future.result()
+
+    def map(self, segments, ref_mean, ref_std):
+        return self._pool.map(
+            _separate_in_worker, segments, repeat(ref_mean), repeat(ref_std)
+        )
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+
+def separate_segment(model, segment, ref_mean, ref_std, device):
+    """Return the 16 kHz mono vocals of one float32 16 kHz mono segment."""
+    from demucs.apply import apply_model
+    from demucs.audio import convert_audio
+
+    wav = torch.from_numpy(np.ascontiguousarray(segment, dtype=np.float32))[None]
+    wav = convert_audio(wav, SAMPLE_RATE, model.samplerate, model.audio_channels)
+    # normalise with the statistics of the whole file like demucs.separate does
+    wav = (wav - ref_mean) / ref_std
+    with torch.no_grad():
+        sources = apply_model(model, wav[None], device=device, split=True, progress=False)[0]
+    vocals = sources[model.sources.index("vocals")] * ref_std + ref_mean
+    vocals = convert_audio(vocals.cpu(), model.samplerate, SAMPLE_RATE, 1)[0]
+    return vocals.numpy()[: len(segment)]
+
+
+def plan_segments(regions, segment_size, overlap):
+    """Cut every region into segments of at most segment_size overlapping by overlap."""
+    segments = []
+    for region_start, region_end in regions:
+        start = region_start
+        while True:
+            end = min(start + segment_size, region_end)
+            segments.append((int(start), int(end)))
+            if end >= region_end:
+                break
+            start = end - overlap
+    return segments
+
+
+def crossfade_weights(length, overlap, fade_in, fade_out):
+    weights = np.ones(length, dtype=np.float32)
+    ramp = min(overlap, length)
+    if fade_in:
+        weights[:ramp] = np.linspace(1e-3, 1, ramp, dtype=np.float32)
+    if fade_out:
+        weights[-ramp:] = np.minimum(
+            weights[-ramp:], np.linspace(1, 1e-3, ramp, dtype=np.float32)
+        )
+    return weights
+
+
+def separate_vocals(
+    pcm,
+    model=None,
+    device="cpu",
+    pool=None,
+    segment_seconds=60.0,
+    overlap_seconds=2.0,
+):
+    """
+    Separate the vocals of a PcmAudio buffer and return them as a float32 array
+    of the same length. Non-speech regions are left silent.
+
+    With a SeparationPool the segments are spread over its processes, that
+    already have the model loaded. Otherwise they run one after the other on
+    model, e.g. the resident CUDA one, which is loaded here when not given.
+    """
+    regions = speech_regions(pcm.samples, pcm.sample_rate)
+    vocals = np.zeros(len(pcm), dtype=np.float32)
+    if len(regions) == 0:
+        return vocals
+
+    segment_size = int(segment_seconds * pcm.sample_rate)
+    overlap = int(overlap_seconds * pcm.sample_rate)
+    segments = plan_segments(regions, segment_size, overlap)
+
+    # whole file statistics, computed on the speech regions only
+    speech = np.concatenate([pcm.float32(start, end) for start, end in regions])
+    ref_mean, ref_std = float(speech.mean()), float(speech.std()) or 1.0
+    del speech
+
+    inputs = (pcm.float32(start, end) for start, end in segments)
+    if pool is not None:
+        logging.info(
+            f"Separating {len(segments)} segments on {pool.num_workers} processes"
+        )
+        separated = list(pool.map(inputs, ref_mean, ref_std))
+    else:
+        if model is None:
+            model = load_separation_model(device)
+        separated = [
+            separate_segment(model, segment, ref_mean, ref_std, device)
+            for segment in inputs
+        ]
+
+    weight_sum = np.zeros(len(pcm), dtype=np.float32)
+    for (start, end), segment_vocals in zip(segments, separated):
+        weights = crossfade_weights(
+            end - start,
+            overlap,
+            fade_in=start > 0 and weight_sum[start] > 0,
+            fade_out=(start, end) != segments[-1] and end < len(pcm),
+        )
+        vocals[start:end] += segment_vocals * weights
+        weight_sum[start:end] += weights
+    np.divide(vocals, weight_sum, out=vocals, where=weight_sum > 0)
+    return vocals
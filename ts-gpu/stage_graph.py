@@ -0,0 +1,227 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import nullcontext
+
+# A small stage-graph executor. Every stage has its own queue and worker
+# threads, and stages that use a model take a slot of a shared resource
+# budget, so the stages of different files overlap: one file is decoded while
+# another is diarized and a third is written. A file enters the stages
+# without dependencies and moves on to a stage once all the stages it depends
+# on are done. A failed item skips the stages it has not started yet and
+# resolves once none of its stages runs any more, so a sibling branch is
+# never cut short, e.g. diarization still writing into the scratch folder of
+# a file whose transcription failed.
+
+
+class Stage:
+    """
+    func takes a list of items and returns None, or a list with an exception
+    or None per item. Up to batch_size queued items are passed at once, and
+    the call holds one slot of resource while it runs.
+    """
+
+    def __init__(self, name, func, deps=(), workers=1, batch_size=1, resource=None):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.resource = resource
+
+
+class _StageMetrics:
+    def __init__(self):
+        self.processed = 0
+        self.failed = 0
+        self.batches = 0
+        self.busy = 0.0
+        self.resource_wait = 0.0
+        self.queue_wait = 0.0
+        self.max_queue_wait = 0.0
+
+
+class _Task:
+    def __init__(self, item):
+        self.item = item
+        self.future = Future()
+        self.done = set()
+        self.enqueued = {}
+        # the first error, and the stages that are queued or running
+        self.error = None
+        self.pending = 0
+        self.lock = threading.Lock()
+
+
+class StageGraph:
+    """
+    Runs items through the stages. Items are dicts, the time every item spent
+    queued for and running in each stage is recorded in item["stage_times"].
+    """
+
+    def __init__(self, stages, resources=None):
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            missing = set(stage.deps) - set(self.stages)
+            if missing:
+                raise ValueError(f"Stage {stage.name} depends on unknown stages {missing}")
+        self.dependents = {
+            name: [stage for stage in stages if name in stage.deps] for name in self.stages
+        }
+        self.resources = {
+            name: threading.BoundedSemaphore(slots) for name, slots in (resources or {}).items()
+        }
+        self.queues = {name: queue.Queue() for name in self.stages}
+        self.metrics = {name: _StageMetrics() for name in self.stages}
+        self._metrics_lock = threading.Lock()
+        self.started = time.monotonic()
+        self._threads = []
+        for stage in stages:
+            for i in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._run_stage, args=(stage,), name=f"{stage.name}-{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, item):
+        """Queue item and return a Future that resolves to it after its last stage."""
+        item.setdefault("stage_times", {})
+        task = _Task(item)
+        roots = [stage.name for stage in self.stages.values() if not stage.deps]
+        task.pending = len(roots)
+        for name in roots:
+            self._enqueue(name, task)
+        return task.future
+
+    def resource(self, name):
+        """A slot of a resource budget, for work that runs outside the graph."""
+        return self.resources[name] if name in self.resources else nullcontext()
+
+    def _enqueue(self, stage_name, task):
+        task.enqueued[stage_name] = time.monotonic()
+        self.queues[stage_name].put(task)
+
+    def _next_batch(self, stage):
+        q = self.queues[stage.name]
+        batch = []
+        while not batch:
+            task = q.get()
+            if task is None:
+                return None
+            if task.error is None:
+                batch.append(task)
+            else:
+                self._finish(stage, task, None)
+        while len(batch) < stage.batch_size:
+            try:
+                task = q.get_nowait()
+            except queue.Empty:
+                break
+            if task is None:
+                # leave the shutdown marker for the next call
+                q.put(None)
+                break
+            if task.error is None:
+                batch.append(task)
+            else:
+                self._finish(stage, task, None)
+        return batch
+
+    def _run_stage(self, stage):
+        while True:
+            batch = self._next_batch(stage)
+            if batch is None:
+                return
+            dequeued = time.monotonic()
+            with self.resource(stage.resource):
+                started = time.monotonic()
+                try:
+                    errors = stage.func([task.item for task in batch]) or [None] * len(batch)
+                except Exception as e:
+                    logging.exception(f"Stage {stage.name} failed")
+                    errors = [e] * len(batch)
+            finished = time.monotonic()
+
+            with self._metrics_lock:
+                metrics = self.metrics[stage.name]
+                metrics.batches += 1
+                metrics.busy += finished - started
+                metrics.resource_wait += started - dequeued
+                for task in batch:
+                    wait = dequeued - task.enqueued[stage.name]
+                    metrics.queue_wait += wait
+                    metrics.max_queue_wait = max(metrics.max_queue_wait, wait)
+                metrics.processed += len(batch)
+                metrics.failed += sum(error is not None for error in errors)
+
+            for task, error in zip(batch, errors):
+                task.item["stage_times"][stage.name] = {
+                    "queue": round(dequeued - task.enqueued[stage.name], 3),
+                    "resource_wait": round(started - dequeued, 3),
+                    "run": round(finished - started, 3),
+                    "batch": len(batch),
+                }
+                self._finish(stage, task, error)
+
+    def _finish(self, stage, task, error):
+        """Record that stage returned or skipped task and move task on."""
+        with task.lock:
+            task.pending -= 1
+            if task.error is None:
+                task.error = error
+            ready = []
+            if task.error is None:
+                task.done.add(stage.name)
+                ready = [
+                    dependent.name
+                    for dependent in self.dependents[stage.name]
+                    if all(dep in task.done for dep in dependent.deps)
+                ]
+                task.pending += len(ready)
+            resolved = task.pending == 0
+        for name in ready:
+            self._enqueue(name, task)
+        if resolved:
+            if task.error is not None:
+                task.future.set_exception(task.error)
+            else:
+                task.future.set_result(task.item)
+
+    def stats(self):
+        """Per stage counts, utilization of its workers and queue times in seconds."""
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        with self._metrics_lock:
+            return {
+                name: {
+                    "processed": metrics.processed,
+                    "failed": metrics.failed,
+                    "batches": metrics.batches,
+                    "queued": self.queues[name].qsize(),
+                    "utilization": round(metrics.busy / (elapsed * self.stages[name].workers), 4),
+                    "busy": round(metrics.busy, 3),
+                    "resource_wait": round(metrics.resource_wait, 3),
+                    "avg_queue_wait": round(metrics.queue_wait / metrics.processed, 3)
+                    if metrics.processed
+                    else 0.0,
+                    "max_queue_wait": round(metrics.max_queue_wait, 3),
+                }
+                for name, metrics in self.metrics.items()
+            }
+
+    def shutdown(self):
+        for name, stage in self.stages.items():
+            for _ in range(stage.workers):
+                self.queues[name].put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def format_stats(stats):
+    return ", ".join(
+        f"{name}: {s['processed']} done, {s['queued']} queued,"
+        f" {s['utilization']:.0%} busy, {s['avg_queue_wait']:.1f}s avg queue"
+        for name, s in stats.items()
+    )
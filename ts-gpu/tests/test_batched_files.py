@@ -0,0 +1,111 @@
+import copy
+import types
+
+import numpy as np
+import pytest
+
+whisperx_asr = pytest.importorskip("whisperx.asr")
+import faster_whisper.tokenizer
+import whisperx.vad
+from transcription_helpers import transcribe_batched, transcribe_batched_files
+
+
+class StubHfTokenizer:
+    def token_to_id(self, token):
+        return sum(map(ord, token))
+
+
+class StubPipeline(whisperx_asr.FasterWhisperPipeline):
+    """
+    The whisperx pipeline on a stub model: VAD cuts the audio into one second
+    segments and the text of a segment is the language and the sum of its samples.
+    """
+
+    def __init__(self, preset_language=None, multilingual=True, detected="de"):
+        # the transformers Pipeline setup is not needed by transcribe
+        self.model = types.SimpleNamespace(
+            hf_tokenizer=StubHfTokenizer(),
+            model=types.SimpleNamespace(is_multilingual=multilingual),
+        )
+        self.preset_language = preset_language
+        self.tokenizer = None
+        if preset_language is not None:
+            self.tokenizer = faster_whisper.tokenizer.Tokenizer(
+                self.model.hf_tokenizer, multilingual, task="transcribe", language=preset_language
+            )
+        self.options = object()
+        self.suppress_numerals = False
+        self._batch_size = None
+        self._vad_params = {"vad_onset": 0.5, "vad_offset": 0.363}
+        self.detected = detected
+        self.detections = 0
+
+    def vad_model(self, audio):
+        num_samples = audio["waveform"].shape[-1]
+        return [
+            {"start": start / 16000, "end": min(start + 16000, num_samples) / 16000}
+            for start in range(0, num_samples, 16000)
+        ]
+
+    def detect_language(self, audio):
+        if not self.model.model.is_multilingual:
+            # like CTranslate2 on an English-only model
+            raise RuntimeError("detect_language can only be called on multilingual models")
+        self.detections += 1
+        return self.detected
+
+    def __call__(self, inputs, batch_size=None, num_workers=0):
+        for item in inputs:
+            text = f"{self.tokenizer.language_code}:{float(item['inputs'].sum()):.1f}"
+            yield {"text": [text] if batch_size in [0, 1, None] else text}
+
+
+@pytest.fixture(autouse=True)
+def segments_as_cut(monkeypatch):
+    merge_chunks = lambda segments, chunk_size, onset, offset: segments
+    monkeypatch.setattr(whisperx.vad, "merge_chunks", merge_chunks)
+    monkeypatch.setattr(whisperx_asr, "merge_chunks", merge_chunks)
+
+
+def audios():
+    rng = np.random.default_rng(0)
+    return [rng.standard_normal(length).astype(np.float32) for length in (40000, 16000, 72000)]
+
+
+def single_file(whisper_model, audio, language, batch_size):
+    # like transcribe_audio, on a copy of the shared model, see get_whisper_model
+    return transcribe_batched(
+        audio, language, batch_size, "model", "int8", False, "cpu",
+        whisper_model=copy.copy(whisper_model),
+    )
+
+
+@pytest.mark.parametrize(
+    "preset_language, multilingual, language, expected",
+    [
+        # medium.en: whisperx presets English and the model can not detect
+        ("en", False, None, "en"),
+        ("fr", True, None, "fr"),
+        (None, True, None, "de"),
+        (None, True, "es", "es"),
+    ],
+)
+@pytest.mark.parametrize("batch_size", [1, 4])
+def test_batched_files_match_single_files(preset_language, multilingual, language, expected, batch_size):
+    whisper_model = StubPipeline(preset_language, multilingual)
+    batched = transcribe_batched_files(audios(), language, batch_size, whisper_model)
+    single = [
+        single_file(StubPipeline(preset_language, multilingual), audio, language, batch_size)
+        for audio in audios()
+    ]
+    assert batched == single
+    assert all(file_language == expected for _, file_language in batched)
+    assert [len(segments) for segments, _ in batched] == [3, 1, 5]
+
+
+def test_preset_language_is_not_detected_again():
+    whisper_model = StubPipeline("fr", True)
+    transcribe_batched_files(audios(), None, 4, whisper_model)
+    assert whisper_model.detections == 0
+    # the model is left as it was loaded
+    assert whisper_model.tokenizer.language_code == "fr"
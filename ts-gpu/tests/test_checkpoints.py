@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+import pytest
+from checkpoints import JobStages, get_stage_dir
+
+# the fields of faster_whisper.transcribe.Word
+Word = namedtuple("Word", ["start", "end", "word", "probability"])
+
+stages = ("audio", "transcribe", "align", "diarize", "punctuate")
+
+
+def job_args(**overrides):
+    args = {
+        "stem_mode": "auto",
+        "music_threshold": 0.1,
+        "compact": False,
+        "compact_min_gap": 5.0,
+        "model_name": "medium.en",
+        "language": None,
+        "batch_size": 0,
+        "suppress_numerals": False,
+        "shards": 1,
+        "diarization_mode": "auto",
+        "diarization_profile": "balanced",
+        "num_speakers": None,
+        "max_speakers": None,
+        "device": "cpu",
+        "punctuation_mode": "auto",
+        "punctuation_int8": False,
+        "from_stage": None,
+    }
+    args.update(overrides)
+    return argparse.Namespace(**args)
+
+
+@pytest.fixture
+def audio_file(tmp_path):
+    path = tmp_path / "call.wav"
+    path.write_bytes(b"RIFF" + bytes(range(256)) * 10)
+    return str(path)
+
+
+def run(audio_file, args, output="first"):
+    """
+    The stages a job with args runs again, in the order of the pipeline. A
+    stage that runs stores output, so the stages after it see a new input.
+    """
+    job = JobStages(audio_file, args)
+    rerun = set()
+    for stage in stages:
+        if job.load(stage) is None:
+            rerun.add(stage)
+            job.save(stage, {"stage": stage, "output": output})
+    return rerun
+
+
+def test_unchanged_inputs_reuse_every_stage(audio_file):
+    assert run(audio_file, job_args()) == set(stages)
+    assert run(audio_file, job_args()) == set()
+
+
+@pytest.mark.parametrize(
+    "overrides, rerun",
+    [
+        ({"model_name": "large-v3"}, {"transcribe", "align", "punctuate"}),
+        ({"language": "de"}, {"transcribe", "align", "punctuate"}),
+        ({"device": "cuda"}, {"align", "punctuate"}),
+        ({"diarization_profile": "fast"}, {"diarize"}),
+        ({"num_speakers": 2}, {"diarize"}),
+        ({"punctuation_mode": "always"}, {"punctuate"}),
+        ({"punctuation_int8": True}, {"punctuate"}),
+        ({"stem_mode": "never"}, set(stages)),
+        ({"compact": True}, set(stages)),
+    ],
+)
+def test_a_changed_arg_misses(audio_file, overrides, rerun):
+    run(audio_file, job_args())
+    assert run(audio_file, job_args(**overrides), output="second") == rerun
+
+
+def test_the_same_output_keeps_the_stages_after_it(audio_file):
+    run(audio_file, job_args())
+    # another model that transcribes the same words
+    assert run(audio_file, job_args(model_name="large-v3")) == {"transcribe"}
+
+
+def test_changed_audio_misses_everything(audio_file):
+    run(audio_file, job_args())
+    with open(audio_file, "ab") as f:
+        f.write(b"\0")
+    assert run(audio_file, job_args(), output="second") == set(stages)
+
+
+@pytest.mark.parametrize(
+    "from_stage, rerun",
+    [
+        ("transcribe", {"transcribe", "align", "punctuate"}),
+        ("align", {"align", "punctuate"}),
+        ("diarize", {"diarize"}),
+        ("punctuate", {"punctuate"}),
+    ],
+)
+def test_from_stage_reruns_the_stage_and_its_dependents(audio_file, from_stage, rerun):
+    run(audio_file, job_args())
+    # even when the stages produce the same output again
+    assert run(audio_file, job_args(from_stage=from_stage)) == rerun
+    # the next run without --from-stage reuses what that run stored
+    assert run(audio_file, job_args()) == set()
+
+
+def test_unused_objects_are_removed(audio_file):
+    run(audio_file, job_args())
+    run(audio_file, job_args(model_name="large-v3"), output="second")
+    stage_dir = get_stage_dir(audio_file)
+    with open(os.path.join(stage_dir, "stages.json")) as f:
+        live = {entry["object"] for entry in json.load(f).values()}
+    assert set(os.listdir(os.path.join(stage_dir, "objects"))) == live
+
+
+def test_restored_words_index_like_fresh_ones(audio_file):
+    segments = [
+        {
+            "start": 0.0,
+            "end": 1.5,
+            "text": " Hello there.",
+            "avg_logprob": np.float32(-0.25),
+            "words": [
+                Word(np.float64(0.0), 0.6, " Hello", np.float32(0.9)),
+                Word(0.6, np.float64(1.5), " there.", 0.8),
+            ],
+        }
+    ]
+    job = JobStages(audio_file, job_args())
+    job.save("transcribe", {"segments": segments, "language": "en"})
+    restored = JobStages(audio_file, job_args()).load("transcribe")
+
+    assert restored["language"] == "en"
+    (segment,) = restored["segments"]
+    assert segment["avg_logprob"] == pytest.approx(-0.25)
+    # align_words reads the words of unaligned languages by index
+    for fresh, word in zip(segments[0]["words"], segment["words"]):
+        assert [word[2], word[0], word[1]] == pytest.approx([fresh[2], fresh[0], fresh[1]])
+        assert word[3] == pytest.approx(fresh[3])
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from audio_helpers import OffsetMap, compaction_segments
+from benchmark import synthetic_hold_call
+
+
+def speech_samples_cut(segments, samples, speech):
+    kept = np.zeros(len(samples), dtype=bool)
+    for start, end in segments.tolist():
+        kept[start:end] = True
+    return sum(int((~kept[start:end]).sum()) for start, end in speech)
+
+
+@pytest.mark.parametrize(
+    "speech_level, noise_level",
+    [
+        (3000, 20),  # a normal call, speech around -25 dBFS
+        (60, 4),  # a quiet far end, speech around -58 dBFS over a quiet line
+        (20, 1),  # speech around -67 dBFS
+        (40, 0),  # quiet speech between digital silence
+    ],
+)
+def test_keeps_every_speech_sample(speech_level, noise_level):
+    rng = np.random.default_rng(0)
+    samples, speech = synthetic_hold_call(
+        rng, 10, speech_level=speech_level, noise_level=noise_level
+    )
+    segments = compaction_segments(samples)
+    assert speech_samples_cut(segments, samples, speech) == 0
+    # the dead air and hold music are still cut
+    assert OffsetMap(segments).compacted_length < 0.5 * len(samples)
+
+
+def test_low_level_speech_is_below_the_stemming_floor():
+    # the -50 dB floor speech_regions uses for stemming would cut the quiet call
+    rng = np.random.default_rng(0)
+    samples, speech = synthetic_hold_call(rng, 10, speech_level=60, noise_level=4)
+    segments = compaction_segments(samples, floor_db=-50.0)
+    assert speech_samples_cut(segments, samples, speech) > 0
+
+
+def test_short_audio_is_kept_whole():
+    samples = np.zeros(8000, dtype=np.int16)
+    assert compaction_segments(samples).tolist() == [[0, 8000]]
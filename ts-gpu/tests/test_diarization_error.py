@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from benchmark import diarization_error, read_reference_rttm
+
+
+def write_rttm(path, turns):
+    with open(path, "w") as f:
+        for start, end, speaker in turns:
+            f.write(
+                f"SPEAKER call 1 {start / 1000:.3f} {(end - start) / 1000:.3f}"
+                f" <NA> <NA> {speaker} <NA> <NA>\n"
+            )
+
+
+def test_read_reference_rttm_numbers_speakers_in_order(tmp_path):
+    path = tmp_path / "call.rttm"
+    write_rttm(path, [(0, 1500, "agent"), (1500, 4000, "caller"), (4000, 5000, "agent")])
+    turns = read_reference_rttm(path)
+    assert turns.tolist() == [[0, 1500, 0], [1500, 4000, 1], [4000, 5000, 0]]
+
+
+def test_relabelled_reference_has_no_error():
+    pytest.importorskip("scipy")
+    reference = np.array([[0, 3000, 0], [3000, 7000, 1], [7000, 9000, 2], [9000, 12000, 0]])
+    relabelled = reference.copy()
+    relabelled[:, 2] = relabelled[:, 2].max() - relabelled[:, 2]
+    error, speech = diarization_error(reference, relabelled)
+    assert error == 0
+    assert speech > 0
+
+
+def test_confused_and_missed_speech_is_counted():
+    pytest.importorskip("scipy")
+    reference = np.array([[0, 5000, 0], [5000, 10000, 1]])
+    # the second turn is given to the first speaker, and nothing after 8s
+    hypothesis = np.array([[0, 8000, 0]])
+    error, speech = diarization_error(reference, hypothesis, collar_ms=0)
+    assert speech == 1000
+    assert error == 500
@@ -0,0 +1,80 @@
+import os
+import runpy
+import subprocess
+import sys
+import threading
+import types
+import wave
+
+import numpy as np
+import pytest
+
+ts_gpu = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def fake_pipeline(monkeypatch, calls):
+    pipeline = types.ModuleType("pipeline")
+    pipeline.get_parser = lambda: calls.append("get_parser")
+    pipeline.diarize_audio = lambda *args, **kwargs: calls.append("diarize_audio")
+    monkeypatch.setitem(sys.modules, "pipeline", pipeline)
+    return pipeline
+
+
+@pytest.mark.parametrize("script", ["diarize.py", "diarize_parallel.py"])
+def test_spawned_import_of_an_entry_point_runs_nothing(script, monkeypatch):
+    # a spawned pool worker runs the main module of its parent as __mp_main__
+    calls = []
+    fake_pipeline(monkeypatch, calls)
+    runpy.run_path(os.path.join(ts_gpu, script), run_name="__mp_main__")
+    assert calls == []
+
+
+def test_spawned_import_of_the_worker_starts_no_threads(monkeypatch):
+    calls = []
+    pipeline = fake_pipeline(monkeypatch, calls)
+    for name in (
+        "JobReport", "diarize_files", "get_whisper_model", "prewarm_models", "whisper_model_loader"
+    ):
+        setattr(pipeline, name, None)
+    pipeline.create_diarization_graph = lambda *args, **kwargs: calls.append("graph")
+    model_cache = types.ModuleType("model_cache")
+    model_cache.ModelCache = lambda *args, **kwargs: calls.append("cache")
+    monkeypatch.setitem(sys.modules, "model_cache", model_cache)
+    monkeypatch.setitem(sys.modules, "audioread", types.ModuleType("audioread"))
+
+    threads = threading.active_count()
+    worker = runpy.run_path(os.path.join(ts_gpu, "ts-worker.py"), run_name="__mp_main__")
+    assert calls == []
+    assert worker["model_cache"] is None and worker["diarization_graph"] is None
+    assert threading.active_count() == threads
+
+
+def test_sharded_run_through_the_entry_point(tmp_path):
+    for module in ("torch", "whisperx", "faster_whisper", "nemo"):
+        pytest.importorskip(module)
+
+    # two shards need at least 2 x 300 seconds, test.wav with pauses in between
+    with wave.open(os.path.join(ts_gpu, "test.wav")) as f:
+        assert f.getframerate() == 16000 and f.getnchannels() == 1
+        speech = np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16)
+    pause = np.zeros(16000 * 5, dtype=np.int16)
+    repeats = int(650 * 16000 // (len(speech) + len(pause))) + 1
+    audio_file = str(tmp_path / "call.wav")
+    with wave.open(audio_file, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(16000)
+        f.writeframes(np.tile(np.concatenate([speech, pause]), repeats).tobytes())
+
+    run = subprocess.run(
+        [sys.executable, "diarize_parallel.py", "-a", audio_file, "--shards", "2", "--no-stem"],
+        cwd=ts_gpu,
+        capture_output=True,
+        text=True,
+        timeout=3600,
+    )
+    assert run.returncode == 0, run.stderr
+    assert "bootstrapping phase" not in run.stderr
+    assert "BrokenProcessPool" not in run.stderr
+    for ext in ("txt", "srt", "json"):
+        assert os.path.getsize(tmp_path / f"call.{ext}") > 0
@@ -0,0 +1,85 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip("inotify_simple")
+from folder_watcher import IncomingWatcher
+
+
+class RecordingQueue:
+    def __init__(self):
+        self.enqueued = []
+
+    def enqueue(self, kind, path):
+        self.enqueued.append((kind, os.path.basename(path)))
+        return len(self.enqueued)
+
+
+@pytest.fixture
+def watcher(tmp_path):
+    watcher = IncomingWatcher(RecordingQueue(), base_dir=str(tmp_path), settle=0.3)
+    watcher._watch_type_dir("diarize")
+    yield watcher
+    watcher.inotify.close()
+
+
+def pump(watcher, seconds=0.05):
+    """Handle the events and due folders of the next seconds, like run does."""
+    end = time.monotonic() + seconds
+    while True:
+        for event in watcher.inotify.read(timeout=int(seconds * 1000 / 5) or 1):
+            watcher._handle(event)
+        watcher._flush_pending()
+        if time.monotonic() >= end:
+            return watcher.queue.enqueued
+
+
+def write(path, data=b"x" * 1000):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_data_json_written_last_enqueues_at_once(watcher, tmp_path):
+    row = tmp_path / "diarize" / "1"
+    row.mkdir()
+    pump(watcher)
+    write(row / "call.wav")
+    write(row / "data.json", b"{}")
+    assert pump(watcher) == [("diarize", "1")]
+
+
+def test_data_json_waits_for_open_audio(watcher, tmp_path):
+    row = tmp_path / "diarize" / "2"
+    row.mkdir()
+    pump(watcher)
+    with open(row / "call.wav", "wb") as audio:
+        audio.write(b"x" * 1000)
+        audio.flush()
+        # an SFTP client that sends data.json first or in parallel
+        write(row / "data.json", b"{}")
+        assert pump(watcher, 0.6) == []
+        audio.write(b"x" * 1000)
+        audio.flush()
+        assert pump(watcher, 0.1) == []
+    assert pump(watcher, 0.1) == []
+    # enqueued once the audio is closed and the folder settled
+    assert pump(watcher, 0.5) == [("diarize", "2")]
+
+
+def test_found_row_with_data_json_settles_first(watcher, tmp_path):
+    row = tmp_path / "diarize" / "3"
+    row.mkdir()
+    write(row / "call.wav")
+    write(row / "data.json", b"{}")
+    watcher.rescan()
+    assert pump(watcher, 0.1) == []
+    assert pump(watcher, 0.4) == [("diarize", "3")]
+
+
+def test_moved_in_row_enqueues_at_once(watcher, tmp_path):
+    staging = tmp_path / "staging"
+    staging.mkdir()
+    write(staging / "call.wav")
+    os.rename(staging, tmp_path / "diarize" / "4")
+    assert pump(watcher) == [("diarize", "4")]
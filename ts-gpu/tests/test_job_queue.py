@@ -0,0 +1,184 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+from job_queue import DONE, FAILED, QUEUED, RUNNING, JobQueue, scan_incoming, worker_id
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "data" / "jobs.sqlite3")
+
+
+@pytest.fixture
+def row(tmp_path):
+    path = tmp_path / "incoming" / "diarize" / "1"
+    path.mkdir(parents=True)
+    (path / "call.wav").write_bytes(b"RIFF")
+    return str(path)
+
+
+def state(queue, job_id):
+    (job,) = [job for job in queue.jobs((QUEUED, RUNNING, DONE, FAILED)) if job["id"] == job_id]
+    return job
+
+
+def test_a_folder_is_queued_once(db_path, row):
+    queue = JobQueue(db_path)
+    job_id = queue.enqueue("diarize", row)
+    assert job_id is not None
+    assert queue.enqueue("diarize", row) is None
+    assert queue.enqueue("diarize", row + "/") is None
+    assert queue.claim("a")["id"] == job_id
+    # running jobs are not queued again either
+    assert queue.enqueue("diarize", row) is None
+    queue.complete(job_id)
+    assert queue.enqueue("diarize", row) is not None
+
+
+def test_a_missing_folder_is_not_queued(db_path, tmp_path):
+    assert JobQueue(db_path).enqueue("diarize", str(tmp_path / "gone")) is None
+
+
+def test_two_claimers_never_get_the_same_job(db_path, tmp_path):
+    queue = JobQueue(db_path)
+    for i in range(40):
+        path = tmp_path / "incoming" / "diarize" / str(i)
+        path.mkdir(parents=True)
+        queue.enqueue("diarize", str(path))
+    claimed = {"a": [], "b": []}
+    start = threading.Barrier(2)
+
+    def claimer(name):
+        # every claimer has its own connection, like the worker and transcribe.sh
+        claimer_queue = JobQueue(db_path)
+        start.wait()
+        while True:
+            job = claimer_queue.claim(name)
+            if job is None:
+                return
+            claimed[name].append(job["id"])
+
+    threads = [threading.Thread(target=claimer, args=(name,)) for name in claimed]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=60)
+
+    assert len(claimed["a"]) + len(claimed["b"]) == 40
+    assert not set(claimed["a"]) & set(claimed["b"])
+    jobs = queue.jobs((RUNNING,))
+    assert len(jobs) == 40
+    assert all(job["attempts"] == 1 for job in jobs)
+
+
+def test_two_processes_race_for_one_job(db_path, row):
+    queue = JobQueue(db_path)
+    job_id = queue.enqueue("diarize", row)
+    script = (
+        "import sys, time\n"
+        "from job_queue import JobQueue\n"
+        "queue = JobQueue(sys.argv[1])\n"
+        "time.sleep(max(float(sys.argv[2]) - time.time(), 0))\n"
+        "job = queue.claim(sys.argv[3])\n"
+        "print(job['id'] if job else '')\n"
+    )
+    start_at = str(time.time() + 1.0)
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    claimers = [
+        subprocess.Popen(
+            [sys.executable, "-c", script, db_path, start_at, name],
+            stdout=subprocess.PIPE,
+            text=True,
+            env=env,
+        )
+        for name in ("a", "b")
+    ]
+    results = sorted(claimer.communicate(timeout=60)[0].strip() for claimer in claimers)
+    assert results == ["", str(job_id)]
+    assert state(queue, job_id)["attempts"] == 1
+
+
+def test_failures_back_off_then_fail_for_good(db_path, row):
+    queue = JobQueue(db_path, retry_delay=0.2)
+    job_id = queue.enqueue("diarize", row, max_attempts=3)
+
+    for attempt in (1, 2):
+        job = queue.claim("a")
+        assert job["attempts"] == attempt
+        assert queue.fail(job_id, "boom") == QUEUED
+        # not claimable until the backoff of this attempt is over
+        assert queue.claim("a") is None
+        job = state(queue, job_id)
+        assert job["available_at"] - job["finished_at"] == pytest.approx(0.2 * attempt)
+        time.sleep(0.2 * attempt + 0.05)
+
+    assert queue.claim("a")["attempts"] == 3
+    assert queue.fail(job_id, "x" * 5000) == FAILED
+    job = state(queue, job_id)
+    assert job["state"] == FAILED and len(job["error"]) == 2000
+    assert queue.claim("a") is None
+    assert queue.depth()[FAILED] == 1
+
+    queue.retry(job_id)
+    job = queue.claim("a")
+    assert job["id"] == job_id and job["attempts"] == 1
+
+
+def test_a_failed_folder_is_queued_again_once_it_changed(db_path, row):
+    queue = JobQueue(db_path)
+    job_id = queue.enqueue("diarize", row, max_attempts=1)
+    queue.claim("a")
+    queue.fail(job_id, "boom")
+    assert queue.enqueue("diarize", row) is None
+    # uploaded again after the failure
+    later = time.time() + 5
+    os.utime(os.path.join(row, "call.wav"), (later, later))
+    new_id = queue.enqueue("diarize", row)
+    assert new_id not in (None, job_id)
+    assert queue.enqueue("diarize", row) is None
+
+
+def test_orphans_of_gone_workers_are_requeued(db_path, tmp_path):
+    queue = JobQueue(db_path)
+    gone = subprocess.Popen([sys.executable, "-c", "pass"])
+    gone.wait()
+    host = socket.gethostname()
+    workers = {
+        "alive": worker_id(),
+        "gone": worker_id(gone.pid, 0),
+        # the pid of this process, but started at another time: a restarted container
+        "reused pid": f"{host}:{os.getpid()}:1:0",
+        # written before workers had a start token
+        "legacy own pid": f"{host}:{os.getpid()}:0",
+        "other host": f"{host}-other:1:1:0",
+        "garbage": "not a worker",
+    }
+    jobs = {}
+    for name, worker in workers.items():
+        path = tmp_path / "incoming" / "diarize" / name.replace(" ", "-")
+        path.mkdir(parents=True)
+        jobs[name] = queue.enqueue("diarize", str(path))
+        assert queue.claim(worker)["id"] == jobs[name]
+
+    requeued = queue.requeue_orphans()
+    assert sorted(requeued) == sorted(
+        jobs[name] for name in ("gone", "reused pid", "legacy own pid", "garbage")
+    )
+    for name, job_id in jobs.items():
+        assert state(queue, job_id)["state"] == (QUEUED if job_id in requeued else RUNNING)
+    assert queue.requeue_orphans() == []
+
+
+def test_scan_enqueues_new_folders(db_path, tmp_path):
+    queue = JobQueue(db_path)
+    for kind, name in (("diarize", "1"), ("transcribe", "2"), ("other", "3")):
+        (tmp_path / kind / name).mkdir(parents=True)
+    (tmp_path / "diarize" / "file.wav").write_bytes(b"")
+    assert len(scan_incoming(queue, str(tmp_path))) == 2
+    assert scan_incoming(queue, str(tmp_path)) == []
+    assert sorted(job["kind"] for job in queue.jobs()) == ["diarize", "transcribe"]
@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+from audio_helpers import OffsetMap
+from helpers import get_words_speaker_mapping
+from word_table import WordTable
+
+# kept: 1-2 s, 5-6 s and 10-11 s of the original call, 0-3 s compacted
+segments = [[16000, 32000], [80000, 96000], [160000, 176000]]
+
+
+@pytest.mark.parametrize(
+    "compacted, original",
+    [
+        (0, 1000),
+        (500, 1500),
+        (999, 1999),
+        # a time on a cut is the start of the segment after it
+        (1000, 5000),
+        (1001, 5001),
+        (2000, 10000),
+        (2999, 10999),
+        # after the end of the compacted audio it goes on from the last segment
+        (3000, 11000),
+        (3500, 11500),
+    ],
+)
+def test_start_times(compacted, original):
+    assert OffsetMap(segments).to_original_ms(np.array([compacted]))[0] == original
+
+
+@pytest.mark.parametrize(
+    "compacted, original",
+    [
+        (0, 1000),
+        (500, 1500),
+        # an end on a cut is the end of the segment before it
+        (1000, 2000),
+        (1001, 5001),
+        (2000, 6000),
+        (3000, 11000),
+    ],
+)
+def test_end_times(compacted, original):
+    assert OffsetMap(segments).to_original_ms(np.array([compacted]), end=True)[0] == original
+
+
+def test_without_cuts_times_only_shift():
+    offsets = OffsetMap([[8000, 48000]])
+    ms = np.array([0, 1, 1234, 2500], dtype=np.int32)
+    assert offsets.to_original_ms(ms).tolist() == [500, 501, 1734, 3000]
+    assert offsets.to_original_ms(ms, end=True).tolist() == [500, 501, 1734, 3000]
+    assert offsets.compacted_length == 40000
+
+
+def test_dtype_and_shape_are_kept():
+    turns = np.array([[0, 1000, 0], [1000, 2500, 1]], dtype=np.int64)
+    mapped = OffsetMap(segments).to_original_ms(turns[:, :2])
+    assert mapped.dtype == np.int64 and mapped.shape == (2, 2)
+    words = np.array([0, 1500], dtype=np.int32)
+    assert OffsetMap(segments).to_original_ms(words).dtype == np.int32
+
+
+def test_times_stay_in_whole_milliseconds():
+    # the second segment starts 0.5 ms into the original
+    offsets = OffsetMap([[0, 16000], [16008, 32008]])
+    ms = np.arange(1000, 2000, 7, dtype=np.float64)
+    mapped = offsets.to_original_ms(ms)
+    assert (mapped == np.rint(mapped)).all()
+    assert np.abs(mapped - (ms + 0.5)).max() <= 0.5
+
+
+def remap(offsets, words, speaker_ts):
+    # like pipeline._write_stage
+    words = words.replace(
+        start=offsets.to_original_ms(words.start),
+        end=offsets.to_original_ms(words.end, end=True),
+    )
+    speaker_ts = speaker_ts.copy()
+    speaker_ts[:, 0] = offsets.to_original_ms(speaker_ts[:, 0])
+    speaker_ts[:, 1] = offsets.to_original_ms(speaker_ts[:, 1], end=True)
+    return words, speaker_ts
+
+
+def test_words_and_turns_at_a_cut():
+    offsets = OffsetMap(segments)
+    words = WordTable.from_word_timestamps(
+        [
+            {"word": "hello", "start": 0.2, "end": 0.6},
+            {"word": "there.", "start": 0.6, "end": 1.0},
+            {"word": "hi,", "start": 1.0, "end": 1.4},
+            {"word": "yes.", "start": 2.1, "end": 2.6},
+        ]
+    )
+    speaker_ts = np.array([[0, 1000, 0], [1000, 2000, 1], [2000, 3000, 0]], dtype=np.int64)
+    words, speaker_ts = remap(offsets, words, speaker_ts)
+
+    # nothing that ends on a cut reaches over the gap
+    assert words.start.tolist() == [1200, 1600, 5000, 10100]
+    assert words.end.tolist() == [1600, 2000, 5400, 10600]
+    assert speaker_ts.tolist() == [[1000, 2000, 0], [5000, 6000, 1], [10000, 11000, 0]]
+    mapped = get_words_speaker_mapping(words, speaker_ts, "start")
+    assert mapped.speaker.tolist() == [0, 0, 1, 0]
+
+
+def test_a_word_and_a_turn_across_a_cut_span_the_gap():
+    offsets = OffsetMap(segments)
+    words = WordTable.from_word_timestamps(
+        [
+            {"word": "so", "start": 0.5, "end": 0.8},
+            # starts before the first cut and ends after it
+            {"word": "anyway,", "start": 0.9, "end": 1.2},
+            {"word": "right.", "start": 1.3, "end": 1.6},
+        ]
+    )
+    # one turn from before the cut to after it
+    speaker_ts = np.array([[400, 1700, 1]], dtype=np.int64)
+    words, speaker_ts = remap(offsets, words, speaker_ts)
+
+    assert words.start.tolist() == [1500, 1900, 5300]
+    assert words.end.tolist() == [1800, 5200, 5600]
+    assert speaker_ts.tolist() == [[1400, 5700, 1]]
+    mapped = get_words_speaker_mapping(words, speaker_ts, "start")
+    assert mapped.speaker.tolist() == [1, 1, 1]
@@ -0,0 +1,53 @@
+import random
+
+from benchmark import reference_get_sentences_speaker_mapping
+from helpers import get_sentences_speaker_mapping
+from word_table import WordTable
+
+# words that exercise Punkt: abbreviations, initials, numbers, ellipses that
+# can span words, quotes and brackets after periods, blanks and newlines
+tricky_words = [
+    "so", "the", "Call", "hello", "Hello", "yes,", "fine.", "ok?", "no!", "U.S.A.",
+    "Dr.", "J.", "3.", "42", ".", ". .", "...", "..", "e.g.", "a.b", "x.\n", "",
+    " ", "end.\"", "(yes.)", "--", "...ok", ".5", "well...", "i.", "A.", "1.5.",
+    "'quote.'", "no.)", ";", ":",
+]
+
+
+def random_stream(rng):
+    num_speakers = rng.randrange(1, 4)
+    return [
+        {
+            "word": rng.choice(tricky_words),
+            "start_time": i * 300,
+            "end_time": i * 300 + 250,
+            "speaker": rng.randrange(num_speakers) if rng.random() < 0.1 else 0,
+        }
+        for i in range(rng.randrange(1, 80))
+    ]
+
+
+def test_matches_reference():
+    rng = random.Random(0)
+    for _ in range(2000):
+        wsm = random_stream(rng)
+        spk_ts = [[0, 1000, wsm[0]["speaker"]]]
+        expected = reference_get_sentences_speaker_mapping(wsm, spk_ts)
+        assert get_sentences_speaker_mapping(wsm, spk_ts) == expected
+        assert get_sentences_speaker_mapping(WordTable.from_dicts(wsm), spk_ts) == expected
+
+
+def test_speaker_names():
+    wsm = [
+        {"word": "hello.", "start_time": 0, "end_time": 250, "speaker": 0},
+        {"word": "hi.", "start_time": 300, "end_time": 550, "speaker": 1},
+        {"word": "bye.", "start_time": 600, "end_time": 850, "speaker": 2},
+    ]
+    sentences = get_sentences_speaker_mapping(
+        wsm, [[0, 1000, 0]], speaker_names={0: "Agent", 1: "Customer"}
+    )
+    assert [sentence["speaker"] for sentence in sentences] == [
+        "Agent",
+        "Customer",
+        "Speaker 2",
+    ]
@@ -0,0 +1,59 @@
+import os
+import random
+
+import pytest
+from benchmark import (
+    reference_get_words_speaker_mapping,
+    reference_read_speaker_ts,
+    synthetic_transcript,
+    write_rttm,
+)
+from helpers import get_words_speaker_mapping, read_rttm
+from word_table import WordTable
+
+
+def shuffled_words(words, rng, swaps):
+    # whisperx can give a word a start before the one of the word in front of it,
+    # which takes the turn pointer path of get_words_speaker_mapping
+    words = [dict(word) for word in words]
+    for _ in range(swaps):
+        i = rng.randrange(len(words) - 1)
+        for key in ("start", "end"):
+            words[i][key], words[i + 1][key] = words[i + 1][key], words[i][key]
+    return words
+
+
+def test_read_rttm_matches_reference(tmp_path):
+    _, spk_ts = synthetic_transcript(hours=1, num_words=100)
+    rttm_path = os.path.join(tmp_path, "mono_file.rttm")
+    write_rttm(rttm_path, spk_ts)
+    assert read_rttm(rttm_path).tolist() == reference_read_speaker_ts(rttm_path)
+
+
+@pytest.mark.parametrize("option", ["start", "mid", "end"])
+def test_matches_reference(option):
+    for seed in range(30):
+        rng = random.Random(seed)
+        words, spk_ts = synthetic_transcript(
+            hours=rng.uniform(0.01, 0.2),
+            num_words=rng.randrange(2, 400),
+            num_speakers=rng.randrange(1, 5),
+            seed=seed,
+        )
+        if seed % 2:
+            words = shuffled_words(words, rng, swaps=len(words) // 10)
+        expected = reference_get_words_speaker_mapping(words, spk_ts, option)
+        assert get_words_speaker_mapping(words, spk_ts, option) == expected
+        table = get_words_speaker_mapping(WordTable.from_word_timestamps(words), spk_ts, option)
+        assert table.to_dicts() == expected
+
+
+def test_words_after_the_last_turn_get_its_speaker():
+    words = [
+        {"word": "so", "start": 0.1, "end": 0.3},
+        {"word": "late", "start": 5.0, "end": 5.2},
+    ]
+    spk_ts = [[0, 1000, 0], [1000, 2000, 1]]
+    result = get_words_speaker_mapping(words, spk_ts)
+    assert [word["speaker"] for word in result] == [0, 1]
+    assert result == reference_get_words_speaker_mapping(words, spk_ts)
@@ -0,0 +1,226 @@
+import threading
+import time
+
+import pytest
+from stage_graph import Stage, StageGraph
+
+# the shape of the diarization graph of pipeline.create_diarization_graph
+deps = {
+    "prepare": (),
+    "transcribe": ("prepare",),
+    "align": ("transcribe",),
+    "diarize": ("prepare",),
+    "punctuate": ("align",),
+    "write": ("diarize", "punctuate"),
+}
+
+
+class Recorder:
+    """Stage functions that record the stages every item ran and how many ran at once."""
+
+    def __init__(self, seconds=0.01):
+        self.seconds = seconds
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.batches = []
+
+    def stage(self, name, resource=None, fail=None):
+        def run(items):
+            with self.lock:
+                self.batches.append((name, len(items)))
+                if resource:
+                    self.running += 1
+                    self.max_running = max(self.max_running, self.running)
+                for item in items:
+                    item["log"].append(name)
+            time.sleep(self.seconds)
+            with self.lock:
+                if resource:
+                    self.running -= 1
+            return [fail(item) if fail else None for item in items]
+
+        return run
+
+
+def diarization_graph(recorder, model_slots=2, fail=None, **stage_args):
+    model_stages = ("transcribe", "align", "diarize", "punctuate")
+    return StageGraph(
+        [
+            Stage(
+                name,
+                recorder.stage(
+                    name,
+                    resource=name in model_stages,
+                    fail=fail if name == "diarize" else None,
+                ),
+                deps=stage_deps,
+                resource="model" if name in model_stages else None,
+                **stage_args.get(name, {}),
+            )
+            for name, stage_deps in deps.items()
+        ],
+        resources={"model": model_slots},
+    )
+
+
+def test_stages_run_after_their_dependencies():
+    recorder = Recorder()
+    graph = diarization_graph(recorder, prepare={"workers": 2}, write={"workers": 2})
+    try:
+        futures = [graph.submit({"file": i, "log": []}) for i in range(6)]
+        items = [future.result(timeout=30) for future in futures]
+    finally:
+        graph.shutdown()
+    for item in items:
+        log = item["log"]
+        assert sorted(log) == sorted(deps)
+        for name, stage_deps in deps.items():
+            assert all(log.index(dep) < log.index(name) for dep in stage_deps)
+        assert set(item["stage_times"]) == set(deps)
+
+
+@pytest.mark.parametrize("model_slots", [1, 2])
+def test_model_stages_share_the_slots(model_slots):
+    recorder = Recorder(seconds=0.02)
+    # more workers than slots, so the slots are the limit
+    graph = diarization_graph(
+        recorder,
+        model_slots=model_slots,
+        transcribe={"workers": 3},
+        diarize={"workers": 3},
+    )
+    try:
+        futures = [graph.submit({"file": i, "log": []}) for i in range(8)]
+        for future in futures:
+            future.result(timeout=30)
+    finally:
+        graph.shutdown()
+    assert recorder.max_running == model_slots
+
+
+def test_waiting_items_are_batched():
+    recorder = Recorder()
+    gate = threading.Event()
+
+    def prepare(items):
+        # holds the items back until all of them wait for transcription
+        gate.wait()
+
+    graph = StageGraph(
+        [
+            Stage("prepare", prepare, workers=4),
+            Stage("transcribe", recorder.stage("transcribe"), deps=("prepare",), batch_size=3),
+        ]
+    )
+    try:
+        futures = [graph.submit({"file": i, "log": []}) for i in range(7)]
+        time.sleep(0.1)
+        gate.set()
+        for future in futures:
+            future.result(timeout=30)
+    finally:
+        graph.shutdown()
+    sizes = [size for name, size in recorder.batches if name == "transcribe"]
+    assert sum(sizes) == 7
+    assert max(sizes) <= 3
+
+
+def test_a_failed_item_stops_only_itself():
+    recorder = Recorder()
+    graph = diarization_graph(
+        recorder, fail=lambda item: ValueError("bad audio") if item["file"] == 1 else None
+    )
+    try:
+        futures = [graph.submit({"file": i, "log": []}) for i in range(3)]
+        with pytest.raises(ValueError):
+            futures[1].result(timeout=30)
+        assert futures[0].result(timeout=30)["log"][-1] == "write"
+        assert futures[2].result(timeout=30)["log"][-1] == "write"
+    finally:
+        graph.shutdown()
+    stats = graph.stats()
+    assert stats["diarize"]["failed"] == 1
+    assert stats["write"]["processed"] == 2
+
+
+def test_unknown_dependency():
+    with pytest.raises(ValueError):
+        StageGraph([Stage("write", lambda items: None, deps=("diarize",))])
+
+
+def test_a_failed_item_waits_for_its_running_stages():
+    diarize_started = threading.Event()
+    diarize_returned = threading.Event()
+    calls = []
+
+    def diarize(items):
+        diarize_started.set()
+        time.sleep(0.3)
+        diarize_returned.set()
+
+    def transcribe(items):
+        # fails while the diarize branch of the same item is still running
+        diarize_started.wait()
+        raise ValueError("bad audio")
+
+    def stage(name):
+        return lambda items: calls.append(name)
+
+    graph = StageGraph(
+        [
+            Stage("prepare", stage("prepare")),
+            Stage("transcribe", transcribe, deps=("prepare",)),
+            Stage("align", stage("align"), deps=("transcribe",)),
+            Stage("diarize", diarize, deps=("prepare",)),
+            Stage("write", stage("write"), deps=("diarize", "align")),
+        ]
+    )
+    try:
+        future = graph.submit({})
+        with pytest.raises(ValueError):
+            future.result(timeout=30)
+        assert diarize_returned.is_set()
+    finally:
+        graph.shutdown()
+    assert calls == ["prepare"]
+    assert graph.stats()["transcribe"]["failed"] == 1
+
+
+def test_queued_stages_of_a_failed_item_are_skipped():
+    recorder = Recorder()
+    diarize_started = threading.Event()
+    gate = threading.Event()
+
+    def diarize(items):
+        diarize_started.set()
+        gate.wait()
+
+    def transcribe(items):
+        diarize_started.wait()
+        return [ValueError("bad audio")]
+
+    graph = StageGraph(
+        [
+            Stage("prepare", recorder.stage("prepare")),
+            Stage("transcribe", transcribe, deps=("prepare",)),
+            # the diarize worker is busy with the first item, the second one waits
+            Stage("diarize", diarize, deps=("prepare",)),
+            Stage("write", recorder.stage("write"), deps=("diarize", "transcribe")),
+        ]
+    )
+    try:
+        futures = [graph.submit({"log": []}) for _ in range(2)]
+        time.sleep(0.2)
+        # the first item is still diarized, the diarize stage of the second is queued
+        assert not any(future.done() for future in futures)
+        gate.set()
+        for future in futures:
+            with pytest.raises(ValueError):
+                future.result(timeout=30)
+    finally:
+        gate.set()
+        graph.shutdown()
+    assert graph.stats()["transcribe"]["failed"] == 2
+    assert graph.stats()["diarize"]["processed"] == 1
+    assert graph.stats()["write"]["processed"] == 0
@@ -0,0 +1,34 @@
+import copy
+import random
+
+import pytest
+from benchmark import random_word_segments, reference_filter_missing_timestamps
+from helpers import filter_missing_timestamps
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_matches_reference(seed):
+    rng = random.Random(seed)
+    for _ in range(500):
+        segments = random_word_segments(
+            rng, rng.randrange(1, 60), rng.choice([0.05, 0.3, 0.8]), rng.choice([1, 3, 20])
+        )
+        initial, final = rng.choice([None, 0.5]), rng.choice([None, 99.0])
+        original = copy.deepcopy(segments)
+        result = filter_missing_timestamps(segments, initial, final)
+        # the reference fills in the segments it is given, the current one copies
+        assert segments == original
+        expected = reference_filter_missing_timestamps(copy.deepcopy(segments), initial, final)
+        assert result == expected
+
+
+def test_unaligned_words_between_aligned_ones():
+    segments = [
+        {"word": "so", "start": 1.0, "end": 1.5, "score": 0.9},
+        {"word": "1995"},
+        {"word": "%"},
+        {"word": "call", "start": 3.0, "end": 3.5, "score": 0.9},
+    ]
+    result = filter_missing_timestamps(segments, 0, None)
+    assert result == reference_filter_missing_timestamps(copy.deepcopy(segments), 0, None)
+    assert all("start" in word and "end" in word for word in result)
@@ -0,0 +1,41 @@
+import os
+
+import token_cache
+from benchmark import SyntheticTokenizer
+from helpers import find_numeral_symbol_tokens
+
+
+def test_numeral_tokens_from_scan_disk_and_memory(tmp_path, monkeypatch):
+    cache_dir = os.path.join(tmp_path, "tokens")
+    monkeypatch.setenv("TS_TOKEN_CACHE_DIR", cache_dir)
+    token_cache.clear_token_cache()
+    tokenizer = SyntheticTokenizer(5000)
+    expected = [-1] + [
+        token_id
+        for token, token_id in tokenizer.get_vocab().items()
+        if any(c in "0123456789%$£" for c in token)
+    ]
+
+    assert find_numeral_symbol_tokens(tokenizer, "org/model") == expected
+    assert len(os.listdir(cache_dir)) == 1
+    token_cache._memory.clear()
+    assert find_numeral_symbol_tokens(tokenizer, "org/model") == expected
+    assert find_numeral_symbol_tokens(tokenizer, "org/model") == expected
+
+    token_cache.clear_token_cache()
+    assert not os.path.exists(cache_dir)
+
+
+def test_changed_vocabulary_gets_its_own_entry(tmp_path, monkeypatch):
+    monkeypatch.setenv("TS_TOKEN_CACHE_DIR", str(tmp_path))
+    token_cache.clear_token_cache()
+    first, second = SyntheticTokenizer(500, seed=0), SyntheticTokenizer(500, seed=1)
+    find_numeral_symbol_tokens(first, "model")
+    token_cache._memory.clear()
+    result = find_numeral_symbol_tokens(second, "model")
+    assert result == [-1] + [
+        token_id
+        for token, token_id in second.get_vocab().items()
+        if any(c in "0123456789%$£" for c in token)
+    ]
+    token_cache.clear_token_cache()
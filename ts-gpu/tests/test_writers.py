@@ -0,0 +1,20 @@
+import os
+import random
+
+import pytest
+from benchmark import random_sentences, reference_write_outputs
+from helpers import write_outputs
+
+
+@pytest.mark.parametrize("num_sentences", [1, 2, 17, 500])
+def test_outputs_match_reference(tmp_path, num_sentences):
+    metadata = {"audio_duration": num_sentences * 4.25, "stemming": {"mode": "auto", "score": 0.1}}
+    reference_base = os.path.join(tmp_path, "reference")
+    current_base = os.path.join(tmp_path, "current")
+    ssm = list(random_sentences(random.Random(num_sentences), num_sentences))
+    reference_write_outputs(ssm, reference_base, metadata)
+    # the writers take the sentences as a stream
+    write_outputs(iter(ssm), current_base + ".wav", metadata, buffer_size=64)
+    for ext in ("txt", "srt", "json"):
+        with open(f"{reference_base}.{ext}", "rb") as f, open(f"{current_base}.{ext}", "rb") as g:
+            assert f.read() == g.read(), ext
@@ -0,0 +1,84 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+
+# On-disk cache of token id lists derived from a tokenizer vocabulary, such as
+# the numeral and symbol tokens suppressed by --suppress_numerals. Scanning the
+# vocabulary takes seconds, so the list is stored per model name and
+# tokenizer hash and kept in memory once loaded. Run
+# `python token_cache.py --clear` to invalidate it.
+
+# bump when the way a token list is computed changes
+cache_version = 1
+
+_memory = {}
+_lock = threading.Lock()
+
+
+def get_cache_dir():
+    return os.environ.get("TS_TOKEN_CACHE_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "transcriptionstream", "tokens"
+    )
+
+
+def tokenizer_hash(hf_tokenizer):
+    """Hash of a tokenizers.Tokenizer, so a changed vocabulary gets a new entry."""
+    return hashlib.sha1(hf_tokenizer.to_str().encode()).hexdigest()[:16]
+
+
+def cached_token_ids(name, model_name, hf_tokenizer, compute):
+    """
+    Return the token id list compute() gives for hf_tokenizer, from memory, from
+    disk or by calling compute once and storing the result.
+    """
+    # the tokenizer is kept in the value, so its id can not be reused
+    key = (name, model_name, id(hf_tokenizer))
+    with _lock:
+        if key in _memory:
+            return list(_memory[key][1])
+
+    safe_model_name = str(model_name).replace("/", "--")
+    path = os.path.join(
+        get_cache_dir(),
+        f"{name}-{safe_model_name}-{tokenizer_hash(hf_tokenizer)}-v{cache_version}.json",
+    )
+    try:
+        with open(path) as f:
+            token_ids = json.load(f)
+    except (OSError, ValueError):
+        token_ids = compute()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(token_ids, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            logging.warning(f"Could not write the token cache {path}", exc_info=True)
+
+    with _lock:
+        _memory[key] = (hf_tokenizer, token_ids)
+    return list(token_ids)
+
+
+def clear_token_cache():
+    with _lock:
+        _memory.clear()
+    shutil.rmtree(get_cache_dir(), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="cached tokenizer token lists")
+    parser.add_argument("--clear", action="store_true", help="delete the cache")
+    args = parser.parse_args()
+    if args.clear:
+        clear_token_cache()
+        print(f"cleared {get_cache_dir()}")
+    else:
+        print(get_cache_dir())
+        for name in sorted(os.listdir(get_cache_dir())) if os.path.isdir(get_cache_dir()) else []:
+            print(f"  {name}")
@@ -8,21 +8,24 @@
 ##  the next transcription kickoff without waiting for the summary to finish. Summaries
 ##  will be automatically created for transcriptions missing them.
 
+## incoming folders are claimed from the job queue (job_queue.py) instead of walked
+##  with globs, so concurrent runs of this script never pick up the same rowId.
+
 # Define the root directory and subdirectories
 root_dir="/transcriptionstream/incoming/"
 transcribed_dir="/transcriptionstream/transcribed/"
-sub_dirs=("diarize" "transcribe")
+job_queue="python3 /root/scripts/job_queue.py"
 
 # Define supported audio file extensions
 audio_extensions=("wav" "mp3" "flac" "ogg")
 
-# Loop over each subdirectory
-for sub_dir in "${sub_dirs[@]}"; do
-    type_dir="$root_dir$sub_dir/"
-    for incoming_dir in "$type_dir"*/ ; do
-        [ -L "${d%/}" ] && continue
+$job_queue scan > /dev/null
 
+# Loop over each claimed job
+while read -r job_id sub_dir incoming_dir <<< "$($job_queue claim)" && [ -n "$job_id" ]; do
+        incoming_dir="${incoming_dir%/}/"
         row_id=$(basename $incoming_dir)
+        failed=0
 
         # Loop over each audio file extension
         for ext in "${audio_extensions[@]}"; do
@@ -45,16 +48,25 @@ for sub_dir in "${sub_dirs[@]}"; do
                     echo "--- diarizing $audio_file..." >> /proc/1/fd/1
                     diarize_start_time=$(date +%s)
                     python3 diarize_parallel.py --batch-size 16 --whisper-model $DIARIZATION_MODEL -a "$audio_file"
+                    status=$?
                     diarize_end_time=$(date +%s)
                     run_time=$((diarize_end_time - diarize_start_time))
                 elif [ "$sub_dir" == "transcribe" ]; then
                     echo "--- transcribing $audio_file..." >> /proc/1/fd/1
                     whisper_start_time=$(date +%s)
                     whisperx --batch_size 12 --model $TRANSCRIPTION_MODEL --output_dir "$new_dir" > "$new_dir/$base_name.txt" "$audio_file"
+                    status=$?
                     whisper_end_time=$(date +%s)
                     run_time=$((whisper_end_time - whisper_start_time))
                 fi
 
+                # leave the audio in incoming so the retry picks it up again
+                if [ $status -ne 0 ]; then
+                    echo "--- failed processing $audio_file" >> /proc/1/fd/1
+                    failed=1
+                    continue
+                fi
+
                 # Move all files with the same base_name to the new subdirectory
                 mv "$incoming_dir$base_name"* "$new_dir/"
 
@@ -77,6 +89,11 @@ for sub_dir in "${sub_dirs[@]}"; do
             done
         done
 
+        if [ $failed -ne 0 ]; then
+            $job_queue fail $job_id "processing failed in transcribe.sh" > /dev/null
+            continue
+        fi
+
         data_file="data.json"
         if [ -e "$incoming_dir$data_file" ]
         then
@@ -85,5 +102,5 @@ for sub_dir in "${sub_dirs[@]}"; do
         fi
 
         rm -rf $incoming_dir
-    done
+        $job_queue done $job_id
 done
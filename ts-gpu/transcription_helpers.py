@@ -1,28 +1,85 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import torch
 
 
-def transcribe(
-    audio_file: str,
-    language: str,
-    model_name: str,
-    compute_dtype: str,
-    suppress_numerals: bool,
-    device: str,
+def load_whisper_model(
+    model_name: str, compute_dtype: str, device: str, cpu_threads: int = 0
 ):
     from faster_whisper import WhisperModel
-    from helpers import find_numeral_symbol_tokens, wav2vec2_langs
 
     # Faster Whisper non-batched
     # Run on GPU with FP16
-    whisper_model = WhisperModel(model_name, device=device, compute_type=compute_dtype)
+    return WhisperModel(
+        model_name, device=device, compute_type=compute_dtype, cpu_threads=cpu_threads
+    )
 
     # or run on GPU with INT8
     # model = WhisperModel(model_size, device="cuda", compute_type="int8_float16")
     # or run on CPU with INT8
     # model = WhisperModel(model_size, device="cpu", compute_type="int8")
 
+
+def load_batched_whisper_model(
+    model_name: str,
+    compute_dtype: str,
+    suppress_numerals: bool,
+    device: str,
+    cpu_threads: int = None,
+    model=None,
+):
+    import whisperx
+    from helpers import find_whisperx_numeral_symbol_tokens
+
+    kwargs = {} if cpu_threads is None else {"threads": cpu_threads}
+    if model is not None:
+        # a loaded faster-whisper WhisperModel, e.g. the shared CPU serving one
+        kwargs["model"] = model
+    # Faster Whisper batched
+    whisper_model = whisperx.load_model(
+        model_name,
+        device,
+        compute_type=compute_dtype,
+        asr_options={"suppress_numerals": suppress_numerals},
+        **kwargs,
+    )
+    if suppress_numerals:
+        # suppress the cached numeral tokens once here instead of letting
+        # whisperx scan the vocabulary again on every transcribe call
+        numeral_symbol_tokens = find_whisperx_numeral_symbol_tokens(
+            whisper_model, model_name
+        )
+        whisper_model.options = whisper_model.options._replace(
+            suppress_tokens=list(
+                set(numeral_symbol_tokens + whisper_model.options.suppress_tokens)
+            )
+        )
+        whisper_model.suppress_numerals = False
+    return whisper_model
+
+
+def transcribe(
+    audio_file,
+    language: str,
+    model_name: str,
+    compute_dtype: str,
+    suppress_numerals: bool,
+    device: str,
+    whisper_model=None,
+):
+    from helpers import find_numeral_symbol_tokens, wav2vec2_langs
+
+    # a resident model is owned by the caller and is not released here
+    resident = whisper_model is not None
+    if not resident:
+        whisper_model = load_whisper_model(model_name, compute_dtype, device)
+
     if suppress_numerals:
-        numeral_symbol_tokens = find_numeral_symbol_tokens(whisper_model.hf_tokenizer)
+        numeral_symbol_tokens = find_numeral_symbol_tokens(
+            whisper_model.hf_tokenizer, model_name
+        )
     else:
         numeral_symbol_tokens = None
 
@@ -43,31 +100,251 @@ def transcribe(
     for segment in segments:
         whisper_results.append(segment._asdict())
     # clear gpu vram
-    del whisper_model
-    torch.cuda.empty_cache()
+    if not resident:
+        del whisper_model
+        torch.cuda.empty_cache()
     return whisper_results, info.language
 
 
 def transcribe_batched(
-    audio_file: str,
+    audio_file,
     language: str,
     batch_size: int,
     model_name: str,
     compute_dtype: str,
     suppress_numerals: bool,
     device: str,
+    whisper_model=None,
 ):
     import whisperx
 
-    # Faster Whisper batched
-    whisper_model = whisperx.load_model(
-        model_name,
-        device,
-        compute_type=compute_dtype,
-        asr_options={"suppress_numerals": suppress_numerals},
-    )
-    audio = whisperx.load_audio(audio_file)
+    resident = whisper_model is not None
+    if not resident:
+        whisper_model = load_batched_whisper_model(
+            model_name, compute_dtype, suppress_numerals, device
+        )
+    # audio_file can also be an already decoded 16 kHz float32 array
+    if isinstance(audio_file, str):
+        audio = whisperx.load_audio(audio_file)
+    else:
+        audio = audio_file
     result = whisper_model.transcribe(audio, language=language, batch_size=batch_size)
-    del whisper_model
-    torch.cuda.empty_cache()
+    if not resident:
+        del whisper_model
+        torch.cuda.empty_cache()
     return result["segments"], result["language"]
+
+
+
+def transcribe_batched_files(audios, language: str, batch_size: int, whisper_model, chunk_size=30):
+    """
+    transcribe_batched for several decoded files with one resident whisperx
+    model. The VAD segments of all files with the same language are packed
+    into the same batches instead of leaving a partial batch at the end of
+    every file. Every segment is padded to 30 seconds on its own, so the
+    result of each file is the same as transcribing it alone.
+
+    Returns a (segments, language) tuple per file.
+    """
+    import faster_whisper
+    from whisperx.audio import SAMPLE_RATE
+    from whisperx.vad import merge_chunks
+
+    files = []
+    for audio in audios:
+        vad_segments = whisper_model.vad_model(
+            {"waveform": torch.from_numpy(audio).unsqueeze(0), "sample_rate": SAMPLE_RATE}
+        )
+        vad_segments = merge_chunks(
+            vad_segments,
+            chunk_size,
+            onset=whisper_model._vad_params["vad_onset"],
+            offset=whisper_model._vad_params["vad_offset"],
+        )
+        # like transcribe: the language of the call, else the one the model
+        # was loaded with (English for .en models, which can not detect it),
+        # else the one detected for this file on its own
+        files.append(
+            (
+                audio,
+                vad_segments,
+                language
+                or whisper_model.preset_language
+                or whisper_model.detect_language(audio),
+            )
+        )
+
+    results = [None] * len(files)
+    previous_tokenizer = whisper_model.tokenizer
+    previous_options = whisper_model.options
+    try:
+        for file_language in dict.fromkeys(f[2] for f in files):
+            members = [i for i, f in enumerate(files) if f[2] == file_language]
+            whisper_model.tokenizer = faster_whisper.tokenizer.Tokenizer(
+                whisper_model.model.hf_tokenizer,
+                whisper_model.model.model.is_multilingual,
+                task="transcribe",
+                language=file_language,
+            )
+            # the numeral tokens are already part of the options, see
+            # load_batched_whisper_model
+            whisper_model.options = previous_options
+
+            order = [(i, seg) for i in members for seg in files[i][1]]
+
+            def data():
+                for i, seg in order:
+                    f1 = int(seg["start"] * SAMPLE_RATE)
+                    f2 = int(seg["end"] * SAMPLE_RATE)
+                    yield {"inputs": files[i][0][f1:f2]}
+
+            segments = {i: [] for i in members}
+            for (i, seg), out in zip(
+                order, whisper_model(data(), batch_size=batch_size, num_workers=0)
+            ):
+                text = out["text"]
+                if batch_size in [0, 1, None]:
+                    text = text[0]
+                segments[i].append(
+                    {
+                        "text": text,
+                        "start": round(seg["start"], 3),
+                        "end": round(seg["end"], 3),
+                    }
+                )
+            for i in members:
+                results[i] = (segments[i], file_language)
+    finally:
+        whisper_model.tokenizer = previous_tokenizer
+        whisper_model.options = previous_options
+    return results
+
+def offset_segments(segments, offset: float):
+    """Shift the segment and word timestamps of a shard by offset seconds."""
+    for segment in segments:
+        segment["start"] = round(segment["start"] + offset, 3)
+        segment["end"] = round(segment["end"] + offset, 3)
+        if segment.get("words"):
+            # faster-whisper words are (start, end, word, probability) tuples
+            segment["words"] = [
+                word._replace(
+                    start=round(word.start + offset, 3), end=round(word.end + offset, 3)
+                )
+                for word in segment["words"]
+            ]
+    return segments
+
+
+# state of a shard worker process, set up once by _init_shard_worker
+_shard_worker = {}
+
+
+def _init_shard_worker(
+    audio_path, batch_size, model_name, compute_dtype, suppress_numerals, device, cpu_threads
+):
+    from audio_helpers import PcmAudio
+
+    torch.set_num_threads(cpu_threads)
+    if batch_size != 0:
+        whisper_model = load_batched_whisper_model(
+            model_name, compute_dtype, suppress_numerals, device, cpu_threads
+        )
+    else:
+        whisper_model = load_whisper_model(model_name, compute_dtype, device, cpu_threads)
+    _shard_worker.update(
+        audio=PcmAudio(audio_path),
+        whisper_model=whisper_model,
+        args=(batch_size, model_name, compute_dtype, suppress_numerals, device),
+    )
+
+
+def _detect_shard_language(start, end):
+    from audio_helpers import SAMPLE_RATE
+
+    # both Whisper variants only look at the first 30 seconds
+    audio = _shard_worker["audio"].float32(start, min(end, start + 30 * SAMPLE_RATE))
+    whisper_model = _shard_worker["whisper_model"]
+    if _shard_worker["args"][0] != 0:
+        return whisper_model.detect_language(audio)
+    # faster-whisper detects the language before the lazy segments are decoded
+    _, info = whisper_model.transcribe(audio, vad_filter=True)
+    return info.language
+
+
+def _transcribe_shard(start, end, language):
+    from audio_helpers import SAMPLE_RATE
+
+    audio = _shard_worker["audio"].float32(start, end)
+    batch_size, model_name, compute_dtype, suppress_numerals, device = _shard_worker[
+        "args"
+    ]
+    whisper_model = _shard_worker["whisper_model"]
+    if batch_size != 0:
+        segments, _ = transcribe_batched(
+            audio,
+            language,
+            batch_size,
+            model_name,
+            compute_dtype,
+            suppress_numerals,
+            device,
+            whisper_model=whisper_model,
+        )
+    else:
+        segments, _ = transcribe(
+            audio,
+            language,
+            model_name,
+            compute_dtype,
+            suppress_numerals,
+            device,
+            whisper_model=whisper_model,
+        )
+    return offset_segments(segments, start / SAMPLE_RATE)
+
+
+def transcribe_sharded(
+    audio_path: str,
+    shards,
+    language: str,
+    batch_size: int,
+    model_name: str,
+    compute_dtype: str,
+    suppress_numerals: bool,
+    device: str,
+):
+    """
+    Transcribe the [start, end) sample ranges of a 16 kHz mono WAV on a process
+    pool, one shard per process, and merge them into a single whisper_results
+    list with timestamps relative to the start of the file. The workers memory
+    map audio_path instead of receiving the samples, and share the CPU cores.
+    """
+    num_workers = len(shards)
+    cpu_threads = max((os.cpu_count() or 1) // num_workers, 1)
+    # spawned, not forked: the caller can be a resident worker with threads
+    # and a CUDA context, and a forked child inherits their locks as they are
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_shard_worker,
+        initargs=(
+            audio_path,
+            batch_size,
+            model_name,
+            compute_dtype,
+            suppress_numerals,
+            device,
+            cpu_threads,
+        ),
+    ) as pool:
+        if language is None:
+            # detect once on the start of the file like an unsharded run does
+            language = pool.submit(_detect_shard_language, *shards[0]).result()
+        futures = [
+            pool.submit(_transcribe_shard, start, end, language)
+            for start, end in shards
+        ]
+        whisper_results = []
+        for future in futures:
+            whisper_results.extend(future.result())
+    return whisper_results, language
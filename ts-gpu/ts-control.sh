@@ -9,11 +9,20 @@
 process1="transcribe.sh"
 maxConcurrentRuns1=$MAX_CONCURRENT_TRANSFORMS  # Maximum concurrent runs for process1
 
+# The resident worker keeps the models loaded between files and handles the
+# incoming folders itself. Set TS_RESIDENT_WORKER=0 to go back to one
+# transcribe.sh run per pass.
+if [ "${TS_RESIDENT_WORKER:-1}" != "0" ]; then
+  process1="ts-worker.py"
+  maxConcurrentRuns1=1
+fi
+
 process2="auto-summary.py"
 maxConcurrentRuns2=$MAX_CONCURRENT_SUMMARYS  # Maximum concurrent runs for process2
 
-# Delay between starting each script (in seconds)
-delayBetweenStarts=10
+# Delay between starting each script (in seconds). Incoming folders are claimed
+# through job_queue.py, so concurrent runs no longer need to be spread out.
+delayBetweenStarts=1
 
 # Function to start a process if it hasn't reached its limit
 start_process_if_allowed() {
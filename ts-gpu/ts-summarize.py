@@ -1,10 +1,11 @@
 import json
 import sys
 import os
-import requests
 import subprocess
 import re
 
+import requests
+
 # Check if both a folder path and API base URL were provided as command line arguments
 if len(sys.argv) < 3:
     print("Please provide a folder path and an API base URL as command line arguments.")
@@ -0,0 +1,441 @@
+import glob
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+import traceback
+
+import audioread
+from audio_helpers import SAMPLE_RATE
+from json_helpers import update_json_data
+from job_queue import FAILED, JobQueue, scan_incoming
+from model_cache import ModelCache
+from pipeline import (
+    JobReport,
+    create_diarization_graph,
+    diarize_files,
+    get_parser,
+    get_whisper_model,
+    prewarm_models,
+    whisper_model_loader,
+)
+from stage_graph import format_stats
+
+# transcription stream resident worker
+# Replaces one transcribe.sh / diarize_parallel.py run per file. The Whisper,
+# alignment, punctuation and NeMo models are loaded once and kept resident in
+# a ModelCache, so short files no longer pay the model load on every job.
+
+# Folders are claimed from the sqlite job queue, so MAX_CONCURRENT_TRANSFORMS
+# worker threads can share the resident models without picking up the same
+# rowId twice. The diarization stages of all worker threads run on one stage
+# graph, so the files of concurrent rows overlap: one is decoded while another
+# is diarized, and TS_MODEL_SLOTS bounds how many model stages run at once.
+
+transcribed_dir = "/transcriptionstream/transcribed/"
+audio_extensions = ("wav", "mp3", "flac", "ogg")
+
+# only used when inotify is not available, see watch_incoming
+scan_interval = 5
+claim_interval = 0.5
+
+# see cpu_serving_args
+cpu_serving = os.environ.get("TS_CPU_SERVING", "0") != "0"
+cpu_workers = os.environ.get("TS_CPU_WORKERS") or os.environ.get("TS_MODEL_SLOTS", "2")
+
+transcription_model = os.environ.get("TRANSCRIPTION_MODEL", "large-v3")
+diarization_model = os.environ.get("DIARIZATION_MODEL", "medium.en")
+prewarm_languages = [
+    language.strip()
+    for language in os.environ.get("TS_PREWARM_LANGUAGES", "en").split(",")
+    if language.strip()
+]
+
+
+def default_cache_size():
+    """
+    Room for every model a mixed load uses, so no job evicts a model the next
+    one needs: the transcription and diarization Whisper models (and the
+    shared CPU model under each with TS_CPU_SERVING), an alignment model per
+    prewarmed language, the NeMo diarizer, punctuation and demucs, plus one
+    spare for another language or diarization profile.
+    """
+    whisper_models = len({transcription_model, diarization_model})
+    if cpu_serving:
+        whisper_models *= 2
+    return whisper_models + len(prewarm_languages) + 4
+
+
+# created by main, so a process spawned by the shard or separation pools
+# imports this module without loading models or starting threads
+model_cache = None
+diarization_graph = None
+
+
+def create_resident_state():
+    global model_cache, diarization_graph
+    model_cache = ModelCache(
+        capacity=int(os.environ.get("TS_MODEL_CACHE_SIZE") or default_cache_size())
+    )
+    diarization_graph = create_diarization_graph(
+        model_cache,
+        nemo_in_process=True,
+        model_slots=int(os.environ.get("TS_MODEL_SLOTS", 2)),
+        # the jobs of the shared CPU model transcribe side by side
+        transcribe_workers=int(cpu_workers) if cpu_serving else 1,
+    )
+
+
+def log(message):
+    print(message, flush=True)
+
+
+def cpu_serving_args():
+    """
+    TS_CPU_SERVING=1 serves every job of a CPU node from one shared Whisper
+    model per model name, with TS_CPU_WORKERS parallel workers (by default
+    TS_MODEL_SLOTS, the model stages that run at once) and TS_CPU_THREADS
+    threads each.
+    """
+    if not cpu_serving:
+        return []
+    return [
+        "--cpu-serving",
+        "--cpu-workers",
+        cpu_workers,
+        "--cpu-threads",
+        os.environ.get("TS_CPU_THREADS", "0"),
+    ]
+
+
+def get_transcribe_args(model_name, device):
+    return get_parser().parse_args(
+        [
+            "-a",
+            "transcribe",
+            "--whisper-model",
+            model_name,
+            "--device",
+            device,
+            *cpu_serving_args(),
+        ]
+    )
+
+
+def transcribe_to_dir(audio_file, output_dir, model_name, batch_size, device):
+    """In-process equivalent of the whisperx CLI call in transcribe.sh."""
+    # takes a model slot of the diarization stages, so both share the GPU budget
+    with diarization_graph.resource("model"):
+        return _transcribe_to_dir(audio_file, output_dir, model_name, batch_size, device)
+
+
+def _transcribe_to_dir(audio_file, output_dir, model_name, batch_size, device):
+    import whisperx
+    from whisperx.utils import get_writer
+
+    report = JobReport()
+    model = get_whisper_model(get_transcribe_args(model_name, device), model_cache, report)
+    audio = whisperx.load_audio(audio_file)
+    report.audio_duration = len(audio) / SAMPLE_RATE
+    result = model.transcribe(audio, batch_size=batch_size)
+
+    language = result["language"]
+    try:
+        align_model, align_metadata = report.get_model(
+            model_cache,
+            ("align", language, device),
+            lambda: whisperx.load_align_model(language_code=language, device=device),
+        )
+    except ValueError:
+        logging.warning(f"No alignment model for language {language}, skipping alignment")
+    else:
+        result = whisperx.align(
+            result["segments"], align_model, align_metadata, audio, device
+        )
+    result["language"] = language
+
+    writer = get_writer("all", output_dir)
+    writer(
+        result,
+        audio_file,
+        {"highlight_words": False, "max_line_count": None, "max_line_width": None},
+    )
+    return report
+
+
+# data.json keys of a row -> diarization options
+row_options = {
+    "channelSpeakers": "--channel-speakers",
+    "diarizationProfile": "--diarization-profile",
+    "numSpeakers": "--num-speakers",
+    "maxSpeakers": "--max-speakers",
+}
+
+
+def get_row_args(incoming_dir):
+    """
+    Diarization options of a row from its data.json, e.g. "channelSpeakers":
+    ["Agent", "Customer"] names the speakers of stereo calls per channel and
+    "diarizationProfile": "fast" with "maxSpeakers": 2 trades accuracy for speed.
+    """
+    try:
+        with open(os.path.join(incoming_dir, "data.json")) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return []
+    if not isinstance(data, dict):
+        return []
+    row_args = []
+    for key, option in row_options.items():
+        value = data.get(key)
+        if isinstance(value, list):
+            value = ",".join(str(v) for v in value)
+        if value not in (None, ""):
+            row_args += [option, str(value)]
+    return row_args
+
+
+def get_diarize_args(audio_file, row_args=()):
+    """The diarization args of the node, TS_* settings first and the row's options last."""
+    node_args = []
+    if os.environ.get("TS_COMPACT", "0") != "0":
+        node_args.append("--compact")
+    if os.environ.get("TS_CHANNEL_SPEAKERS"):
+        node_args += ["--channel-speakers", os.environ["TS_CHANNEL_SPEAKERS"]]
+    return get_parser().parse_args(
+        [
+            "--batch-size",
+            "16",
+            "--whisper-model",
+            diarization_model,
+            "--diarization-profile",
+            os.environ.get("TS_DIARIZATION_PROFILE", "balanced"),
+            *cpu_serving_args(),
+            *node_args,
+            *row_args,
+            "-a",
+            audio_file,
+        ]
+    )
+
+
+def diarize_row(audio_files):
+    log(f"--- diarizing {', '.join(audio_files)}...")
+    row_args = get_row_args(os.path.dirname(audio_files[0]))
+    try:
+        args = get_diarize_args(audio_files[0], row_args)
+    except SystemExit:
+        # argparse exits on invalid values, that must not end the job thread
+        raise ValueError(f"Invalid diarization options in data.json: {row_args}")
+    reports = diarize_files(
+        audio_files, args, cache=model_cache, nemo_in_process=True, graph=diarization_graph
+    )
+    log(f"--- stages: {format_stats(diarization_graph.stats())}")
+    return reports
+
+
+def transcribe_audio(audio_file, new_dir):
+    log(f"--- transcribing {audio_file}...")
+    device = get_parser().get_default("device")
+    return transcribe_to_dir(
+        audio_file,
+        new_dir,
+        transcription_model,
+        12,
+        device,
+    )
+
+
+def prewarm():
+    """
+    Check the local artifacts and load the configured models into the model
+    cache, so neither happens on the critical path of the first job. A job
+    that starts meanwhile waits for the load of a model it needs.
+    """
+    from artifacts import configured_artifacts, preflight
+
+    start_time = time.time()
+    try:
+        for name, problem in preflight(configured_artifacts()):
+            log(f"--- artifact {name}: {problem}")
+    except Exception:
+        logging.exception("Artifact preflight failed")
+
+    prewarm_models(get_diarize_args("prewarm"), model_cache, prewarm_languages)
+
+    device = get_parser().get_default("device")
+    try:
+        model_cache.get(
+            *whisper_model_loader(
+                get_transcribe_args(transcription_model, device), model_cache, JobReport()
+            )
+        )
+    except Exception:
+        logging.exception(f"Prewarming {transcription_model} failed")
+    log(f"--- models prewarmed in {time.time() - start_time:.1f}s")
+
+
+def update_data(destination, audio, run_time, report):
+    if not os.path.exists(destination) or not os.path.exists(audio):
+        log("data/audio file not exists")
+        return
+
+    data = {
+        "transcription_time": str(run_time),
+        "file_size": os.path.getsize(audio),
+        "model_load_time_saved": round(report.time_saved, 3),
+    }
+
+    if report.audio_duration is not None:
+        data["audio_duration"] = report.audio_duration
+    else:
+        with audioread.audio_open(audio) as f:
+            data["audio_duration"] = f.duration
+
+    update_json_data(destination, data, "utf-8-sig")
+
+
+def finish_audio(incoming_dir, new_dir, audio_file, ext, run_time, report):
+    base_name = os.path.basename(audio_file)[: -len(ext) - 1]
+
+    # Move all files with the same base_name to the new subdirectory
+    for path in glob.glob(os.path.join(incoming_dir, glob.escape(base_name) + "*")):
+        shutil.move(path, os.path.join(new_dir, os.path.basename(path)))
+
+    subprocess.run(["chown", "-R", "transcriptionstream:transcriptionstream", new_dir])
+
+    update_data(
+        os.path.join(new_dir, base_name + ".json"),
+        os.path.join(new_dir, f"{base_name}.{ext}"),
+        run_time,
+        report,
+    )
+
+    log(f"--- done processing {audio_file} - output placed in {new_dir}")
+    log(
+        f"Runtime for processing {audio_file} = {run_time}, model load time saved"
+        f" vs cold start = {report.time_saved:.1f}s ({', '.join(f'{k}: {v}' for k, v in report.models.items())})"
+    )
+    log("------------------------------------")
+
+
+def process_row(sub_dir, incoming_dir):
+    row_id = os.path.basename(os.path.normpath(incoming_dir))
+    failed = []
+
+    audio_files = []
+    for ext in audio_extensions:
+        for audio_file in sorted(glob.glob(os.path.join(incoming_dir, f"*.{ext}"))):
+            if os.path.isfile(audio_file):
+                base_name = os.path.basename(audio_file)[: -len(ext) - 1]
+                new_dir = os.path.join(transcribed_dir, row_id, base_name)
+                os.makedirs(new_dir, exist_ok=True)
+                audio_files.append((audio_file, ext, new_dir))
+
+    if sub_dir == "diarize" and audio_files:
+        # the files of a row are diarized as one batch, the run time is split
+        # between them by audio duration
+        start_time = time.time()
+        try:
+            reports = diarize_row([audio_file for audio_file, _, _ in audio_files])
+        except Exception:
+            logging.exception(f"Processing {incoming_dir} failed")
+            raise
+        run_time = time.time() - start_time
+        total_duration = sum(report.audio_duration or 0 for report in reports)
+        for (audio_file, ext, new_dir), report in zip(audio_files, reports):
+            if report.error is not None:
+                # leave the audio in incoming so the retry picks it up again
+                failed.append(f"{audio_file}: {report.error!r}")
+                continue
+            share = (report.audio_duration or 0) / total_duration if total_duration else 1
+            finish_audio(incoming_dir, new_dir, audio_file, ext, int(run_time * share), report)
+    else:
+        for audio_file, ext, new_dir in audio_files:
+            start_time = time.time()
+            try:
+                report = transcribe_audio(audio_file, new_dir)
+            except Exception:
+                # leave the audio in incoming so the retry picks it up again
+                logging.exception(f"Processing {audio_file} failed")
+                failed.append(traceback.format_exc())
+                continue
+            run_time = int(time.time() - start_time)
+            finish_audio(incoming_dir, new_dir, audio_file, ext, run_time, report)
+
+    if failed:
+        raise RuntimeError("\n".join(failed))
+
+    data_file = os.path.join(incoming_dir, "data.json")
+    if os.path.exists(data_file):
+        os.makedirs(os.path.join(transcribed_dir, row_id), exist_ok=True)
+        shutil.move(data_file, os.path.join(transcribed_dir, row_id, "data.json"))
+        subprocess.run(
+            [
+                "python3",
+                "/root/scripts/notify.py",
+                "--path",
+                os.path.join(transcribed_dir, row_id) + "/",
+            ]
+        )
+
+    shutil.rmtree(incoming_dir, ignore_errors=True)
+
+
+def run_jobs(queue):
+    while True:
+        job = queue.claim()
+        if job is None:
+            queue.wait_for_job(claim_interval)
+            continue
+
+        log(f"--- job {job['id']} claimed: {job['path']} (attempt {job['attempts']})")
+        try:
+            process_row(job["kind"], job["path"])
+        except Exception as e:
+            state = queue.fail(job["id"], e)
+            log(f"--- job {job['id']} failed, {'giving up' if state == FAILED else 'retrying'}")
+        else:
+            queue.complete(job["id"])
+
+
+def watch_incoming(queue):
+    try:
+        from folder_watcher import IncomingWatcher
+    except ImportError:
+        logging.warning("inotify_simple is not installed, polling the incoming folders")
+        scan_forever(queue)
+        return
+    IncomingWatcher(queue).run()
+
+
+def scan_forever(queue):
+    while True:
+        try:
+            scan_incoming(queue)
+        except Exception:
+            logging.exception("Scanning incoming folders failed")
+        time.sleep(scan_interval)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    create_resident_state()
+    queue = JobQueue()
+    for job_id in queue.requeue_orphans():
+        log(f"--- job {job_id} requeued, its worker is gone")
+
+    workers = max(int(os.environ.get("MAX_CONCURRENT_TRANSFORMS") or 1), 1)
+    log(f"--- resident transcription worker started with {workers} job threads")
+    if os.environ.get("TS_PREWARM", "1") != "0":
+        threading.Thread(target=prewarm, daemon=True).start()
+    for _ in range(workers):
+        threading.Thread(target=run_jobs, args=(queue,), daemon=True).start()
+    watch_incoming(queue)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,7 @@ import argparse
 import os
 import json
 import sys
-import audioread
-from helpers import update_json_data
+from json_helpers import update_json_data
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -38,7 +37,12 @@ if args.destination != '' and args.audio != '' and args.time != '':
 
     data = {'transcription_time': args.time, 'file_size': os.path.getsize(audio)}
 
-    with audioread.audio_open(audio) as f:
-        data['audio_duration'] = f.duration
+    def audio_duration():
+        import audioread
 
-    update_json_data(dest, data, 'utf-8-sig')
\ No newline at end of file
+        with audioread.audio_open(audio) as f:
+            return f.duration
+
+    # diarization already stores the duration of its decoded buffer, only
+    # whisperx transcriptions still need the audio opened here
+    update_json_data(dest, data, 'utf-8-sig', defaults={'audio_duration': audio_duration})
\ No newline at end of file
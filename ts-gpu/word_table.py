@@ -0,0 +1,64 @@
+import sys
+
+import numpy as np
+
+
+class WordTable:
+    """
+    The words of a transcript as columns instead of one dict per word: start
+    and end in ms as int32, speaker ids as int16 and the word texts as interned
+    strings, so repeated words share one object. A stage returns a new table
+    that shares the columns it did not change.
+    """
+
+    __slots__ = ("words", "start", "end", "speaker")
+
+    def __init__(self, words, start, end, speaker=None):
+        self.words = words
+        self.start = start
+        self.end = end
+        # None until the words are mapped to speakers
+        self.speaker = speaker
+
+    def __len__(self):
+        return len(self.words)
+
+    @classmethod
+    def from_word_timestamps(cls, word_timestamps):
+        """From whisperx word segments, with start and end in seconds."""
+        num_words = len(word_timestamps)
+        start = np.fromiter((w["start"] for w in word_timestamps), np.float64, num_words)
+        end = np.fromiter((w["end"] for w in word_timestamps), np.float64, num_words)
+        return cls(
+            [sys.intern(w["word"]) for w in word_timestamps],
+            (start * 1000).astype(np.int32),
+            (end * 1000).astype(np.int32),
+        )
+
+    @classmethod
+    def from_dicts(cls, word_speaker_mapping):
+        """From the word speaker mapping dicts with start_time and end_time in ms."""
+        num_words = len(word_speaker_mapping)
+        return cls(
+            [sys.intern(w["word"]) for w in word_speaker_mapping],
+            np.fromiter((w["start_time"] for w in word_speaker_mapping), np.int32, num_words),
+            np.fromiter((w["end_time"] for w in word_speaker_mapping), np.int32, num_words),
+            np.fromiter((w["speaker"] for w in word_speaker_mapping), np.int16, num_words),
+        )
+
+    def to_dicts(self):
+        """The word speaker mapping dicts, with plain Python ints."""
+        return [
+            {"word": wrd, "start_time": s, "end_time": e, "speaker": sp}
+            for wrd, s, e, sp in zip(
+                self.words, self.start.tolist(), self.end.tolist(), self.speaker.tolist()
+            )
+        ]
+
+    def replace(self, words=None, speaker=None, start=None, end=None):
+        return WordTable(
+            self.words if words is None else words,
+            self.start if start is None else start,
+            self.end if end is None else end,
+            self.speaker if speaker is None else speaker,
+        )
@@ -109,24 +109,30 @@ class CheckPointResponse(BaseModel):
 def before_request():
     g.start_time = datetime.now()
 
+# transcribed folder -> (folder mtime, sub folders still missing an .srt file)
+transcriptionIndex = {}
+
+def folder_is_complete(folder):
+    """Return True when every audio sub folder has its .srt, re-listing only what changed."""
+    mtime = os.stat(folder).st_mtime_ns
+    cached = transcriptionIndex.get(folder)
+    if cached is not None and cached[0] == mtime:
+        missing = cached[1]
+    else:
+        missing = [os.path.join(folder, f) for f in os.listdir(folder) if os.path.isdir(os.path.join(folder, f))]
+
+    missing = [subFolder for subFolder in missing if not any(file.endswith('.srt') for file in os.listdir(subFolder))]
+    transcriptionIndex[folder] = (mtime, missing)
+    return not missing
+
 @app.route('/')
 def index():
-    folderPaths = [os.path.join(TRANSCRIBED_FOLDER, f) for f in os.listdir(TRANSCRIBED_FOLDER) if os.path.isdir(os.path.join(TRANSCRIBED_FOLDER, f))]
-
-    # Filter folders to only include those containing an .srt file
     validFolders = []
-    for folder in folderPaths:
-        subFolders = [os.path.join(folder, f) for f in os.listdir(folder) if os.path.isdir(os.path.join(folder, f))]
-        showFolder = True
-        for subFolder in subFolders:
-            files = os.listdir(subFolder)
-            if not any(file.endswith('.srt') for file in files):
-                showFolder = False
-                continue
-
-        if (showFolder):
-            validFolders.append(os.path.basename(folder))
-    
+    for entry in os.scandir(TRANSCRIBED_FOLDER):
+        # Filter folders to only include those containing an .srt file
+        if entry.is_dir() and folder_is_complete(entry.path):
+            validFolders.append(entry.name)
+
     sortedFolders = sorted(validFolders, key=lambda s: s.lower())  # Sorting by name in ascending order, case-insensitive
     return jsonify({"transcriptions": sortedFolders})
 
@@ -142,11 +148,14 @@ def upload_audio():
 #     headers = {'Authorization': "Bearer " + os.environ.get('SALESDOCK_AUTHORIZATION')}
     headers = {}
 
-    folderPath = os.path.join(app.config['UPLOAD_FOLDER'], 'diarize', str(request_data['rowId']))
+    # download into a staging folder and move it into diarize/ in one rename, so the
+    # ts-gpu watcher only ever sees complete folders
+    folderPath = os.path.join(app.config['UPLOAD_FOLDER'], '.staging', str(request_data['rowId']))
+    targetPath = os.path.join(app.config['UPLOAD_FOLDER'], 'diarize', str(request_data['rowId']))
     if (os.path.exists(folderPath)):
         shutil.rmtree(folderPath)
 
-    os.mkdir(folderPath)
+    os.makedirs(folderPath)
     for audio in request_data['audios']:
         audioUrl = audio['url']
         response = requests.get(audioUrl, headers=headers, verify=False)
@@ -164,6 +173,10 @@ def upload_audio():
 
     with open(os.path.join(folderPath, secure_filename('data.json')), mode="w") as file:
         json.dump(request_data, file)
+
+    if (os.path.exists(targetPath)):
+        shutil.rmtree(targetPath)
+    os.rename(folderPath, targetPath)
     return jsonify(success=True, message="File saved successfully"), 200
 
 @app.route('/transcription/<path:folder>', methods=['GET'])